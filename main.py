@@ -4,8 +4,40 @@ import re
 import subprocess
 import threading
 import json
+import csv
 from datetime import timedelta
 import shutil
+import math
+import struct
+import mmap
+import multiprocessing
+import tempfile
+import time
+import platform
+import argparse
+import hashlib
+import sqlite3
+import statistics
+import functools
+import select
+import signal
+import ctypes
+import ctypes.util
+import hmac
+import secrets
+import urllib.request
+import urllib.error
+from fractions import Fraction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import resource # Unix のみ (子プロセスのCPU時間・ピークRSSの取得に使う)
+except ImportError:
+    resource = None
+_startup_started = time.perf_counter() # 起動時間の計測の起点 (PySide の読み込みより前)
 
 # --- ▼ ステップ1 修正箇所 (1/3) ▼ ---
 # PyInstallerでビルドした.app/.exeが同梱のバイナリを見つけるためのヘルパー関数を追加
@@ -21,23 +53,3403 @@ def get_base_path():
         return os.path.dirname(os.path.abspath(__file__))
 # --- ▲ ステップ1 修正箇所 (1/3) ▲ ---
 
+# --- メニューのレイアウト座標系 ---
+# シーンは出力解像度に依存しない論理座標 (16:9) で編集し、
+# 書き出し時にスケール変換で出力解像度へ直接レンダリングする
+MENU_LAYOUT_WIDTH = 1920
+MENU_LAYOUT_HEIGHT = 1080
+
+def parse_resolution_fps(resolution_fps, default_res="1920x1080", default_fps="23.976"):
+    """ '1920x1080:24000/1001' 形式の設定値を (幅, 高さ, fps文字列) に分解する """
+    res, fps = default_res, default_fps
+    if resolution_fps:
+        res_part, _, fps_part = resolution_fps.partition(':')
+        if res_part: res = res_part
+        if fps_part: fps = fps_part
+    width, height = (int(v) for v in res.split('x'))
+    return width, height, fps
+
+def get_cache_dir():
+    """ プローブ索引などのキャッシュを保存するディレクトリを返す (BDCOPY_CACHE_DIR で上書き可) """
+    cache_dir = os.environ.get("BDCOPY_CACHE_DIR")
+    if not cache_dir:
+        if sys.platform == "win32":
+            base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+        elif sys.platform == "darwin":
+            base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+        else:
+            base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+        cache_dir = os.path.join(base, "BDCopy")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def run_command(command, log=None, capture=False, cpu=None):
+    """
+    サブプロセスを実行し、出力を1行ずつ log に流す。(returncode, 出力行のリスト) を返す。
+    cpu (CpuLease) を渡すと、その割り当てに従って優先度と CPU アフィニティを設定する。
+    """
+    with trace_span(os.path.basename(str(command[0])), "subprocess", cmd=' '.join(str(c) for c in command)) as span:
+        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        if cpu:
+            creationflags |= cpu.creationflags
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', errors='replace', creationflags=creationflags)
+        span["pid"] = process.pid
+        if cpu:
+            cpu.apply(process)
+            span["threads"] = cpu.threads
+        lines = []
+        for line in process.stdout:
+            line = line.strip()
+            if log: log(line)
+            if capture: lines.append(line)
+        _wait_process(process)
+        span["returncode"] = process.returncode
+    _stage_metrics.note("exit_codes", (os.path.basename(str(command[0])), process.returncode))
+    return process.returncode, lines
+
+# --- CPU の割り当て (スレッド予算と優先度) ---
+CPU_RESERVED_CORES = 1 # GUI とプレビュー再生のために空けておくコア数
+CPU_BACKGROUND_NICE = 10
+CPU_BACKGROUND_IOPRIO = (2 << 13) | 7 # ベストエフォート (クラス2) の最低レベル
+CPU_LEASE_LIMITS = {"menu_encode": 2, "audio_encode": 1, "loudness": 1} # 処理の種類ごとのスレッド数の上限
+CPU_MAIN_ENCODE_SHARE = 0.5 # 本編エンコードは他の処理と重なっても予算の半分以上を使う
+_IOPRIO_SET_SYSCALL = {"x86_64": 251, "amd64": 251, "aarch64": 30, "arm64": 30, "i686": 289, "armv7l": 314, "ppc64le": 273}
+
+class CpuLease:
+    """ ResourceGovernor から借りたスレッド数と CPU。with を抜けると返す """
+    def __init__(self, governor, kind, threads, cpus):
+        self.governor = governor
+        self.kind = kind
+        self.threads = threads
+        self.cpus = cpus # アフィニティを設定しない場合は None
+
+    @property
+    def creationflags(self):
+        if sys.platform == 'win32' and self.governor.background_priority:
+            return subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        return 0
+
+    def apply(self, process):
+        """ 起動直後のプロセスに優先度と CPU アフィニティを設定する (失敗しても処理は続ける) """
+        try:
+            if self.governor.background_priority and hasattr(os, "setpriority"):
+                os.setpriority(os.PRIO_PROCESS, process.pid, CPU_BACKGROUND_NICE)
+                syscall = _IOPRIO_SET_SYSCALL.get(platform.machine().lower()) if sys.platform.startswith("linux") else None
+                if syscall:
+                    ctypes.CDLL(None, use_errno=True).syscall(syscall, 1, process.pid, CPU_BACKGROUND_IOPRIO) # IOPRIO_WHO_PROCESS
+            if self.cpus is not None:
+                if hasattr(os, "sched_setaffinity"):
+                    os.sched_setaffinity(process.pid, self.cpus)
+                elif sys.platform == 'win32':
+                    mask = sum(1 << cpu for cpu in self.cpus)
+                    ctypes.windll.kernel32.SetProcessAffinityMask(int(process._handle), ctypes.c_size_t(mask))
+        except OSError:
+            pass # 既に終了している・権限が無い
+
+    def describe(self):
+        cpus = ""
+        if self.cpus:
+            cpus = f", CPU {self.cpus[0]}" + (f"-{self.cpus[-1]}" if len(self.cpus) > 1 else "")
+        priority = ", 低優先度" if self.governor.background_priority else ""
+        return f"{self.kind}: {self.threads}スレッド{cpus}{priority}"
+
+    def release(self):
+        self.governor.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class ResourceGovernor:
+    """
+    並行するエンコード (ffmpeg) にスレッド数を割り当てる。
+    使用中の割り当ての合計が予算 (コア数 - GUI 用の予約) を超えないように配り、
+    本編エンコードには他の処理と重なっても一定以上を回す。
+    """
+    def __init__(self, budget=None, reserved_cores=CPU_RESERVED_CORES, affinity=False, background_priority=True):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        reserved = min(reserved_cores, len(cpus) - 1)
+        self.usable_cpus = cpus[reserved:] # 先頭のコアを GUI 用に空けておく
+        self.budget = max(1, budget or len(self.usable_cpus))
+        self.affinity = affinity
+        self.background_priority = background_priority
+        self._lock = threading.Condition()
+        self._active = []
+
+    def _free(self):
+        return self.budget - sum(lease.threads for lease in self._active)
+
+    def lease(self, kind, max_threads=None, min_threads=None):
+        """ min_threads を渡すと、その数が空くまで待つ (複数タイトルの並行エンコードで予算を超えないように) """
+        with self._lock:
+            limit = min(CPU_LEASE_LIMITS.get(kind, self.budget), max_threads or self.budget)
+            if min_threads:
+                need = min(min_threads, limit)
+                self._lock.wait_for(lambda: not self._active or self._free() >= need)
+            free = self._free()
+            threads = max(1, min(limit, free))
+            if kind == "video_encode" and not min_threads:
+                threads = max(threads, min(limit, int(self.budget * CPU_MAIN_ENCODE_SHARE)))
+            cpus = None
+            if self.affinity:
+                taken = {cpu for lease in self._active for cpu in (lease.cpus or [])}
+                free_cpus = [cpu for cpu in self.usable_cpus if cpu not in taken]
+                # 空きが足りなければ予約分以外の全コアで共有する
+                cpus = free_cpus[:threads] if len(free_cpus) >= threads else list(self.usable_cpus)
+            lease = CpuLease(self, kind, threads, cpus)
+            self._active.append(lease)
+            return lease
+
+    def release(self, lease):
+        with self._lock:
+            if lease in self._active:
+                self._active.remove(lease)
+                self._lock.notify_all()
+
+    def describe(self):
+        return (f"CPU予算 {self.budget}スレッド (利用可能なコア {len(self.usable_cpus)}, "
+                f"アフィニティ {'あり' if self.affinity else 'なし'}, 低優先度 {'あり' if self.background_priority else 'なし'})")
+
+_resource_governor = None
+_resource_governor_lock = threading.Lock()
+
+def get_resource_governor():
+    global _resource_governor
+    with _resource_governor_lock:
+        if _resource_governor is None:
+            _resource_governor = ResourceGovernor()
+        return _resource_governor
+
+def configure_resource_governor(**options):
+    """ 起動時の設定 (CLI) で作り直す。実行中の割り当てには影響しない """
+    global _resource_governor
+    with _resource_governor_lock:
+        _resource_governor = ResourceGovernor(**options)
+        return _resource_governor
+
+# --- トレース (Chrome trace-event 形式) ---
+TRACE_BUFFER_EVENTS = 100000 # 直近のスパンだけをメモリに保持する
+
+class Tracer:
+    """
+    処理段階・サブプロセス・GUIスレッドの操作をスパンとして記録する。
+    ジョブごとの書き出しは start_capture() で開始時刻を押さえ、それ以降のスパンを対象にする。
+    ジョブの Worker で記録したスパンにはそのジョブの取り込み先 (capture) の番号を付け、
+    同時に走る別のジョブ (ディスクセットなど) のトレースには含めない。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=TRACE_BUFFER_EVENTS)
+        self._thread_names = {}
+        self._captures = 0
+        self._local = threading.local()
+        self.pid = os.getpid()
+
+    @staticmethod
+    def now_us():
+        return time.perf_counter_ns() // 1000
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """ with 内の処理を1スパンとして記録する。yield した dict に追記した値は args に入る """
+        started = self.now_us()
+        try:
+            yield args
+        except Exception as e:
+            args["error"] = str(e)
+            raise
+        finally:
+            thread = threading.current_thread()
+            event = {"name": name, "cat": category, "ph": "X", "ts": started, "dur": self.now_us() - started,
+                     "pid": self.pid, "tid": thread.native_id, "args": args,
+                     "capture": getattr(self._local, "capture", None)}
+            with self._lock:
+                self._events.append(event)
+                self._thread_names[thread.native_id] = thread.name
+
+    def events_since(self, origin_us, capture_id=None):
+        """ origin_us 以降のスパン。capture_id を渡すと、他の取り込み先の番号が付いたスパンは除く """
+        with self._lock:
+            events = [{key: value for key, value in event.items() if key != "capture"} for event in self._events
+                      if event["ts"] >= origin_us and event["capture"] in (None, capture_id)]
+            thread_names = dict(self._thread_names)
+        return events, thread_names
+
+    def start_capture(self):
+        with self._lock:
+            self._captures += 1
+            capture_id = self._captures
+        return TraceCapture(self, self.now_us(), capture_id)
+
+    @contextmanager
+    def activate(self, capture_id):
+        """ with 内でこのスレッドが記録するスパンを capture_id の取り込み先に付ける """
+        previous = getattr(self._local, "capture", None)
+        self._local.capture = capture_id
+        try:
+            yield
+        finally:
+            self._local.capture = previous
+
+    def bind(self, func):
+        """ 別スレッドで実行する関数を、呼び出し元と同じ取り込み先で記録する """
+        capture_id = getattr(self._local, "capture", None)
+        if capture_id is None:
+            return func
+        def wrapper(*args, **kwargs):
+            with self.activate(capture_id):
+                return func(*args, **kwargs)
+        return wrapper
+
+class TraceCapture:
+    """
+    1ジョブ分のスパン (開始時刻以降) を Chrome trace JSON とサマリ表にまとめる。
+    取り込み先の番号が付いていないスパン (GUIスレッドの操作など) は、同じ時間帯のすべてのジョブに含まれる。
+    """
+    def __init__(self, tracer, origin_us, capture_id):
+        self.tracer = tracer
+        self.origin_us = origin_us
+        self.capture_id = capture_id
+
+    def activate(self):
+        return self.tracer.activate(self.capture_id)
+
+    def bind(self, func):
+        """ func をこのジョブのスパンとして記録されるように包む (Worker の run など) """
+        def wrapper(*args, **kwargs):
+            with self.activate():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def export(self, path):
+        events, thread_names = self.tracer.events_since(self.origin_us, self.capture_id)
+        used_threads = {event["tid"] for event in events}
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.tracer.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in thread_names.items() if tid in used_threads]
+        metadata.append({"name": "process_name", "ph": "M", "pid": self.tracer.pid, "tid": 0, "args": {"name": "BDCopy"}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return path
+
+    def summary_lines(self):
+        """ 種別・名前ごとの回数・合計・最大時間の表 (合計の降順) """
+        events, _ = self.tracer.events_since(self.origin_us, self.capture_id)
+        if not events:
+            return []
+        totals = {}
+        for event in events:
+            entry = totals.setdefault((event["cat"], event["name"]), [0, 0, 0])
+            entry[0] += 1
+            entry[1] += event["dur"]
+            entry[2] = max(entry[2], event["dur"])
+        elapsed = max(event["ts"] + event["dur"] for event in events) - self.origin_us
+        lines = [f"{'種別':<10} {'名前':<24} {'回数':>4} {'合計(秒)':>10} {'最大(秒)':>10}"]
+        for (category, name), (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{category:<10} {name:<24} {count:>4} {total / 1e6:>10.3f} {longest / 1e6:>10.3f}")
+        lines.append(f"ジョブ全体の経過時間: {elapsed / 1e6:.3f}秒")
+        return lines
+
+_tracer = Tracer()
+
+def get_tracer():
+    return _tracer
+
+def trace_span(name, category="stage", **args):
+    return _tracer.span(name, category, **args)
+
+# --- メトリクス (Prometheus テキスト形式) ---
+STAGE_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+class MetricsRegistry:
+    """ カウンタ・ゲージ・ヒストグラムを保持し、Prometheus のテキスト形式で出力する """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict() # 名前 -> {"type", "help", "values": {ラベル: 値}}
+
+    def _values(self, name, kind, help_text):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = {"type": kind, "help": help_text, "values": {}}
+        return metric["values"]
+
+    def inc(self, name, help_text, amount=1, **labels):
+        with self._lock:
+            values = self._values(name, "counter", help_text)
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, help_text, value, **labels):
+        with self._lock:
+            self._values(name, "gauge", help_text)[tuple(sorted(labels.items()))] = value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._metrics.get(name, {}).get("values", {}).get(tuple(sorted(labels.items())))
+
+    def observe(self, name, help_text, value, buckets=STAGE_DURATION_BUCKETS, **labels):
+        with self._lock:
+            values = self._values(name, "histogram", help_text)
+            histogram = values.setdefault(tuple(sorted(labels.items())),
+                                          {"bounds": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(histogram["bounds"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1 # 累積 (le) で数える
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['type']}")
+                for labels, value in metric["values"].items():
+                    if metric["type"] != "histogram":
+                        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+                        continue
+                    for bound, count in zip(value["bounds"], value["counts"]):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']:g}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+_metrics_registry = MetricsRegistry()
+
+def get_metrics_registry():
+    return _metrics_registry
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _metrics_registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # スクレイプごとのアクセスログは出さない
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """ /metrics を返す HTTP サーバーをデーモンスレッドで起動する (既定ではローカルホストのみ) """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+# --- 起動時間の計測 ---
+_startup_marks = OrderedDict() # 段階 -> 起点からの秒数
+
+def mark_startup(phase):
+    """ 起動の段階ごとの経過時間を記録する (メトリクスの bdcopy_startup_seconds にも出す) """
+    elapsed = time.perf_counter() - _startup_started
+    _startup_marks[phase] = elapsed
+    _metrics_registry.set("bdcopy_startup_seconds", "起動開始から各段階までの経過時間", elapsed, phase=phase)
+    return elapsed
+
+def describe_startup():
+    previous = 0.0
+    parts = []
+    for phase, elapsed in _startup_marks.items():
+        parts.append(f"{phase} {elapsed - previous:.2f}秒")
+        previous = elapsed
+    return f"起動時間: {previous:.2f}秒 ({' / '.join(parts)})"
+
+# --- 監視フォルダ (無人オーサリング) ---
+WATCH_VIDEO_EXTENSIONS = (".mkv", ".mp4", ".m4v", ".mov", ".m2ts", ".mts", ".ts", ".avi", ".mpg", ".mpeg")
+WATCH_DEFAULT_LAYOUT = "layout.json" # マスターと同名の .json が無いときに使うフォルダ共通のレイアウト
+WATCH_DRAIN_POLL_MS = 1000 # ジョブの終了後、残りの Worker の終了を確かめる間隔
+WATCH_STABLE_SEC = 10.0 # サイズと更新時刻がこの時間変わらなければコピー完了とみなす
+WATCH_POLL_SEC = 2.0
+WATCH_FINGERPRINT_CHUNK = 1024 * 1024
+
+def watch_fingerprint(video_path, layout_path):
+    """ 内容ベースの識別子 (サイズ + 先頭/末尾 1MiB + レイアウト)。同じマスターの再投入を重複として扱う """
+    digest = hashlib.sha256()
+    size = os.path.getsize(video_path)
+    digest.update(str(size).encode())
+    with open(video_path, 'rb') as f:
+        digest.update(f.read(WATCH_FINGERPRINT_CHUNK))
+        f.seek(max(0, size - WATCH_FINGERPRINT_CHUNK))
+        digest.update(f.read(WATCH_FINGERPRINT_CHUNK))
+    with open(layout_path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+class _Inotify:
+    """ Linux の inotify を ctypes で使う最小限のラッパー (フォルダへの書き込み・移動で起こす) """
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 に失敗しました")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for directory in directories:
+            if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, f"inotify_add_watch に失敗しました: {directory}")
+
+    def wait(self, timeout):
+        """ イベントが来るか timeout 秒経つまで待つ。イベント内容は使わず読み捨てる (再走査するため) """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(readable)
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    """
+    フォルダ直下のマスター (+ レイアウトJSON) を見張り、書き込みが止まったものを1回だけ通知する。
+    inotify が使えれば変更で起き、使えなければ一定間隔で走査する。安定判定はどちらも走査で行う。
+    """
+    def __init__(self, directories, on_ready, stable_sec=WATCH_STABLE_SEC, poll_sec=WATCH_POLL_SEC,
+                 use_inotify=True, log=None):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.on_ready = on_ready
+        self.stable_sec = stable_sec
+        self.poll_sec = poll_sec
+        self.use_inotify = use_inotify
+        self.log = log or (lambda message: None)
+        self.candidates = {} # マスターのパス -> {"state": (サイズ, 更新時刻...), "since": 変化が止まった時刻}
+        self.notified = {} # マスターのパス -> 通知した時の状態 (同じ状態では再通知しない)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        inotify = None
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                inotify = _Inotify(self.directories)
+                self.log("監視方式: inotify")
+            except OSError as e:
+                self.log(f"inotify を使えないためポーリングで監視します: {e}")
+        if inotify is None:
+            self.log(f"監視方式: ポーリング ({self.poll_sec:g}秒間隔)")
+        try:
+            while not self._stop.is_set():
+                self.scan()
+                # 安定待ちの候補があるときは短い間隔で再走査する
+                timeout = min(self.poll_sec, self.stable_sec) if self.candidates else self.poll_sec
+                if inotify:
+                    inotify.wait(timeout)
+                else:
+                    self._stop.wait(timeout)
+        finally:
+            if inotify:
+                inotify.close()
+
+    @staticmethod
+    def find_layout(video_path):
+        stem, _ = os.path.splitext(video_path)
+        for layout_path in (stem + ".json", os.path.join(os.path.dirname(video_path), WATCH_DEFAULT_LAYOUT)):
+            if os.path.isfile(layout_path):
+                return layout_path
+        return None
+
+    def scan(self):
+        now = time.monotonic()
+        seen = set()
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                self.log(f"監視フォルダを読めません: {directory}: {e}")
+                continue
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(WATCH_VIDEO_EXTENSIONS):
+                    continue
+                layout_path = self.find_layout(entry.path)
+                if not layout_path:
+                    continue # レイアウトが届くまで待つ
+                seen.add(entry.path)
+                try:
+                    video_stat, layout_stat = entry.stat(), os.stat(layout_path)
+                except OSError:
+                    continue
+                state = (video_stat.st_size, video_stat.st_mtime_ns, layout_path, layout_stat.st_size, layout_stat.st_mtime_ns)
+                candidate = self.candidates.get(entry.path)
+                if candidate is None or candidate["state"] != state:
+                    # 新規 または まだ書き込み中 (デバウンス: 変化するたびに待ち直す)
+                    self.candidates[entry.path] = {"state": state, "since": now}
+                    continue
+                if now - candidate["since"] < self.stable_sec or self.notified.get(entry.path) == state:
+                    continue
+                self.notified[entry.path] = state
+                try:
+                    fingerprint = watch_fingerprint(entry.path, layout_path)
+                except OSError as e:
+                    self.log(f"識別子を計算できません: {entry.path}: {e}")
+                    continue
+                self.on_ready({"video_path": entry.path, "layout_path": layout_path, "fingerprint": fingerprint})
+        for path in list(self.candidates):
+            if path not in seen:
+                del self.candidates[path] # 移動・削除されたもの
+                self.notified.pop(path, None)
+
+class WatchHistory:
+    """ 処理済みマスターの識別子と結果を保存する (同じ内容を再投入しても作り直さない) """
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_cache_dir(), "watch_history.json")
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, fingerprint):
+        return self.entries.get(fingerprint)
+
+    def record(self, fingerprint, **fields):
+        self.entries[fingerprint] = dict(fields, recorded_at=datetime.now().isoformat(timespec="seconds"))
+        with open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+def traced(category="gui"):
+    """ メソッド全体を1スパンとして記録するデコレータ (GUIスレッドの重い操作用) """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _tracer.span(func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- 処理段階の計測 ---
+def _maxrss_bytes(value):
+    # ru_maxrss は Linux では KiB、macOS ではバイト
+    return value if sys.platform == 'darwin' else value * 1024
+
+class StageMetrics:
+    """
+    処理段階 (メニュー描画・各エンコード・mux など) ごとの実測値を集める。
+    壁時計時間・CPU時間 (実行スレッド + 子プロセス)・ピークRSS・書き込みバイト数を記録する。
+    段階ごとの記録 (終了コード・キャッシュ可否を含む) は常に作り、メトリクスの収集に渡す。
+    一覧への蓄積と子プロセスのリソース取得はベンチマーク時 (enabled) のみ行う。
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages = []
+        self.epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def reset(self):
+        with self._lock:
+            self.stages = []
+            self.epoch = time.perf_counter()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def bind(self, func):
+        """ スレッドプールへ渡す関数を、呼び出し元の段階 (とトレースの取り込み先) の中で実行されたものとして記録する """
+        func = _tracer.bind(func)
+        record = self.current()
+        if record is None:
+            return func
+        def wrapper(*args, **kwargs):
+            stack = self._stack()
+            stack.append(record)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def note(self, key, value):
+        """ 実行中の段階の記録にリスト項目を追加する (段階の外なら何もしない) """
+        record = self.current()
+        if record is not None:
+            record.setdefault(key, []).append(value)
+
+    @contextmanager
+    def stage(self, name, outputs=None):
+        record = {"name": name, "thread": threading.current_thread().name,
+                  "start_sec": round(time.perf_counter() - self.epoch, 4), "ok": True,
+                  "processes": 0, "child_cpu_sec": 0.0, "peak_rss_bytes": 0}
+        stack = self._stack()
+        stack.append(record)
+        started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            stack.pop()
+            record["wall_sec"] = round(time.perf_counter() - started, 4)
+            record["cpu_sec"] = round(time.thread_time() - cpu_started + record.pop("child_cpu_sec"), 4)
+            record["bytes_written"] = sum(os.path.getsize(path) for path in (outputs or []) if os.path.isfile(path))
+            if self.enabled:
+                if not record["processes"] and resource:
+                    # 子プロセスを使わない段階 (メニュー描画など) はこのプロセスのピークを記録する
+                    record["peak_rss_bytes"] = _maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+                with self._lock:
+                    self.stages.append(record)
+
+    def add_process_usage(self, usage):
+        record = self.current()
+        if record is None:
+            return
+        record["processes"] += 1
+        record["child_cpu_sec"] += usage.ru_utime + usage.ru_stime
+        # fork 直後は親のページを共有するため、小さなツールでは親プロセスの RSS 程度が下限になる
+        record["peak_rss_bytes"] = max(record["peak_rss_bytes"], _maxrss_bytes(usage.ru_maxrss))
+
+_stage_metrics = StageMetrics()
+
+def get_stage_metrics():
+    return _stage_metrics
+
+@contextmanager
+def pipeline_stage(name, outputs=None, report=None):
+    """
+    with pipeline_stage("video_encode", outputs=[path], report=signals.stage.emit): の形で
+    処理段階をトレース・計測する。終了時 (失敗時も) に記録を report に渡す。
+    """
+    record = None
+    try:
+        with _tracer.span(name, "stage"), _stage_metrics.stage(name, outputs) as record:
+            yield record
+    finally:
+        if report and record is not None:
+            report(dict(record))
+
+def stage_kind(name):
+    """ 段階名から番号を除いた種類 (audio_encode_1 → audio_encode。集計と予測の単位) """
+    return re.sub(r'_\d+$', '', name)
+
+def note_cache(cache, hit):
+    """ 実行中の段階の記録にキャッシュの可否を残す (メトリクスのヒット率用) """
+    _stage_metrics.note("cache", (cache, bool(hit)))
+
+def _wait_process(process):
+    """ 子プロセスの終了を待つ。計測中は wait4 でリソース使用量も取得する """
+    if _stage_metrics.enabled and hasattr(os, "wait4") and process.returncode is None:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        _stage_metrics.add_process_usage(usage)
+        return process.returncode
+    return process.wait()
+
+# --- ソースのプローブ ---
+PROBE_VERSION = 4 # プローブ結果の項目を変えたら上げる (索引のキャッシュを無効化する)
+HDR10_TRANSFER = "smpte2084" # PQ。マスタリング情報 (HDR10 の静的メタデータ) を最初のフレームから読む
+
+def _parse_rate(value):
+    """ '24000/1001' のような分数表記を float に変換する """
+    try:
+        num, _, den = str(value).partition('/')
+        return float(num) / float(den) if den else float(num)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+def probe_hdr_metadata(video_path, ffmpeg_path):
+    """
+    最初のフレームのサイドデータから HDR10 のマスタリング情報と最大輝度 (MaxCLL/MaxFALL) を読む。
+    コンテナに書かれたものも SEI のものもフレームに付くので、showinfo で両方を拾える。
+    """
+    _, lines = run_command([ffmpeg_path, '-hide_banner', '-nostats', '-i', video_path, '-map', '0:v:0', '-frames:v', '1',
+                            '-vf', 'showinfo', '-an', '-sn', '-f', 'null', '-'], capture=True)
+    metadata = {}
+    for line in lines:
+        if "Mastering display metadata" in line:
+            point = r'\(([\d.]+)[, ]+([\d.]+)\)'
+            primaries = {name: re.search(key + point, line) for name, key in
+                         (("red", "r"), ("green", "g"), ("blue", "b"), ("white_point", "wp"))}
+            luminance = re.search(r'min_luminance=([\d.]+), max_luminance=([\d.]+)', line)
+            if all(primaries.values()) and luminance:
+                metadata["mastering_display"] = {name: [float(m.group(1)), float(m.group(2))] for name, m in primaries.items()}
+                metadata["mastering_display"].update(min_luminance=float(luminance.group(1)),
+                                                     max_luminance=float(luminance.group(2)))
+        match = re.search(r'Content light level metadata: MaxCLL=(\d+), MaxFALL=(\d+)', line)
+        if match:
+            metadata["content_light"] = {"max_cll": int(match.group(1)), "max_fall": int(match.group(2))}
+    return metadata
+
+def probe_media(video_path, ffmpeg_path, ffprobe_path=None):
+    """
+    ソースのコンテナ長とストリーム一覧を取得する。
+    ffprobe があれば JSON 出力を使い、無ければ `ffmpeg -i` の出力を解析する。
+    PQ (HDR10) の映像には最初のフレームのマスタリング情報も加える。
+    """
+    probe = _probe_streams(video_path, ffmpeg_path, ffprobe_path)
+    video = next((st for st in probe["streams"] if st["type"] == "video"), None)
+    if video and video["color_transfer"] == HDR10_TRANSFER:
+        video.update(probe_hdr_metadata(video_path, ffmpeg_path))
+    return probe
+
+def _probe_streams(video_path, ffmpeg_path, ffprobe_path=None):
+    if ffprobe_path:
+        command = [ffprobe_path, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path]
+        with trace_span(os.path.basename(ffprobe_path), "subprocess", cmd=' '.join(command)):
+            output = subprocess.check_output(command, universal_newlines=True, encoding='utf-8', errors='replace', creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
+        data = json.loads(output)
+        streams = []
+        for st in data.get("streams", []):
+            tags = st.get("tags", {})
+            streams.append({
+                "index": st.get("index"),
+                "type": st.get("codec_type"),
+                "codec": st.get("codec_name", ""),
+                "profile": st.get("profile", ""),
+                "level": int(st.get("level", 0) or 0),
+                "language": tags.get("language", "und"),
+                "channels": st.get("channels", 0),
+                "sample_rate": int(st.get("sample_rate", 0) or 0),
+                "bit_rate": int(st.get("bit_rate", 0) or 0),
+                "width": st.get("width", 0),
+                "height": st.get("height", 0),
+                "fps": _parse_rate(st.get("avg_frame_rate") or st.get("r_frame_rate") or 0),
+                "pix_fmt": st.get("pix_fmt", ""),
+                "field_order": st.get("field_order", ""),
+                "color_primaries": st.get("color_primaries", ""),
+                "color_transfer": st.get("color_transfer", ""),
+                "color_space": st.get("color_space", ""),
+            })
+        return {"version": PROBE_VERSION, "duration": float(data.get("format", {}).get("duration", 0) or 0), "streams": streams}
+
+    # ffprobe が同梱されていない環境向けのフォールバック
+    _, lines = run_command([ffmpeg_path, '-hide_banner', '-i', video_path], capture=True)
+    duration = 0.0
+    streams = []
+    for line in lines:
+        match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', line)
+        if match:
+            h, m, sec = match.groups()
+            duration = int(h) * 3600 + int(m) * 60 + float(sec)
+            continue
+        match = re.search(r'Stream #\d+:(\d+)(?:\[\w+\])?(?:\((\w+)\))?: (Video|Audio|Subtitle|Data|Attachment): (\w+)(.*)', line)
+        if not match:
+            continue
+        index, language, kind, codec, rest = match.groups()
+        stream = {"index": int(index), "type": kind.lower(), "codec": codec, "profile": "", "level": 0,
+                  "language": language or "und", "channels": 0, "sample_rate": 0, "bit_rate": 0,
+                  "width": 0, "height": 0, "fps": 0.0, "pix_fmt": "", "field_order": "",
+                  "color_primaries": "", "color_transfer": "", "color_space": ""}
+        if kind == "Audio":
+            rate = re.search(r'(\d+) Hz', rest)
+            if rate: stream["sample_rate"] = int(rate.group(1))
+            layout = re.search(r'Hz, ([^,]+)', rest)
+            if layout:
+                layout_name = layout.group(1)
+                channel_map = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "5.0": 5, "5.1": 6, "6.1": 7, "7.1": 8}
+                stream["channels"] = channel_map.get(layout_name.split('(')[0].strip(), 2)
+        elif kind == "Video":
+            size = re.search(r', (\d{2,5})x(\d{2,5})', rest)
+            if size: stream["width"], stream["height"] = int(size.group(1)), int(size.group(2))
+            fps = re.search(r'([\d.]+) fps', rest)
+            if fps: stream["fps"] = float(fps.group(1))
+            pix_fmt = re.search(r'\), (\w+)\(|, (yuv\w+|nv12|p010\w*)', rest)
+            if pix_fmt: stream["pix_fmt"] = pix_fmt.group(1) or pix_fmt.group(2)
+            # 'yuv420p10le(tv, bt2020nc/bt2020/smpte2084, progressive)' (3つが同じなら1つだけ表示される)
+            color = re.search(r'\((?:tv|pc), ([\w-]+)(?:/([\w-]+)/([\w-]+))?', rest)
+            if color and color.group(1) not in ("progressive", "top", "bottom"):
+                space = color.group(1)
+                stream["color_space"], stream["color_primaries"], stream["color_transfer"] = \
+                    space, color.group(2) or space, color.group(3) or space
+            if "progressive" in rest: stream["field_order"] = "progressive"
+            elif "top first" in rest or "top coded first" in rest: stream["field_order"] = "tt"
+            elif "bottom first" in rest or "bottom coded first" in rest: stream["field_order"] = "bb"
+        bit_rate = re.search(r'(\d+) kb/s', rest)
+        if bit_rate: stream["bit_rate"] = int(bit_rate.group(1)) * 1000
+        streams.append(stream)
+    if not streams:
+        raise RuntimeError(f"ソースのストリーム情報を取得できませんでした: {video_path}")
+    return {"version": PROBE_VERSION, "duration": duration, "streams": streams}
+
+class SourceProbeIndex:
+    """
+    ソースごとのプローブ結果をディスク上のJSONにキャッシュする索引。
+    エントリはパス・サイズ・更新時刻で識別し、ファイルが変わったら破棄する。
+    """
+    def __init__(self, index_path=None):
+        self.index_path = index_path or os.path.join(get_cache_dir(), "probe_index.json")
+        self._lock = threading.RLock()
+        self._entries = {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _fingerprint(path):
+        st = os.stat(path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    def get(self, path):
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry.get("fingerprint") != self._fingerprint(path):
+                return None
+            return dict(entry)
+
+    def update(self, path, **fields):
+        key = os.path.abspath(path)
+        fingerprint = self._fingerprint(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry.get("fingerprint") != fingerprint:
+                entry = {"fingerprint": fingerprint}
+            entry.update(fields)
+            self._entries[key] = entry
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, indent=1, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+            return dict(entry)
+
+    def update_section(self, path, section, key, value):
+        """ エントリ内の辞書 (section) の1項目だけを更新する (並行する他の項目の更新を消さないため) """
+        with self._lock:
+            entry = self.get(path) or {}
+            merged = dict(entry.get(section, {}))
+            merged[key] = value
+            return self.update(path, **{section: merged})
+
+# --- ソースの事前解析 (インターレース / テレシネ / 黒帯) ---
+ANALYSIS_VERSION = 1 # 判定ロジックを変えたら上げる (索引のキャッシュを無効化する)
+ANALYSIS_WINDOWS = 8 # ファイル全体に分散させるサンプル区間の数
+ANALYSIS_WINDOW_SEC = 4.0
+
+def analyze_sample_window(ffmpeg_path, video_path, start_sec, duration_sec, cpu=None):
+    """ 1区間だけをデコードし、idet と cropdetect の結果を返す """
+    command = [ffmpeg_path, '-hide_banner', '-nostats'] + (['-threads', '1'] if cpu else [])
+    command += ['-ss', f'{start_sec:.3f}', '-t', f'{duration_sec:.3f}',
+                '-i', video_path, '-map', '0:v:0', '-vf', 'idet,cropdetect=limit=24:round=2:reset=0',
+                '-an', '-sn', '-f', 'null', '-']
+    returncode, lines = run_command(command, capture=True, cpu=cpu)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+    result = {"tff": 0, "bff": 0, "progressive": 0, "repeated": 0, "not_repeated": 0, "bounds": None}
+    for line in lines:
+        match = re.search(r'Multi frame detection: TFF:\s*(\d+) BFF:\s*(\d+) Progressive:\s*(\d+)', line)
+        if match:
+            result["tff"], result["bff"], result["progressive"] = (int(v) for v in match.groups())
+        match = re.search(r'Repeated Fields: Neither:\s*(\d+) Top:\s*(\d+) Bottom:\s*(\d+)', line)
+        if match:
+            neither, top, bottom = (int(v) for v in match.groups())
+            result["not_repeated"], result["repeated"] = neither, top + bottom
+        match = re.search(r'x1:(-?\d+) x2:(-?\d+) y1:(-?\d+) y2:(-?\d+)', line)
+        if match:
+            result["bounds"] = [int(v) for v in match.groups()] # 区間の最後の値 (reset=0 なので累積) を使う
+    return result
+
+def analyze_source(ffmpeg_path, video_path, probe, log=None, cpu=None):
+    """
+    ファイル全体に分散した短い区間だけをサンプリングして並列に解析し、
+    デインターレース / 逆テレシネ / クロップのフィルタを決める。
+    cpu (CpuLease) を渡すと、そのスレッド数だけの区間を1スレッドずつ並列に解析する。
+    """
+    video = next((st for st in probe.get("streams", []) if st.get("type") == "video"), {})
+    duration = probe.get("duration") or 0.0
+    width, height = video.get("width") or 0, video.get("height") or 0
+    window = min(ANALYSIS_WINDOW_SEC, max(duration, 0.1))
+    count = ANALYSIS_WINDOWS if duration > window * ANALYSIS_WINDOWS else 1
+    # 先頭/末尾 5% (ロゴやクレジット) を避けて均等に配置する
+    usable = max(duration * 0.9 - window, 0.0)
+    starts = [duration * 0.05 + usable * (i + 0.5) / count for i in range(count)] if count > 1 else [0.0]
+    if log: log(f"ソースを事前解析しています ({count}区間 x {window:.0f}秒)...")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(count, cpu.threads if cpu else os.cpu_count() or 1))) as pool:
+        analyze_window = get_stage_metrics().bind(lambda start: analyze_sample_window(ffmpeg_path, video_path, start, window, cpu))
+        samples = list(pool.map(analyze_window, starts))
+
+    tff = sum(s["tff"] for s in samples)
+    bff = sum(s["bff"] for s in samples)
+    progressive = sum(s["progressive"] for s in samples)
+    repeated = sum(s["repeated"] for s in samples)
+    total = max(tff + bff + progressive, 1)
+    interlaced_ratio = (tff + bff) / total
+    repeated_ratio = repeated / max(repeated + sum(s["not_repeated"] for s in samples), 1)
+
+    deinterlace = ""
+    field_order = "tff" if tff >= bff else "bff"
+    fps = video.get("fps") or 0.0
+    # コンテナがプログレッシブと申告している場合は、誤検出を避けるため閾値を上げる
+    interlaced_threshold = 0.9 if video.get("field_order") == "progressive" else 0.65
+    if abs(fps - 29.97) < 0.05 and (0.25 <= repeated_ratio <= 0.55 or 0.15 <= interlaced_ratio <= 0.65):
+        # 3:2 プルダウン: 5フレーム中2フレームでフィールドが繰り返される → フィールドマッチ + 間引きで 23.976p に戻す
+        deinterlace = f"fieldmatch=order={field_order},decimate"
+        scan = "telecine"
+    elif interlaced_ratio > interlaced_threshold:
+        deinterlace = f"bwdif=mode=send_frame:parity={field_order}"
+        scan = "interlaced"
+    else:
+        scan = "progressive"
+
+    # 黒帯: 全区間の有効領域を合成する (どこかの区間で映っている部分は切らない)
+    crop = ""
+    bounds = [s["bounds"] for s in samples if s["bounds"]]
+    if bounds and width and height:
+        x1 = max(0, min(b[0] for b in bounds)); x2 = min(width - 1, max(b[1] for b in bounds))
+        y1 = max(0, min(b[2] for b in bounds)); y2 = min(height - 1, max(b[3] for b in bounds))
+        crop_w = (x2 - x1 + 1) // 2 * 2
+        crop_h = (y2 - y1 + 1) // 2 * 2
+        # 数ピクセルの誤差は無視する
+        if crop_w > width * 0.25 and crop_h > height * 0.25 and (width - crop_w > 8 or height - crop_h > 8):
+            crop = f"crop={crop_w}:{crop_h}:{x1 // 2 * 2}:{y1 // 2 * 2}"
+
+    return {"version": ANALYSIS_VERSION, "scan": scan, "interlaced_ratio": round(interlaced_ratio, 3),
+            "repeated_ratio": round(repeated_ratio, 3), "deinterlace": deinterlace, "crop": crop,
+            "windows": len(samples)}
+
+def load_source_probe(video_path, ffmpeg_path, ffprobe_path=None, log=None):
+    """ プローブ索引にあればそれを、無ければプローブして索引に保存した結果を返す """
+    index = get_source_probe_index()
+    entry = index.get(video_path)
+    hit = bool(entry and entry.get("probe", {}).get("version") == PROBE_VERSION)
+    note_cache("probe", hit)
+    if hit:
+        if log: log("ソース情報をプローブ索引から読み込みました。")
+        return entry["probe"]
+    if log: log("ソース情報を取得しています...")
+    probe = probe_media(video_path, ffmpeg_path, ffprobe_path)
+    index.update(video_path, probe=probe)
+    return probe
+
+def load_source_analysis(video_path, ffmpeg_path, probe, log=None, cpu=None):
+    """ 事前解析の結果を索引から読み込む (無ければ解析して保存する) """
+    index = get_source_probe_index()
+    analysis = (index.get(video_path) or {}).get("analysis")
+    note_cache("analysis", analysis and analysis.get("version") == ANALYSIS_VERSION)
+    if analysis and analysis.get("version") == ANALYSIS_VERSION:
+        if log: log("事前解析の結果を索引から再利用します。")
+        return analysis
+    analysis = analyze_source(ffmpeg_path, video_path.replace('\\', '/'), probe, log=log, cpu=cpu)
+    index.update(video_path, analysis=analysis)
+    return analysis
+
+# --- 映像エンコードの引数 ---
+HW_H264_ENCODERS = ['h264_nvenc', 'h264_amf', 'h264_qsv']
+DEFAULT_RATE_CONTROL = {"mode": "crf", "crf": 20}
+
+def build_scale_filter(resolution_fps):
+    """ BD の解像度合わせ (scale/pad) のフィルタと出力fpsの引数を返す: (フィルタ, ['-r', fps]) """
+    scale_filter = ""
+    fps_option = []
+    if resolution_fps:
+        res, fps = resolution_fps.split(':')
+
+        # padフィルターの解像度指定を 'x' から ':' に変更
+        pad_res = res.replace('x', ':') # '1920x1080' を '1920:1080' に変換
+        scale_filter = f"scale={res}:force_original_aspect_ratio=decrease,pad={pad_res}:(ow-iw)/2:(oh-ih)/2"
+
+        fps_option = ['-r', fps] if fps else []
+    return scale_filter, fps_option
+
+def build_video_filter_args(resolution_fps, prefilters=None):
+    """ 事前解析のフィルタ + 解像度合わせ (scale/pad) と出力fpsの引数を返す """
+    scale_filter, fps_option = build_scale_filter(resolution_fps)
+
+    args = []
+    video_filters = [f for f in (prefilters or []) if f] + ([scale_filter] if scale_filter else [])
+    if video_filters: args.extend(['-vf', ','.join(video_filters)])
+    args.extend(fps_option)
+    return args
+
+def uses_vbv(rate_control, resolution_fps):
+    """ VBV (-maxrate/-bufsize) でビットレートの上限を守るエンコードか (上限付きVBR、UHD は常に) """
+    return is_uhd_output(resolution_fps) or (rate_control or DEFAULT_RATE_CONTROL)["mode"] == "vbr"
+
+def build_video_codec_args(encoder, rate_control=None, preset='medium', threads=None, resolution_fps=None, source_video=None):
+    """
+    エンコーダとレート制御 (CRF/CQ 固定 または 上限付きVBR) の引数を返す。
+    UHD の出力設定では encoder によらず HEVC 10bit (build_uhd_codec_args) にする。
+    """
+    if is_uhd_output(resolution_fps):
+        return build_uhd_codec_args(rate_control, preset, threads, resolution_fps, source_video)
+    rate_control = rate_control or DEFAULT_RATE_CONTROL
+    args = ['-c:v', encoder, '-preset', preset or 'medium']
+    if threads:
+        args.extend(['-threads', str(threads)])
+    if rate_control["mode"] == "vbr":
+        bitrate = int(rate_control["bitrate"])
+        args.extend(['-b:v', str(bitrate), '-maxrate', str(min(BD_MAX_VIDEO_BITRATE, int(bitrate * 1.5))),
+                     '-bufsize', str(BD_MAX_VIDEO_BITRATE)])
+    else:
+        # エンコーダによって品質オプション (-crf または -cq) を切り替える
+        quality = format(rate_control["crf"], 'g')
+        args.extend(['-cq', quality] if encoder in HW_H264_ENCODERS else ['-crf', quality])
+    args.extend(['-pix_fmt', 'yuv420p'])
+    return args
+
+# --- UHD (2160p HEVC 10bit / HDR10) ---
+# 縦 2160 の出力設定は Ultra HD Blu-ray として HEVC Main10 でエンコードする。
+# PQ (HDR10) のソースはマスタリング情報を引き継ぎ、SDR のソースは BT.2020 の SDR に変換する。
+# 本編は常に1本の x265 でエンコードする。チャンクに分けて並行にすると継ぎ目で VBV のバッファ状態が引き継がれず、
+# ffmpeg の libx265 には総フレーム数が渡らないので vbv-end を終わり際だけに効かせること (vbv-end-fr-adj) もできない
+UHD_MIN_HEIGHT = 2160
+UHD_VIDEO_ENCODER = "libx265"
+UHD_MAX_VIDEO_BITRATE = 100_000_000 # UHD BD の映像の上限
+UHD_X265_PARAMS = ["level-idc=5.1", "high-tier=1", "open-gop=0", "min-keyint=1", "aud=1", "hrd=1", "repeat-headers=1",
+                   "colorprim=bt2020", "colormatrix=bt2020nc", "range=limited"]
+UHD_PASSTHROUGH_TRANSFERS = {HDR10_TRANSFER, "arib-std-b67", "bt2020-10"} # 変換せずにそのまま入れる伝達特性
+UHD_SDR_TRANSFER = "bt2020-10"
+SDR_SOURCE_PRIMARIES = {"bt709", "bt470bg", "smpte170m"} # colorspace フィルタの入力として指定できるもの
+GRAPHICS_PLANE_SIZE = (1920, 1080) # UHD でも PG/IG のグラフィックスは 1080p (プレーヤーが拡大する)
+
+def is_uhd_output(resolution_fps):
+    return bool(resolution_fps) and parse_resolution_fps(resolution_fps)[1] >= UHD_MIN_HEIGHT
+
+def video_encoder_for(encoder, resolution_fps):
+    """ 出力設定で実際に使う映像エンコーダ (UHD は libx265 に固定) """
+    return UHD_VIDEO_ENCODER if is_uhd_output(resolution_fps) else encoder
+
+def max_video_bitrate(resolution_fps):
+    return UHD_MAX_VIDEO_BITRATE if is_uhd_output(resolution_fps) else BD_MAX_VIDEO_BITRATE
+
+def video_elementary_format(resolution_fps):
+    """ 映像だけを書き出すときの ffmpeg の出力形式 """
+    return "hevc" if is_uhd_output(resolution_fps) else "h264"
+
+def tsmuxer_video_codec(resolution_fps):
+    return "V_MPEGH/ISO/HEVC" if is_uhd_output(resolution_fps) else "V_MPEG4/ISO/AVC"
+
+def tsmuxer_blu_ray_options(resolution_fps, options):
+    """ tsMuxeR の --blu-ray / --blu-ray-iso に、UHD なら UHD BD (v3) の指定を加える """
+    return options + " --blu-ray-v3" if is_uhd_output(resolution_fps) else options
+
+def graphics_plane_size(resolution_fps):
+    """ 字幕 (PG) とメニュー (IG) を描く大きさ """
+    width, height, _ = parse_resolution_fps(resolution_fps)
+    return (min(width, GRAPHICS_PLANE_SIZE[0]), min(height, GRAPHICS_PLANE_SIZE[1])) if is_uhd_output(resolution_fps) \
+        else (width, height)
+
+def source_video_stream(probe):
+    return next((st for st in (probe or {}).get("streams", []) if st.get("type") == "video"), None)
+
+def bt2020_sdr_filter(source_primaries="bt709"):
+    """ SDR の映像を BT.2020 (SDR, 10bit) に変換する colorspace フィルタ """
+    return f"colorspace=all=bt2020:iall={source_primaries}:format=yuv420p10"
+
+def uhd_color_filter(source_video, resolution_fps):
+    """ UHD 出力で SDR のソースを BT.2020 に変換するフィルタ (HDR や BT.2020 のソース、UHD 以外では '') """
+    if not source_video or not is_uhd_output(resolution_fps):
+        return ""
+    if source_video.get("color_transfer") in UHD_PASSTHROUGH_TRANSFERS or source_video.get("color_primaries") == "bt2020":
+        return ""
+    primaries = source_video.get("color_primaries")
+    if primaries not in SDR_SOURCE_PRIMARIES:
+        # 未指定なら解像度から推定する (HD は BT.709、SD は BT.601)
+        primaries = "bt709" if (source_video.get("height") or 0) >= 720 else "smpte170m"
+    return bt2020_sdr_filter(primaries)
+
+def x265_master_display(mastering):
+    """ プローブのマスタリング情報を x265 の master-display 形式 (色度 0.00002 単位、輝度 0.0001 cd/m2 単位) にする """
+    point = lambda name: f"({round(mastering[name][0] * 50000)},{round(mastering[name][1] * 50000)})"
+    return (f"G{point('green')}B{point('blue')}R{point('red')}WP{point('white_point')}"
+            f"L({round(mastering['max_luminance'] * 10000)},{round(mastering['min_luminance'] * 10000)})")
+
+def build_uhd_codec_args(rate_control=None, preset='medium', threads=None, resolution_fps=None, source_video=None):
+    """
+    UHD BD 向けの x265 (Main10, レベル 5.1 High tier, 1秒以内の closed GOP, VBV で映像の上限を守る) の引数を返す。
+    source_video が PQ ならマスタリング情報と MaxCLL/MaxFALL をそのまま書く。
+    """
+    rate_control = rate_control or DEFAULT_RATE_CONTROL
+    fps = _parse_rate(parse_resolution_fps(resolution_fps)[2])
+    params = UHD_X265_PARAMS + [f"keyint={max(1, int(fps))}"]
+    if threads:
+        params.append(f"pools={threads}")
+    source_video = source_video or {}
+    transfer = source_video.get("color_transfer")
+    params.append(f"transfer={transfer if transfer in UHD_PASSTHROUGH_TRANSFERS else UHD_SDR_TRANSFER}")
+    if transfer == HDR10_TRANSFER:
+        params += ["hdr10=1", "hdr10-opt=1"]
+        if source_video.get("mastering_display"):
+            params.append(f"master-display={x265_master_display(source_video['mastering_display'])}")
+        if source_video.get("content_light"):
+            light = source_video["content_light"]
+            params.append(f"max-cll={light['max_cll']},{light['max_fall']}")
+    if preset not in ENCODER_PRESETS[UHD_VIDEO_ENCODER]:
+        preset = 'medium' # 別のエンコーダ用のプリセット名 (nvenc の p4 など) は使えない
+    args = ['-c:v', UHD_VIDEO_ENCODER, '-preset', preset, '-profile:v', 'main10']
+    if rate_control["mode"] == "vbr":
+        bitrate = int(rate_control["bitrate"])
+        args.extend(['-b:v', str(bitrate), '-maxrate', str(min(UHD_MAX_VIDEO_BITRATE, int(bitrate * 1.5)))])
+    else:
+        # CRF でも VBV で上限を守る
+        args.extend(['-crf', format(rate_control["crf"], 'g'), '-maxrate', str(UHD_MAX_VIDEO_BITRATE)])
+    args.extend(['-bufsize', str(UHD_MAX_VIDEO_BITRATE), '-pix_fmt', 'yuv420p10le', '-x265-params', ':'.join(params)])
+    return args
+
+# --- 1回のデコードからの追加出力 ---
+# 本編のエンコードと同じ ffmpeg で、事前解析のフィルタを通した映像を split で分けて追加の出力を作る
+# (高ビットレートのマスターを出力ごとにデコードし直さない)
+SECONDARY_OUTPUTS = OrderedDict([
+    ("proxy", ("プレビュー用プロキシ (540p)", "preview_proxy.mp4")),
+    ("thumbnails", ("チャプターサムネイル", "chapter_thumbnails.jpg")),
+    ("web_mp4", ("Web 用 MP4", "feature_web.mp4")),
+    ("scene_feed", ("シーンチェンジ解析", "scene_changes.json")),
+])
+PROXY_HEIGHT = 540
+WEB_MAX_HEIGHT = 1080
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_COLUMNS = 5
+SCENE_CHANGE_THRESHOLD = 0.3
+SCENE_ANALYSIS_HEIGHT = 360 # シーンチェンジの判定は縮小した映像で十分
+
+def _filter_path(path):
+    """ フィルタのオプションに書くファイルパス (区切り文字の ':' と '\\' をエスケープする) """
+    return "'" + path.replace('\\', '/').replace(':', '\\:') + "'"
+
+def _chapter_select_expr(chapters):
+    # 各チャプター位置を最初に越えたフレームを選ぶ (先頭のチャプターは最初のフレーム)
+    terms = ["isnan(prev_t)"]
+    for chapter in chapters:
+        h, m, sec = (int(v) for v in chapter.split(':'))
+        position = h * 3600 + m * 60 + sec
+        if position > 0:
+            terms.append(f"gte(t,{position})*lt(prev_t,{position})")
+    return "+".join(terms), len(terms)
+
+def build_multi_output_args(resolution_fps, prefilters, codec_args, output_path, secondary, output_dir,
+                            chapters=(), threads=None):
+    """
+    本編 (BD) と追加出力 (secondary: SECONDARY_OUTPUTS の名前) を1回のデコードから作る ffmpeg の引数 (入力より後) を返す。
+    戻り値: (引数, {名前: 出力パス})。scene_feed は ffmpeg が書くテキストのパスで、JSON への変換は呼び出し側で行う。
+    """
+    secondary = [name for name in SECONDARY_OUTPUTS if name in secondary]
+    scale_filter, fps_option = build_scale_filter(resolution_fps)
+    shared = ",".join([f for f in (prefilters or []) if f] or ["null"])
+    labels = ["bd"] + secondary
+    graph = [f"[0:v]{shared},split={len(labels)}" + "".join(f"[{label}_in]" for label in labels)]
+    graph.append(f"[bd_in]{scale_filter or 'null'}[bd]")
+    outputs = {name: os.path.join(output_dir, SECONDARY_OUTPUTS[name][1]).replace('\\', '/') for name in secondary}
+    thread_args = ['-threads', str(threads)] if threads else []
+    args = []
+    tail = []
+    for name in secondary:
+        if name == "proxy":
+            graph.append(f"[proxy_in]scale=-2:{PROXY_HEIGHT},format=yuv420p[proxy]")
+            # シークしやすいよう GOP を短くする
+            tail += ['-map', '[proxy]', '-map', '0:a:0?', '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-g', '12',
+                     *thread_args, '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', '-y', outputs[name]]
+        elif name == "web_mp4":
+            graph.append(f"[web_mp4_in]scale=-2:'min({WEB_MAX_HEIGHT},ih)',format=yuv420p[web_mp4]")
+            tail += ['-map', '[web_mp4]', '-map', '0:a:0?', '-c:v', 'libx264', '-preset', 'medium', '-crf', '22',
+                     *thread_args, '-c:a', 'aac', '-b:a', '192k', '-movflags', '+faststart', '-y', outputs[name]]
+        elif name == "thumbnails":
+            expr, count = _chapter_select_expr(chapters)
+            columns = min(count, THUMBNAIL_COLUMNS)
+            rows = math.ceil(count / columns)
+            graph.append(f"[thumbnails_in]select='{expr}',scale={THUMBNAIL_WIDTH}:-2,tile={columns}x{rows}[thumbnails]")
+            tail += ['-map', '[thumbnails]', '-frames:v', '1', '-update', '1', '-q:v', '3', '-y', outputs[name]]
+        elif name == "scene_feed":
+            outputs[name] = os.path.splitext(outputs[name])[0] + ".txt"
+            graph.append(f"[scene_feed_in]scale=-2:{SCENE_ANALYSIS_HEIGHT},select='gt(scene,{SCENE_CHANGE_THRESHOLD})',"
+                         f"metadata=mode=print:file={_filter_path(outputs[name])}[scene_feed]")
+            tail += ['-map', '[scene_feed]', '-f', 'null', '-']
+    args += ['-filter_complex', ";".join(graph), '-map', '[bd]', *fps_option, *codec_args, '-an', '-y', output_path]
+    return args + tail, outputs
+
+def parse_scene_changes(text_path, json_path):
+    """ metadata=mode=print の出力からシーンチェンジの時刻とスコアを取り出し、JSON に書く """
+    changes = []
+    with open(text_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = re.search(r'pts_time:([\d.]+)', line)
+            if match:
+                changes.append({"time": round(float(match.group(1)), 3), "score": None})
+            match = re.search(r'lavfi\.scene_score=([\d.]+)', line)
+            if match and changes:
+                changes[-1]["score"] = round(float(match.group(1)), 4)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({"threshold": SCENE_CHANGE_THRESHOLD, "changes": changes}, f, indent=1)
+    os.remove(text_path)
+    return changes
+
+# --- 分散エンコード (コーディネータ / エージェント) ---
+# 本編映像を出力フレーム単位のセグメントに分け、HTTP で接続してくるエージェントに配る。
+# エージェントはソースを Range 要求で必要な範囲だけ読み、同じ引数でエンコードした結果を送り返す。
+# 各セグメントは IDR から始まるので、concat で再エンコードせずにつなげられる。
+DISTRIBUTED_SEGMENT_SEC = 60.0
+DISTRIBUTED_LEASE_TIMEOUT_SEC = 30.0 # この時間ハートビートが無ければ割り当てを取り消す
+DISTRIBUTED_HEARTBEAT_SEC = 5.0
+DISTRIBUTED_POLL_SEC = 2.0
+DISTRIBUTED_MAX_ATTEMPTS = 3 # 失敗 (報告・タイムアウト) がこの回数に達したセグメントはジョブごと失敗にする
+DISTRIBUTED_STALL_TIMEOUT_SEC = 600.0 # 割り当て・ハートビート・完了がどれもこの時間無ければジョブを失敗にする (エージェントが居ない)
+DISTRIBUTED_STRAGGLER_RATIO = 2.0 # 完了済みセグメントの所要時間 (中央値) のこの倍を超えたら他のエージェントにも割り当てる
+DISTRIBUTED_TOKEN_HEADER = "X-BDCopy-Token"
+DISTRIBUTED_CHUNK = 1024 * 1024
+
+def plan_encode_segments(duration_sec, fps, segment_sec=DISTRIBUTED_SEGMENT_SEC):
+    """ [(開始秒, フレーム数), ...] を返す。境界は出力フレームに揃え、最後のセグメントは末尾まで (None) """
+    fps = Fraction(fps).limit_denominator(1001)
+    frames_per_segment = max(1, round(segment_sec * fps))
+    total_frames = max(1, math.ceil(duration_sec * fps))
+    segments = []
+    for start_frame in range(0, total_frames, frames_per_segment):
+        last = start_frame + frames_per_segment >= total_frames
+        segments.append((float(start_frame / fps), None if last else frames_per_segment))
+    return segments
+
+def concat_video_segments(ffmpeg_path, paths, work_dir, output_path, log=None):
+    """ セグメント (各々 IDR から始まる) を再エンコードせずに output_path へ結合する。returncode を返す """
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in paths:
+            f.write("file '" + path.replace("'", "'\\''") + "'\n")
+    returncode, _ = run_command([ffmpeg_path, '-hide_banner', '-f', 'concat', '-safe', '0', '-i', list_path,
+                                 '-map', '0:v:0', '-c', 'copy', '-y', output_path], log=log)
+    return returncode
+
+class _DistributedEncode:
+    """ コーディネータ上の1回分の分散エンコード (セグメントの状態と割り当てを持つ) """
+    def __init__(self, job_id, source_path, encode_args, segments, work_dir):
+        self.job_id = job_id
+        self.source_path = source_path
+        self.source_size = os.path.getsize(source_path)
+        self.encode_args = list(encode_args)
+        self.work_dir = work_dir
+        self.error = None
+        self.progress_at = time.monotonic() # 最後に割り当て・ハートビート・完了があった時刻
+        self.segments = [{"index": i, "start": start, "frames": frames, "leases": {}, "failures": 0,
+                          "failed_agents": set(), "path": None, "elapsed": None, "agent": None}
+                         for i, (start, frames) in enumerate(segments)]
+
+    def done(self):
+        return all(segment["path"] for segment in self.segments)
+
+class EncodeCoordinator:
+    """
+    セグメントをエージェントに割り当て、結果を集める。エージェントからの要求は HTTP (TCP) で受ける。
+      POST /lease      割り当てを受け取る (無ければ 204)
+      GET  /source/ID  ソースを返す (Range 対応)
+      POST /heartbeat  エンコード中の通知 (取り消し済みなら 410)
+      PUT  /segment/ID/LEASE  エンコード結果のアップロード
+      POST /fail       失敗の報告
+    """
+    def __init__(self, port, host="127.0.0.1", token=None, segment_sec=DISTRIBUTED_SEGMENT_SEC,
+                 lease_timeout_sec=DISTRIBUTED_LEASE_TIMEOUT_SEC):
+        self.token = token or secrets.token_urlsafe(16)
+        self.segment_sec = segment_sec
+        self.lease_timeout_sec = lease_timeout_sec
+        self.jobs = OrderedDict() # ジョブID -> _DistributedEncode
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), _CoordinatorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="encode-coordinator", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def encode(self, source_path, encode_args, output_path, ffmpeg_path, duration_sec, fps, log=None):
+        """ セグメントを配り、すべて揃ったら output_path に結合する (完了まで戻らない)。returncode を返す """
+        log = log or (lambda message: None)
+        job_id = secrets.token_hex(8)
+        work_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(output_path) or None)
+        job = _DistributedEncode(job_id, source_path, encode_args, plan_encode_segments(duration_sec, fps, self.segment_sec),
+                                 work_dir)
+        log(f"分散エンコード: {len(job.segments)}セグメント ({self.segment_sec:g}秒単位) をエージェントに配布します "
+            f"(コーディネータ {self.address[0]}:{self.address[1]})")
+        with self.condition:
+            self.jobs[job_id] = job
+            reported = 0
+            while not job.done() and not job.error:
+                self.condition.wait(1.0)
+                self._expire_leases(job, log)
+                if time.monotonic() - job.progress_at > DISTRIBUTED_STALL_TIMEOUT_SEC:
+                    job.error = (f"{format_duration(DISTRIBUTED_STALL_TIMEOUT_SEC)}の間どのエージェントからも進捗がありません "
+                                 f"(エージェントが接続していないか、すべて停止しています)")
+                    break
+                finished = [segment for segment in job.segments if segment["path"]]
+                if len(finished) != reported:
+                    reported = len(finished)
+                    log(f"分散エンコード: {reported}/{len(job.segments)} セグメント完了")
+            del self.jobs[job_id]
+        try:
+            if job.error:
+                raise RuntimeError(f"分散エンコードに失敗しました: {job.error}")
+            return concat_video_segments(ffmpeg_path, [segment["path"] for segment in job.segments], work_dir,
+                                         output_path, log)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _record(self, result):
+        get_metrics_registry().inc("bdcopy_distributed_segments_total", "分散エンコードのセグメント割り当ての結果",
+                                   result=result)
+
+    def _release(self, job, segment, lease_id, reason, log=None):
+        """ 割り当てを取り消す。失敗扱いなら回数を数え、上限に達したらジョブを失敗にする """
+        lease = segment["leases"].pop(lease_id, None)
+        if lease is None:
+            return
+        segment["failures"] += 1
+        segment["failed_agents"].add(lease["agent"]) # 同じエージェントには再び割り当てない
+        self._record(reason)
+        if segment["failures"] >= DISTRIBUTED_MAX_ATTEMPTS and not segment["leases"]:
+            job.error = f"セグメント {segment['index']} が {segment['failures']} 回失敗しました (最後: {lease['agent']})"
+        elif log:
+            log(f"分散エンコード: セグメント {segment['index']} を再割り当てします ({lease['agent']}: {reason})")
+        self.condition.notify_all()
+
+    def _expire_leases(self, job, log=None):
+        now = time.monotonic()
+        for segment in job.segments:
+            for lease_id, lease in list(segment["leases"].items()):
+                if now - lease["heartbeat"] > self.lease_timeout_sec:
+                    self._release(job, segment, lease_id, "timeout", log)
+
+    def lease(self, agent):
+        """ 未割り当てのセグメント、無ければ遅れているセグメントの予備を割り当てる """
+        with self.condition:
+            now = time.monotonic()
+            for job in self.jobs.values():
+                self._expire_leases(job)
+                if job.error:
+                    continue
+                candidates = [s for s in job.segments if not s["path"] and not s["leases"] and agent not in s["failed_agents"]]
+                if not candidates:
+                    # 予備の割り当て: 先に返ってきた方を採用し、もう一方は取り消す
+                    elapsed = sorted(s["elapsed"] for s in job.segments if s["elapsed"] is not None)
+                    if elapsed:
+                        limit = max(DISTRIBUTED_STRAGGLER_RATIO * elapsed[len(elapsed) // 2], 2 * DISTRIBUTED_HEARTBEAT_SEC)
+                        candidates = [s for s in job.segments if not s["path"] and len(s["leases"]) == 1
+                                      and agent not in s["failed_agents"]
+                                      and all(l["agent"] != agent for l in s["leases"].values())
+                                      and now - min(l["started"] for l in s["leases"].values()) > limit]
+                        if candidates:
+                            self._record("speculative")
+                if candidates:
+                    segment = candidates[0]
+                    lease_id = secrets.token_hex(8)
+                    segment["leases"][lease_id] = {"agent": agent, "started": now, "heartbeat": now}
+                    job.progress_at = now
+                    return {"job": job.job_id, "segment": segment["index"], "lease": lease_id,
+                            "start": segment["start"], "frames": segment["frames"], "args": job.encode_args,
+                            "source": f"/source/{job.job_id}", "source_name": os.path.basename(job.source_path)}
+            return None
+
+    def _find_lease(self, job_id, lease_id):
+        job = self.jobs.get(job_id)
+        if job and not job.error:
+            for segment in job.segments:
+                if lease_id in segment["leases"]:
+                    return job, segment
+        return None, None
+
+    def heartbeat(self, job_id, lease_id):
+        with self.condition:
+            job, segment = self._find_lease(job_id, lease_id)
+            if segment is None:
+                return False
+            segment["leases"][lease_id]["heartbeat"] = job.progress_at = time.monotonic()
+            return True
+
+    def fail(self, job_id, lease_id, message):
+        with self.condition:
+            job, segment = self._find_lease(job_id, lease_id)
+            if segment is not None:
+                self._release(job, segment, lease_id, "failed")
+                if job.error:
+                    job.error += f": {message}"
+
+    def source_path(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return job and (job.source_path, job.source_size)
+
+    def segment_upload_path(self, job_id, lease_id):
+        with self.condition:
+            job, segment = self._find_lease(job_id, lease_id)
+            if segment is None:
+                return None
+            return os.path.join(job.work_dir, f"segment_{segment['index']:05d}.{lease_id}.part")
+
+    def complete(self, job_id, lease_id, part_path):
+        """ アップロードされたセグメントを採用する。既に他のエージェントの結果があれば False """
+        with self.condition:
+            job, segment = self._find_lease(job_id, lease_id)
+            if segment is None or segment["path"]:
+                return False
+            lease = segment["leases"].pop(lease_id)
+            segment_path = os.path.join(job.work_dir, f"segment_{segment['index']:05d}.mkv")
+            os.replace(part_path, segment_path)
+            job.progress_at = time.monotonic()
+            segment.update(path=segment_path, elapsed=job.progress_at - lease["started"], agent=lease["agent"])
+            segment["leases"].clear() # 予備の割り当ては次のハートビートで取り消される
+            self._record("completed")
+            self.condition.notify_all()
+            return True
+
+class _CoordinatorRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _authorized(self):
+        token = self.headers.get(DISTRIBUTED_TOKEN_HEADER, "")
+        if hmac.compare_digest(token.encode(), self.server.coordinator.token.encode()):
+            return True
+        self.send_error(403)
+        return False
+
+    def _send_json(self, status, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        coordinator = self.server.coordinator
+        request = self._read_json()
+        if self.path == "/lease":
+            task = coordinator.lease(request.get("agent", self.client_address[0]))
+            if task:
+                self._send_json(200, task)
+            else:
+                self._send_json(204)
+        elif self.path == "/heartbeat":
+            self._send_json(200 if coordinator.heartbeat(request.get("job"), request.get("lease")) else 410, {})
+        elif self.path == "/fail":
+            coordinator.fail(request.get("job"), request.get("lease"), request.get("message", ""))
+            self._send_json(200, {})
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        parts = self.path.strip('/').split('/')
+        source = self.server.coordinator.source_path(parts[1]) if len(parts) == 2 and parts[0] == "source" else None
+        if not source:
+            self.send_error(404)
+            return
+        path, size = source
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2))) # 末尾から N バイト
+            if start >= size or end < start: # bytes=500-100 のような逆順の指定も満たせない範囲とする
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(DISTRIBUTED_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # ffmpeg はシークのたびに接続を切り替える
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        coordinator = self.server.coordinator
+        parts = self.path.strip('/').split('/')
+        part_path = coordinator.segment_upload_path(parts[1], parts[2]) if len(parts) == 3 and parts[0] == "segment" else None
+        if not part_path:
+            self.send_error(410) # 取り消し済み または 他のエージェントの結果を採用済み
+            return
+        remaining = int(self.headers.get("Content-Length", 0))
+        with open(part_path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(DISTRIBUTED_CHUNK, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining or not coordinator.complete(parts[1], parts[2], part_path):
+            os.remove(part_path)
+            self.send_error(400 if remaining else 409)
+            return
+        self._send_json(200, {})
+
+def _agent_request(url, token, data=None, method="POST"):
+    """ コーディネータに JSON を送り、応答の JSON (204 なら None) を返す。410 などは HTTPError になる """
+    body = json.dumps(data).encode('utf-8') if data is not None else None
+    request = urllib.request.Request(url, data=body, method=method,
+                                     headers={DISTRIBUTED_TOKEN_HEADER: token, "Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        payload = response.read()
+        return json.loads(payload) if response.status != 204 and payload else None
+
+class _SourceRelayHandler(BaseHTTPRequestHandler):
+    """ エージェントの ffmpeg からの要求に、トークンを付けてコーディネータのソースを中継する """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        relay = self.server.relay
+        if self.path != relay["path"]:
+            self.send_error(404)
+            return
+        headers = {DISTRIBUTED_TOKEN_HEADER: relay["token"]}
+        if self.headers.get("Range"):
+            headers["Range"] = self.headers["Range"]
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(relay["url"], headers=headers), timeout=60)
+        except urllib.error.HTTPError as e:
+            self.send_error(e.code)
+            return
+        except OSError:
+            self.send_error(502)
+            return
+        with response:
+            self.send_response(response.status)
+            for header in ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges"):
+                if response.headers.get(header):
+                    self.send_header(header, response.headers[header])
+            self.end_headers()
+            try:
+                while True:
+                    chunk = response.read(DISTRIBUTED_CHUNK)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass # ffmpeg がシークのために接続を切った
+
+@contextmanager
+def _source_relay(url, token):
+    """
+    トークンをコマンドライン (ps や /proc から読める) に出さずに ffmpeg にソースを読ませるための、
+    ループバックの中継を立てて URL を返す。URL のパスはこのセグメント限りの乱数。
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SourceRelayHandler)
+    server.daemon_threads = True
+    path = "/" + secrets.token_urlsafe(16)
+    server.relay = {"url": url, "token": token, "path": path}
+    threading.Thread(target=server.serve_forever, name="source-relay", daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}{path}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def run_agent_task(coordinator_url, token, ffmpeg_path, task, work_dir, name, log=print):
+    """ 割り当てられた1セグメントをエンコードしてアップロードする。採用されたら True """
+    with _source_relay(coordinator_url + task["source"], token) as source_url:
+        return _encode_agent_segment(coordinator_url, token, ffmpeg_path, task, work_dir, name, source_url, log)
+
+def _encode_agent_segment(coordinator_url, token, ffmpeg_path, task, work_dir, name, source_url, log):
+    segment_path = os.path.join(work_dir, f"segment_{task['job']}_{task['segment']:05d}.mkv")
+    command = [ffmpeg_path, '-hide_banner', '-nostdin',
+               '-ss', f"{task['start']:.6f}", '-i', source_url, '-map', '0:v:0']
+    command.extend(task["args"])
+    if task["frames"]:
+        command.extend(['-frames:v', str(task["frames"])])
+    command.extend(['-an', '-f', 'matroska', '-y', segment_path])
+    log(f"[{name}] セグメント {task['segment']} ({task['source_name']} {task['start']:.2f}秒～) をエンコードします")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                               encoding='utf-8', errors='replace',
+                               creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
+    cancelled = threading.Event()
+    def send_heartbeats():
+        while process.poll() is None:
+            try:
+                _agent_request(coordinator_url + "/heartbeat", token, {"job": task["job"], "lease": task["lease"]})
+            except urllib.error.HTTPError as e:
+                if e.code == 410: # 他のエージェントが先に終えた・割り当てが取り消された
+                    cancelled.set()
+                    process.terminate()
+                    return
+            except OSError:
+                pass
+            for _ in range(int(DISTRIBUTED_HEARTBEAT_SEC * 10)):
+                if process.poll() is not None:
+                    return
+                time.sleep(0.1)
+    heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeat_thread.start()
+    tail = deque(process.stderr, maxlen=5)
+    process.wait()
+    heartbeat_thread.join()
+    try:
+        if cancelled.is_set():
+            log(f"[{name}] セグメント {task['segment']} は取り消されました")
+            return False
+        if process.returncode != 0:
+            message = f"ffmpeg が終了コード {process.returncode} で終了しました: {' / '.join(line.strip() for line in tail)}"
+            log(f"[{name}] セグメント {task['segment']}: {message}")
+            _agent_request(coordinator_url + "/fail", token, {"job": task["job"], "lease": task["lease"], "message": message})
+            return False
+        with open(segment_path, 'rb') as f:
+            request = urllib.request.Request(f"{coordinator_url}/segment/{task['job']}/{task['lease']}", data=f, method="PUT",
+                                             headers={DISTRIBUTED_TOKEN_HEADER: token,
+                                                      "Content-Length": str(os.path.getsize(segment_path))})
+            try:
+                urllib.request.urlopen(request, timeout=600).close()
+            except urllib.error.HTTPError as e:
+                log(f"[{name}] セグメント {task['segment']} は採用されませんでした (HTTP {e.code})")
+                return False
+        log(f"[{name}] セグメント {task['segment']} を送信しました")
+        return True
+    finally:
+        if os.path.exists(segment_path):
+            os.remove(segment_path)
+
+def run_encode_agent(coordinator_url, token, ffmpeg_path, name=None, work_dir=None, log=print, stop=None):
+    """ コーディネータから割り当てを受け取り続けるエージェント (stop がセットされるまで) """
+    coordinator_url = coordinator_url.rstrip('/')
+    name = name or f"{platform.node()}-{os.getpid()}"
+    stop = stop or threading.Event()
+    with tempfile.TemporaryDirectory(prefix="bdcopy_agent_", dir=work_dir) as agent_dir:
+        log(f"[{name}] エージェントを開始します: {coordinator_url}")
+        while not stop.is_set():
+            try:
+                task = _agent_request(coordinator_url + "/lease", token, {"agent": name})
+            except urllib.error.HTTPError as e:
+                if e.code == 403:
+                    raise RuntimeError("コーディネータに拒否されました (トークンを確認してください)")
+                task = None
+            except OSError as e:
+                log(f"[{name}] コーディネータに接続できません: {e}")
+                task = None
+            if task is None:
+                stop.wait(DISTRIBUTED_POLL_SEC)
+                continue
+            try:
+                run_agent_task(coordinator_url, token, ffmpeg_path, task, agent_dir, name, log)
+            except OSError as e:
+                log(f"[{name}] セグメント {task['segment']} の処理中にエラー: {e}")
+
+# --- ディスク容量に合わせたビットレート計画 ---
+MEDIA_CAPACITY_BYTES = {"BD-25": 25_025_314_816, "BD-50": 50_050_629_632, "BD-100": 100_103_356_416}
+BD_MAX_VIDEO_BITRATE = 40_000_000
+MUX_OVERHEAD = 1.06 # m2ts (192バイトパケット) + PES/PCR のおおよそのオーバーヘッド
+FILESYSTEM_OVERHEAD_BYTES = 64 * 1024 * 1024 # UDF + BDMV 管理ファイル
+PLAN_SAFETY_RATIO = 0.03 # 予測誤差に備えて残しておく容量の割合
+MENU_BITRATE_ESTIMATE = 5_000_000
+SUBTITLE_BITRATE_ESTIMATE = 100_000
+PLAN_SAMPLE_WINDOWS = 6
+PLAN_SAMPLE_SEC = 8.0
+PLAN_SAMPLE_QUALITIES = (16, 20, 24, 28)
+PLAN_QUALITY_RANGE = (14.0, 28.0) # この範囲で収まらなければ上限付きVBRにする
+
+def format_size(num_bytes):
+    return f"{num_bytes / 1_000_000_000:.2f} GB"
+
+def estimate_audio_bitrate(track, normalize_loudness=False):
+    """ AudioEncoderWorker が出力する音声のビットレートを見積もる """
+    if not normalize_loudness and track.get("codec") in PASSTHROUGH_AUDIO_CODECS and track.get("sample_rate") in (0, 48000):
+        return track.get("bit_rate") or (1_509_000 if track.get("codec") == "dts" else 640_000)
+    return 640_000 if (track.get("channels") or 2) > 2 else 448_000
+
+def measure_rate_curve(ffmpeg_path, video_path, probe, encoder, resolution_fps, prefilters, log=None, preset='medium'):
+    """
+    ファイル全体から短い区間を抜き出し、複数の品質値で並列にサンプルエンコードして
+    ビットレート(bps) = exp(a + b * 品質値) の曲線を当てはめる。
+    """
+    duration = probe.get("duration") or 0.0
+    window = min(PLAN_SAMPLE_SEC, max(duration, 0.1))
+    count = PLAN_SAMPLE_WINDOWS if duration > window * PLAN_SAMPLE_WINDOWS * 2 else 1
+    usable = max(duration * 0.9 - window, 0.0)
+    starts = [duration * 0.05 + usable * (i + 0.5) / count for i in range(count)] if count > 1 else [0.0]
+    tasks = [(start, quality) for quality in PLAN_SAMPLE_QUALITIES for start in starts]
+    if log: log(f"サンプルエンコードで容量を見積もっています ({count}区間 x 品質{len(PLAN_SAMPLE_QUALITIES)}段階)...")
+
+    with tempfile.TemporaryDirectory(prefix="bdcopy_plan_") as tmp_dir:
+        def encode_sample(task):
+            start, quality = task
+            out_format = video_elementary_format(resolution_fps)
+            out_path = os.path.join(tmp_dir, f"sample_{start:.0f}_{quality}.{out_format}")
+            command = [ffmpeg_path, '-hide_banner', '-nostats', '-ss', f'{start:.3f}', '-t', f'{window:.3f}',
+                       '-i', video_path, '-map', '0:v:0']
+            command.extend(build_video_filter_args(resolution_fps, prefilters))
+            command.extend(build_video_codec_args(encoder, {"mode": "crf", "crf": quality}, preset,
+                                                  resolution_fps=resolution_fps, source_video=source_video_stream(probe)))
+            command.extend(['-an', '-f', out_format, '-y', out_path])
+            returncode, _ = run_command(command)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ' '.join(command))
+            return quality, os.path.getsize(out_path) * 8, min(window, max(duration - start, 0.1))
+
+        workers = max(1, min(len(tasks), (os.cpu_count() or 2) // 2))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            samples = list(pool.map(get_stage_metrics().bind(encode_sample), tasks))
+
+    points = []
+    for quality in PLAN_SAMPLE_QUALITIES:
+        bits = sum(b for q, b, _ in samples if q == quality)
+        seconds = sum(sec for q, _, sec in samples if q == quality)
+        points.append((quality, bits / seconds))
+    # 対数ビットレートに対する最小二乗直線
+    xs = [q for q, _ in points]
+    ys = [math.log(max(bps, 1.0)) for _, bps in points]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum((x - mean_x) ** 2 for x in xs)
+    a = mean_y - b * mean_x
+    return {"a": a, "b": b, "points": points}
+
+def load_rate_curve(video_path, ffmpeg_path, probe, encoder, resolution_fps, prefilters, preset='medium', log=None):
+    """ 同じ条件のサンプル結果は索引から再利用し、無ければサンプルエンコードして保存する """
+    index = get_source_probe_index()
+    curve_key = f"{encoder}|{preset}|{resolution_fps}|{','.join(prefilters)}"
+    curve = (index.get(video_path) or {}).get("rate_curve", {}).get(curve_key)
+    note_cache("rate_curve", curve)
+    if curve:
+        if log: log("サンプルエンコードの結果を索引から再利用します。")
+        return curve
+    curve = measure_rate_curve(ffmpeg_path, video_path.replace('\\', '/'), probe, encoder, resolution_fps, prefilters,
+                               log=log, preset=preset)
+    index.update_section(video_path, "rate_curve", curve_key, curve)
+    return curve
+
+def plan_bitrate(probe, curve, media, menu_duration_sec=10.0, subtitle_count=0, normalize_loudness=False,
+                 max_bitrate=BD_MAX_VIDEO_BITRATE):
+    """ メディア容量に収まるレート制御 (CRF または 上限付きVBR) と予測ISOサイズを求める """
+    capacity = MEDIA_CAPACITY_BYTES[media]
+    duration = max(probe.get("duration") or 0.0, 1.0)
+    audio_bps = sum(estimate_audio_bitrate(st, normalize_loudness) for st in probe.get("streams", []) if st.get("type") == "audio")
+    fixed_bytes = (audio_bps * duration + SUBTITLE_BITRATE_ESTIMATE * subtitle_count * duration
+                   + MENU_BITRATE_ESTIMATE * menu_duration_sec) / 8 * MUX_OVERHEAD + FILESYSTEM_OVERHEAD_BYTES
+    usable_bytes = capacity * (1 - PLAN_SAFETY_RATIO)
+    target_bps = min((usable_bytes - fixed_bytes) * 8 / MUX_OVERHEAD / duration, max_bitrate)
+
+    plan = {"media": media, "capacity_bytes": capacity, "duration": duration}
+    quality = None
+    if target_bps > 0 and curve["b"] < 0:
+        # 目標ビットレート以下になる最小の品質値 (0.5刻み)
+        quality = math.ceil((math.log(target_bps) - curve["a"]) / curve["b"] * 2) / 2
+    if quality is not None and PLAN_QUALITY_RANGE[0] <= quality <= PLAN_QUALITY_RANGE[1]:
+        plan.update({"mode": "crf", "crf": quality})
+        video_bps = math.exp(curve["a"] + curve["b"] * quality)
+    elif quality is not None and quality < PLAN_QUALITY_RANGE[0]:
+        # 容量に十分余裕がある場合は品質の上限で打ち止め
+        plan.update({"mode": "crf", "crf": PLAN_QUALITY_RANGE[0]})
+        video_bps = math.exp(curve["a"] + curve["b"] * PLAN_QUALITY_RANGE[0])
+    else:
+        video_bps = max(target_bps, 500_000)
+        plan.update({"mode": "vbr", "bitrate": int(video_bps)})
+    predicted = video_bps * duration / 8 * MUX_OVERHEAD + fixed_bytes
+    plan.update({"video_bitrate": int(video_bps), "predicted_iso_bytes": int(predicted),
+                 "margin_bytes": int(capacity - predicted), "margin_ratio": (capacity - predicted) / capacity})
+    return plan
+
+def describe_plan(plan):
+    rate = f"CRF {plan['crf']:g}" if plan["mode"] == "crf" else f"VBR {plan['bitrate'] / 1_000_000:.1f} Mbps"
+    fits = "収まります" if plan["margin_bytes"] >= 0 else "収まりません"
+    return (f"{plan['media']}: {rate} (映像 約{plan['video_bitrate'] / 1_000_000:.1f} Mbps) / 予測ISO {format_size(plan['predicted_iso_bytes'])}"
+            f" / 余裕 {format_size(plan['margin_bytes'])} ({plan['margin_ratio']:.1%}) → {fits}")
+
+def predict_title_bytes(probe, curve, normalize_loudness=False, rate_control=None, source_size=0,
+                        max_bitrate=BD_MAX_VIDEO_BITRATE):
+    """
+    タイトル1本 (本編映像 + 音声) がディスク上で占めるバイト数を予測する。
+    curve が None ならストリームコピーになるソースとして、映像は source_size (ソースの映像ストリームの大きさ) で見積もる。
+    """
+    duration = max(probe.get("duration") or 0.0, 1.0)
+    audio_bps = sum(estimate_audio_bitrate(st, normalize_loudness) for st in probe.get("streams", []) if st.get("type") == "audio")
+    if curve is None:
+        video_bytes = source_size
+    else:
+        rate_control = rate_control or DEFAULT_RATE_CONTROL
+        video_bytes = min(math.exp(curve["a"] + curve["b"] * rate_control["crf"]), max_bitrate) * duration / 8
+    return int((video_bytes + audio_bps * duration / 8) * MUX_OVERHEAD)
+
+def source_video_bytes(probe, path):
+    """ ソースの映像ストリームの大きさ。映像のビットレートが分からなければ、コンテナから音声の分を引く """
+    duration = probe.get("duration") or 0.0
+    video = source_video_stream(probe) or {}
+    if video.get("bit_rate"):
+        return int(video["bit_rate"] * duration / 8)
+    audio_bps = sum(st.get("bit_rate") or estimate_audio_bitrate(st) for st in probe.get("streams", []) if st.get("type") == "audio")
+    return max(0, int(os.path.getsize(path) - audio_bps * duration / 8))
+
+def split_titles_in_order(sizes, count, capacity):
+    """ 話数順のまま count 枚以内に区切る。最も大きいディスクが最小になる区切りを返す (収まらなければ None) """
+    def split(limit):
+        discs, fill = [[]], 0
+        for i, size in enumerate(sizes):
+            if discs[-1] and fill + size > limit:
+                discs.append([])
+                fill = 0
+            discs[-1].append(i)
+            fill += size
+        return discs
+    low, high = max(sizes), capacity
+    if low > high or len(split(high)) > count:
+        return None
+    while low < high:
+        middle = (low + high) // 2
+        if len(split(middle)) <= count:
+            high = middle
+        else:
+            low = middle + 1
+    return split(low)
+
+def disc_title_capacity(media, menu_duration_sec=10.0):
+    """ 1枚のディスクでタイトルに使える容量 (安全マージン・ファイルシステム・メニューを除く) """
+    menu_bytes = MENU_BITRATE_ESTIMATE * menu_duration_sec / 8 * MUX_OVERHEAD
+    return int(MEDIA_CAPACITY_BYTES[media] * (1 - PLAN_SAFETY_RATIO) - FILESYSTEM_OVERHEAD_BYTES - menu_bytes)
+
+def pack_titles_into_discs(sizes, capacity):
+    """
+    タイトル (sizes の添字) を最少枚数のディスクに振り分け、使用量がなるべく均等になるようにする。
+    大きい順に最も空いているディスクへ入れ、入らなければ最も詰まるディスクへ入れ直して、
+    それでも入らない場合だけ枚数を増やす。最後に使用量の最大と最小のディスク間で移動・交換して差を縮める。
+    同じ枚数で話数順のまま区切れる場合は、そちらを使う (最も大きいディスクが最小になる区切り)。
+    各ディスクのタイトルは元の順 (話数順) に並べて返す。
+    """
+    too_large = [i for i, size in enumerate(sizes) if size > capacity]
+    if too_large:
+        raise ValueError(f"1枚に収まらないタイトルがあります: {', '.join(str(i + 1) for i in too_large)}")
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i])
+
+    def assign(count, choose):
+        discs, fill = [[] for _ in range(count)], [0] * count
+        for i in order:
+            candidates = [d for d in range(count) if fill[d] + sizes[i] <= capacity]
+            if not candidates:
+                return None
+            d = choose(candidates, fill, sizes[i])
+            discs[d].append(i)
+            fill[d] += sizes[i]
+        return discs
+
+    count = max(1, math.ceil(sum(sizes) / capacity))
+    while True:
+        discs = (assign(count, lambda candidates, fill, size: min(candidates, key=lambda d: fill[d])) or
+                 assign(count, lambda candidates, fill, size: max(candidates, key=lambda d: fill[d])))
+        if discs:
+            break
+        count += 1
+    in_order = split_titles_in_order(sizes, count, capacity)
+    if in_order:
+        return in_order
+
+    while len(discs) > 1:
+        fill = [sum(sizes[i] for i in disc) for disc in discs]
+        hi, lo = max(range(len(discs)), key=lambda d: fill[d]), min(range(len(discs)), key=lambda d: fill[d])
+        gap = fill[hi] - fill[lo]
+        best = None # (移動後の差, 高い側から出すタイトル, 低い側から出すタイトル)
+        for a in discs[hi]:
+            for b in [None] + discs[lo]:
+                delta = sizes[a] - (sizes[b] if b is not None else 0)
+                if 0 < delta and fill[lo] + delta <= capacity and abs(gap - 2 * delta) < (best[0] if best else gap):
+                    best = (abs(gap - 2 * delta), a, b)
+        if not best:
+            break
+        _, a, b = best
+        discs[hi].remove(a)
+        discs[lo].append(a)
+        if b is not None:
+            discs[lo].remove(b)
+            discs[hi].append(b)
+    return sorted((sorted(disc) for disc in discs if disc), key=lambda disc: disc[0])
+
+# --- エンコーダプリセットの自動調整 (マシンごとのベンチマーク) ---
+ENCODER_PRESETS = {
+    "libx264": ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"],
+    "libx265": ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow"],
+    "h264_nvenc": ["p1", "p2", "p3", "p4", "p5", "p6", "p7"],
+    "h264_qsv": ["veryfast", "faster", "fast", "medium", "slow", "veryslow"],
+    "h264_amf": ["speed", "balanced", "quality"],
+}
+DEFAULT_QUALITY_FLOOR = 0.97 # SSIM (All) の下限
+# 標準クリップ (テスト素材不要: lavfi で生成する)。特徴の異なる絵柄を揃える
+BENCHMARK_CLIPS = {
+    "pattern": "testsrc2=size={size}:rate={rate}",
+    "fractal": "mandelbrot=size={size}:rate={rate}",
+    "grain": "testsrc2=size={size}:rate={rate},noise=alls=18:allf=t+u",
+}
+BENCHMARK_CLIP_SEC = 4.0
+
+def get_machine_id():
+    """ ベンチマーク結果を区別するマシン識別子 """
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', f"{platform.node()}-{platform.machine()}-{os.cpu_count()}cpu")
+
+def get_encoder_profile_path():
+    return os.path.join(get_cache_dir(), f"encoder_profile_{get_machine_id()}.json")
+
+def load_encoder_profile():
+    try:
+        with open(get_encoder_profile_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _parse_quality_metrics(lines):
+    ssim = psnr = None
+    for line in lines:
+        match = re.search(r'SSIM .*All:([\d.]+)', line)
+        if match: ssim = float(match.group(1))
+        match = re.search(r'PSNR .*average:([\d.]+|inf)', line)
+        if match: psnr = float(match.group(1)) if match.group(1) != 'inf' else 100.0
+    return ssim, psnr
+
+def benchmark_encoder_presets(ffmpeg_path, encoder, resolution_fps=None, log=None):
+    """
+    標準クリップを各プリセット・スレッド数でエンコードし、fps と SSIM/PSNR を測定する。
+    画質はプリセットの差が出るよう、解像度に応じた固定ビットレートで比較する。
+    """
+    width, height, fps = parse_resolution_fps(resolution_fps)
+    size = f"{width}x{height}"
+    bitrate = int(8_000_000 * (width * height) / (1920 * 1080))
+    cpu_count = os.cpu_count() or 1
+    thread_counts = sorted({0, max(1, cpu_count // 2), cpu_count}) # 0 はエンコーダの自動設定
+    frames = int(round(_parse_rate(fps) * BENCHMARK_CLIP_SEC))
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bdcopy_bench_") as tmp_dir:
+        for preset in ENCODER_PRESETS.get(encoder, ["medium"]):
+            for threads in thread_counts:
+                clip_scores = []
+                elapsed = 0.0
+                for clip_name, source in BENCHMARK_CLIPS.items():
+                    lavfi = source.format(size=size, rate=fps)
+                    out_path = os.path.join(tmp_dir, f"{clip_name}.mkv")
+                    command = [ffmpeg_path, '-hide_banner', '-nostats', '-f', 'lavfi', '-i', lavfi, '-frames:v', str(frames)]
+                    command.extend(build_video_codec_args(encoder, {"mode": "vbr", "bitrate": bitrate}, preset, threads,
+                                                          resolution_fps=resolution_fps))
+                    command.extend(['-y', out_path])
+                    started = time.perf_counter()
+                    returncode, _ = run_command(command)
+                    elapsed += time.perf_counter() - started
+                    if returncode != 0:
+                        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+                    # 元の lavfi と比較して画質を測る
+                    metric_command = [ffmpeg_path, '-hide_banner', '-nostats', '-i', out_path,
+                                      '-f', 'lavfi', '-i', f"{lavfi},trim=end_frame={frames}",
+                                      '-lavfi', '[0:v]split[a][b];[1:v]split[c][d];[a][c]ssim;[b][d]psnr', '-f', 'null', '-']
+                    returncode, lines = run_command(metric_command, capture=True)
+                    if returncode != 0:
+                        raise subprocess.CalledProcessError(returncode, ' '.join(metric_command))
+                    clip_scores.append(_parse_quality_metrics(lines))
+                entry = {"preset": preset, "threads": threads,
+                         "fps": round(frames * len(BENCHMARK_CLIPS) / elapsed, 2),
+                         "ssim": round(sum(s for s, _ in clip_scores) / len(clip_scores), 5),
+                         "psnr": round(sum(p for _, p in clip_scores) / len(clip_scores), 3)}
+                results.append(entry)
+                if log: log(f"ベンチマーク {encoder} preset={preset} threads={threads or 'auto'}: "
+                            f"{entry['fps']} fps, SSIM {entry['ssim']}, PSNR {entry['psnr']} dB")
+    return results
+
+def save_encoder_profile(encoder, resolution_fps, results):
+    profile = load_encoder_profile() or {"machine": get_machine_id(), "encoders": {}}
+    profile["encoders"][f"{encoder}|{resolution_fps}"] = {"measured_at": time.time(), "results": results}
+    path = get_encoder_profile_path()
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return profile
+
+def select_encoder_preset(encoder, resolution_fps, quality_floor=DEFAULT_QUALITY_FLOOR, profile=None):
+    """
+    プロファイルから品質下限を満たす最速のプリセットを選ぶ。
+    戻り値: (preset, threads, 選択理由の説明)。プロファイルが無ければ medium。
+    """
+    profile = profile or load_encoder_profile()
+    results = ((profile or {}).get("encoders", {}).get(f"{encoder}|{resolution_fps}") or {}).get("results")
+    if not results:
+        return "medium", None, "ベンチマーク結果が無いため medium を使用"
+    passing = [r for r in results if r["ssim"] >= quality_floor]
+    if passing:
+        best = max(passing, key=lambda r: r["fps"])
+        reason = f"SSIM {best['ssim']} ≥ {quality_floor} の中で最速 ({best['fps']} fps)"
+    else:
+        best = max(results, key=lambda r: (r["ssim"], r["fps"]))
+        reason = f"品質下限 {quality_floor} を満たす設定が無いため最高画質 (SSIM {best['ssim']})"
+    return best["preset"], best["threads"] or None, reason
+
+# --- 品質検証 (SSIM/PSNR) ---
+DEFAULT_VERIFY_SSIM_FLOOR = 0.95 # チャプター平均 SSIM (All) の下限
+VERIFY_WORST_WINDOW_MARGIN = 0.05 # 最悪区間は下限からこの分まで許容する
+VERIFY_SEGMENT_SEC = 120.0 # 並列に比較する区間の長さ
+VERIFY_FRAME_TOLERANCE = 2 # 区間の境界 (シーク位置と fps 変換) でずれてよいフレーム数
+VERIFY_WINDOW_SEC = 2.0 # 最悪区間を探す移動窓の長さ
+
+def build_reference_filter(resolution_fps, prefilters=None):
+    """ ソースをエンコード時と同じ見た目 (デインターレース/クロップ/scale/pad/fps) に揃えるフィルタ """
+    filters = [f for f in (prefilters or []) if f]
+    if resolution_fps:
+        res, fps = resolution_fps.split(':')
+        filters.append(f"scale={res}:force_original_aspect_ratio=decrease,pad={res.replace('x', ':')}:(ow-iw)/2:(oh-ih)/2")
+        if fps: filters.append(f"fps={fps}")
+    return ','.join(filters + ["setpts=PTS-STARTPTS", "format=yuv420p"])
+
+def verify_segment(ffmpeg_path, encoded_path, source_path, start_sec, duration_sec, reference_filter, cpu=None,
+                   expected_frames=None):
+    """
+    1区間のフレームごとの SSIM と PSNR を返す: [(フレーム番号(区間内), ssim, psnr), ...]
+    SSIM と PSNR のフレームが揃わない・expected_frames と合わない場合は例外にする。
+    """
+    stats_dir = tempfile.mkdtemp(prefix="verify_")
+    try:
+        # 2つのフィルタが同じ標準出力に書くと行が混ざるので、それぞれのファイルに書かせる
+        ssim_path, psnr_path = os.path.join(stats_dir, "ssim.log"), os.path.join(stats_dir, "psnr.log")
+        graph = (f"[0:v]setpts=PTS-STARTPTS,format=yuv420p,split[e1][e2];[1:v]{reference_filter},split[r1][r2];"
+                 f"[e1][r1]ssim=stats_file={_filter_path(ssim_path)};[e2][r2]psnr=stats_file={_filter_path(psnr_path)}")
+        single = ['-threads', '1'] if cpu else [] # 並列度は区間の数で取る
+        command = [ffmpeg_path, '-hide_banner', '-nostats',
+                   *single, '-ss', f'{start_sec:.3f}', '-t', f'{duration_sec:.3f}', '-i', encoded_path,
+                   *single, '-ss', f'{start_sec:.3f}', '-t', f'{duration_sec:.3f}', '-i', source_path,
+                   '-filter_complex', graph, '-an', '-sn', '-f', 'null', '-']
+        returncode, _ = run_command(command, capture=True, cpu=cpu)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ' '.join(command))
+        ssim, psnr = {}, {}
+        with open(ssim_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = re.match(r'n:(\d+) Y:.* All:([\d.]+)', line)
+                if match:
+                    ssim[int(match.group(1))] = float(match.group(2))
+        with open(psnr_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = re.match(r'n:(\d+) mse_avg:.* psnr_avg:([\d.]+|inf)', line)
+                if match:
+                    psnr[int(match.group(1))] = float(match.group(2)) if match.group(2) != 'inf' else 100.0 # 完全一致
+    finally:
+        shutil.rmtree(stats_dir, ignore_errors=True)
+    where = f"{start_sec:.3f}秒からの区間"
+    if not ssim or sorted(ssim) != list(range(1, len(ssim) + 1)) or sorted(psnr) != sorted(ssim):
+        raise RuntimeError(f"品質検証の結果が揃いません ({where}: SSIM {len(ssim)}フレーム, PSNR {len(psnr)}フレーム)")
+    if expected_frames is not None and abs(len(ssim) - expected_frames) > VERIFY_FRAME_TOLERANCE:
+        raise RuntimeError(f"品質検証で比較できたフレーム数が区間の長さと合いません "
+                           f"({where}: {len(ssim)}フレーム, 想定 {expected_frames}フレーム)")
+    return [(n - 1, ssim[n], psnr[n]) for n in sorted(ssim)]
+
+def verify_encode(ffmpeg_path, encoded_path, source_path, probe, resolution_fps, chapters,
+                  prefilters=None, log=None, cpu=None):
+    """
+    エンコード結果とソースを区間に分けて並列に比較し、全体・チャプターごと・最悪区間のスコアを返す。
+    chapters は本編先頭からの 'HH:MM:SS' のリスト。
+    """
+    video = next((st for st in probe.get("streams", []) if st.get("type") == "video"), {})
+    fps_str = parse_resolution_fps(resolution_fps)[2] if resolution_fps else video.get("fps")
+    fps = _parse_rate(fps_str or "24000/1001")
+    duration = probe.get("duration") or 0.0
+    count = max(1, math.ceil(duration / VERIFY_SEGMENT_SEC))
+    segment = duration / count if duration else VERIFY_SEGMENT_SEC
+    reference_filter = build_reference_filter(resolution_fps, prefilters)
+    if log: log(f"品質検証を開始します ({count}区間を並列に比較)...")
+
+    def run_segment(i):
+        # 最後の区間はコンテナの長さ (音声の方が長いことがある) まで取るので、フレーム数は確かめない
+        expected = round(segment * fps) if i < count - 1 else None
+        return i * segment, verify_segment(ffmpeg_path, encoded_path, source_path, i * segment, segment, reference_filter, cpu,
+                                           expected_frames=expected)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(count, cpu.threads if cpu else os.cpu_count() or 1))) as pool:
+        # 区間の境界で fps 変換により重複したフレームは捨てる
+        segments = pool.map(get_stage_metrics().bind(run_segment), range(count))
+        frames = [(start + n / fps, ssim, psnr)
+                  for start, samples in segments for n, ssim, psnr in samples
+                  if n / fps < segment]
+    if not frames:
+        raise RuntimeError("品質検証で比較できたフレームがありません。")
+
+    def summarize(items):
+        return {"ssim": round(sum(f[1] for f in items) / len(items), 5),
+                "psnr": round(sum(f[2] for f in items) / len(items), 3), "frames": len(items)}
+
+    # チャプターごとの平均
+    bounds = sorted({0.0} | {sum(int(v) * m for v, m in zip(t.split(':'), (3600, 60, 1))) for t in chapters})
+    chapter_scores = []
+    for i, start in enumerate(bounds):
+        end = bounds[i + 1] if i + 1 < len(bounds) else float('inf')
+        items = [f for f in frames if start <= f[0] < end]
+        if items:
+            chapter_scores.append(dict(summarize(items), chapter=i + 1, start=start))
+
+    # 移動窓で最悪区間を探す
+    window = max(1, int(round(VERIFY_WINDOW_SEC * fps)))
+    total = sum(f[1] for f in frames[:window])
+    worst_total, worst_index = total, 0
+    for i in range(window, len(frames)):
+        total += frames[i][1] - frames[i - window][1]
+        if total < worst_total:
+            worst_total, worst_index = total, i - window + 1
+    span = min(window, len(frames))
+    worst = {"start": round(frames[worst_index][0], 3), "ssim": round(worst_total / span, 5)}
+    return dict(summarize(frames), chapters=chapter_scores, worst_window=worst)
+
+def check_verification(result, ssim_floor=DEFAULT_VERIFY_SSIM_FLOOR):
+    """ 下限を下回った項目の説明のリストを返す (空なら合格) """
+    problems = [f"チャプター{c['chapter']} の平均SSIM {c['ssim']} < {ssim_floor}"
+                for c in result["chapters"] if c["ssim"] < ssim_floor]
+    worst = result["worst_window"]
+    if worst["ssim"] < ssim_floor - VERIFY_WORST_WINDOW_MARGIN:
+        problems.append(f"{worst['start']:.1f}秒付近の最悪区間 SSIM {worst['ssim']} < {ssim_floor - VERIFY_WORST_WINDOW_MARGIN:.3f}")
+    return problems
+
+# --- ラウドネス正規化 (EBU R128) ---
+LOUDNORM_TARGET = {"I": -23.0, "TP": -1.0, "LRA": 20.0} # 映画素材向けに LRA は広めに取る
+
+def loudnorm_target_key(audio_index):
+    """ プローブ索引内の測定値のキー (目標値が変われば測定し直す) """
+    return f"a{audio_index}@I{LOUDNORM_TARGET['I']}:TP{LOUDNORM_TARGET['TP']}:LRA{LOUDNORM_TARGET['LRA']}"
+
+def build_loudnorm_filter(measured):
+    """ 1パス目の測定値から、2パス目 (線形正規化) の loudnorm フィルタ文字列を組み立てる """
+    target = f"I={LOUDNORM_TARGET['I']}:TP={LOUDNORM_TARGET['TP']}:LRA={LOUDNORM_TARGET['LRA']}"
+    return (f"loudnorm={target}"
+            f":measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+            f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+            f":offset={measured['target_offset']}:linear=true:print_format=summary")
+
+_source_probe_index = None
+_source_probe_index_lock = threading.Lock()
+
+def get_source_probe_index():
+    global _source_probe_index
+    with _source_probe_index_lock:
+        if _source_probe_index is None:
+            _source_probe_index = SourceProbeIndex()
+        return _source_probe_index
+
+# --- 書き込みドライブの列挙 ---
+DRIVE_REFRESH_SEC = 30 # ドライブ一覧を更新する間隔 (外付けドライブの接続・メディアの入れ替えに追従する)
+
+def get_drive_cache_path():
+    return os.path.join(get_cache_dir(), "drives.json")
+
+def load_drive_cache():
+    """ 前回列挙したドライブ一覧 [(表示名, ドライブID), ...] (無ければ None) """
+    try:
+        with open(get_drive_cache_path(), 'r', encoding='utf-8') as f:
+            return [tuple(drive) for drive in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+def enumerate_optical_drives():
+    """ 光学ドライブの一覧 [(表示名, ドライブID), ...] を返す。wmic / drutil を起動するので GUI スレッドでは呼ばない """
+    drives = []
+    if sys.platform == "win32":
+        # Windows: 'wmic' を使ってドライブレターを取得
+        output = subprocess.check_output(['wmic', 'cdrom', 'get', 'Drive, MediaType'],
+                                         universal_newlines=True,
+                                         creationflags=subprocess.CREATE_NO_WINDOW)
+        for line in output.splitlines():
+            match = re.match(r'^\s*([A-Z]:)\s*(.*)', line)
+            if match:
+                drive = match.group(1)
+                media_type = match.group(2).strip()
+                if not media_type:
+                    media_type = "メディアなし"
+                drives.append((f"{drive} ({media_type})", drive)) # 表示名, 内部ID
+    elif sys.platform == "darwin":
+        # macOS: 'drutil list' を使ってドライブIDを取得
+        output = subprocess.check_output(['drutil', 'list'], universal_newlines=True)
+        # 'drutil list' の出力をパースして、実際のドライブID（disk2など）を取得
+        current_device = None
+        for line in output.splitlines():
+            if "Vendor" in line and "Product" in line:
+                 # 新しいデバイスセクションの開始
+                 match = re.search(r'/dev/(disk\d+)', line)
+                 if match:
+                     current_device = match.group(1)
+            if current_device and "Type" in line and ("CD" in line or "DVD" in line or "BD" in line):
+                 # 光学ドライブである可能性が高い
+                 drives.append((f"{current_device} (光学ドライブ)", current_device))
+                 current_device = None # 重複追加を防ぐ
+    else:
+        raise RuntimeError(f"非対応OSのためドライブを取得できません: {sys.platform}")
+    tmp_path = get_drive_cache_path() + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(drives, f, ensure_ascii=False)
+    os.replace(tmp_path, get_drive_cache_path())
+    return drives
+
+# --- ISO の整合性チェックと書き込み後の読み戻し検証 ---
+ISO_SECTOR_SIZE = 2048
+ISO_HASH_CHUNK = 64 * 1024 * 1024 # mmap で読む単位 (どの OS の割り当て粒度の倍数にもなる)
+ISO_FOLLOW_POLL_SEC = 0.5
+ISO_MANIFEST_VERSION = 1
+BD_ALIGNED_UNIT = 6144 # m2ts は 32 ソースパケット (192バイト) 単位で記録される
+BDMV_REQUIRED_ENTRIES = ("BDMV/index.bdmv", "BDMV/MovieObject.bdmv", "BDMV/PLAYLIST", "BDMV/CLIPINF", "BDMV/STREAM")
+READBACK_OPEN_TIMEOUT_SEC = 120 # 書き込み後にドライブがメディアを認識し直すまで待つ時間
+
+def _hash_range(path, offset, length):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as view:
+        return hashlib.sha256(view).hexdigest()
+
+def hash_iso_chunks(path, writer_done=None, chunk_size=ISO_HASH_CHUNK):
+    """
+    ISO をチャンクごとに SHA-256 する ([16進ダイジェスト, ...] を返す)。
+    writer_done (threading.Event) を渡すと書き込み中のファイルを追いかけ、書き終わったチャンクから順に計算する。
+    """
+    digests = []
+    offset = 0
+    while True:
+        done = writer_done is None or writer_done.is_set() # サイズを見る前に確認する (書き終わりの取りこぼし防止)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        while size - offset >= chunk_size or (done and offset < size):
+            length = min(chunk_size, size - offset)
+            digests.append(_hash_range(path, offset, length))
+            offset += length
+        if done:
+            return digests
+        writer_done.wait(ISO_FOLLOW_POLL_SEC)
+
+def manifest_digest(chunks):
+    """ チャンクのダイジェストを連結したものの SHA-256 (ISO 全体の識別に使う) """
+    return hashlib.sha256("".join(chunks).encode('ascii')).hexdigest()
+
+def get_iso_manifest_path(iso_path):
+    return iso_path + ".sha256.json"
+
+def write_iso_manifest(iso_path, chunks, chunk_size=ISO_HASH_CHUNK, files=None):
+    manifest = {"version": ISO_MANIFEST_VERSION, "size": os.path.getsize(iso_path), "chunk_size": chunk_size,
+                "chunks": chunks, "digest": manifest_digest(chunks), "files": files or {}}
+    with open(get_iso_manifest_path(iso_path), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def load_iso_manifest(iso_path):
+    """ ISO と同じサイズ・版のマニフェストがあれば返す """
+    try:
+        with open(get_iso_manifest_path(iso_path), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != ISO_MANIFEST_VERSION or manifest.get("size") != os.path.getsize(iso_path):
+        return None
+    return manifest
+
+class BlockDevice:
+    """
+    読み出し専用のブロックデバイス。ISO イメージも光学ドライブも同じインターフェースで読む
+    (テストではイメージファイルをドライブの代わりに使える)。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb', buffering=0)
+
+    @staticmethod
+    def drive_path(drive_id):
+        """ ドライブID (E: / disk2 / sr0) を読み出し用のデバイスパスにする """
+        if sys.platform == "win32":
+            return "\\\\.\\" + drive_id.rstrip("\\")
+        if sys.platform == "darwin":
+            return "/dev/r" + drive_id # バッファを通さない raw デバイス
+        return drive_id if drive_id.startswith("/dev/") else "/dev/" + drive_id
+
+    @classmethod
+    def open(cls, target):
+        """ 既存のファイルならそのイメージ、そうでなければドライブIDとして開く """
+        return cls(target if os.path.isfile(target) else cls.drive_path(target))
+
+    def read(self, offset, length):
+        # raw デバイスはセクタ単位でしか読めないので、呼び出し側はセクタ境界で読むこと
+        self._file.seek(offset)
+        chunks = []
+        while length > 0:
+            data = self._file.read(length)
+            if not data:
+                break
+            chunks.append(data)
+            length -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class UdfError(Exception):
+    pass
+
+class UdfImage:
+    """
+    UDF ファイルシステムを読み、ファイルの一覧 (サイズと記録位置) を返す最小限の実装。
+    Blu-ray (UDF 2.50) のメタデータパーティションと、物理パーティションのみの UDF に対応する。
+    """
+    def __init__(self, device):
+        self.device = device
+        self.block_size = ISO_SECTOR_SIZE
+        self.partitions = {} # パーティション番号 -> 開始セクタ
+        self.partition_maps = [] # パーティション参照番号 -> ("physical", 番号) / ("metadata", 番号, 範囲)
+        self.root_icb = None
+
+    def _read_sectors(self, sector, count=1):
+        data = self.device.read(sector * self.block_size, count * self.block_size)
+        if len(data) < count * self.block_size:
+            raise UdfError(f"セクタ {sector} を読めません (イメージが途中で切れています)")
+        return data
+
+    @staticmethod
+    def _tag(data, expected=None):
+        tag_id, = struct.unpack_from('<H', data, 0)
+        if (sum(data[0:4]) + sum(data[5:16])) & 0xFF != data[4]:
+            raise UdfError("記述子のタグのチェックサムが一致しません")
+        if expected is not None and tag_id not in (expected if isinstance(expected, tuple) else (expected,)):
+            raise UdfError(f"記述子の種類が違います (タグ {tag_id}, 期待値 {expected})")
+        return tag_id
+
+    def _physical_sector(self, partition_ref, lbn):
+        kind = self.partition_maps[partition_ref]
+        if kind[0] == "physical":
+            return self.partitions[kind[1]] + lbn
+        # メタデータパーティション: 論理ブロックはメタデータファイルの中の位置
+        byte_offset = lbn * self.block_size
+        for extent_offset, extent_length in kind[2]:
+            if byte_offset < extent_length:
+                return (extent_offset + byte_offset) // self.block_size
+            byte_offset -= extent_length
+        raise UdfError(f"メタデータパーティションの範囲外を参照しています (ブロック {lbn})")
+
+    def parse(self):
+        anchor = self._read_sectors(256)
+        self._tag(anchor, 2)
+        vds_length, vds_location = struct.unpack_from('<II', anchor, 16)
+        logical_volume = None
+        for sector in range(vds_location, vds_location + max(1, vds_length // self.block_size)):
+            data = self._read_sectors(sector)
+            tag_id = self._tag(data)
+            if tag_id == 5: # パーティション記述子
+                number, = struct.unpack_from('<H', data, 22)
+                self.partitions[number], = struct.unpack_from('<I', data, 188)
+            elif tag_id == 6: # 論理ボリューム記述子
+                logical_volume = data
+            elif tag_id == 8: # 終端
+                break
+        if logical_volume is None or not self.partitions:
+            raise UdfError("ボリューム記述子 (論理ボリューム/パーティション) が見つかりません")
+        self.block_size, = struct.unpack_from('<I', logical_volume, 212)
+        map_count, = struct.unpack_from('<I', logical_volume, 268)
+        pos = 440
+        metadata_maps = []
+        for _ in range(map_count):
+            map_type, map_length = logical_volume[pos], logical_volume[pos + 1]
+            if map_type == 1:
+                self.partition_maps.append(("physical", struct.unpack_from('<H', logical_volume, pos + 4)[0]))
+            elif b"Metadata" in logical_volume[pos + 4:pos + 36]:
+                number, metadata_lbn = struct.unpack_from('<HI', logical_volume, pos + 38)
+                metadata_maps.append(len(self.partition_maps))
+                self.partition_maps.append(("metadata", number, metadata_lbn))
+            else: # スペアリングなど (読み出しは物理パーティションと同じ)
+                self.partition_maps.append(("physical", struct.unpack_from('<H', logical_volume, pos + 38)[0]))
+            pos += map_length
+        for index in metadata_maps:
+            _, number, metadata_lbn = self.partition_maps[index]
+            physical_ref = next(i for i, m in enumerate(self.partition_maps) if m == ("physical", number))
+            entry = self.read_file_entry(physical_ref, metadata_lbn)
+            self.partition_maps[index] = ("metadata", number, entry["extents"])
+        fsd_lbn, fsd_ref = struct.unpack_from('<IH', logical_volume, 252)
+        fsd = self._read_sectors(self._physical_sector(fsd_ref, fsd_lbn))
+        self._tag(fsd, 256)
+        self.root_icb = struct.unpack_from('<IH', fsd, 404)
+        return self
+
+    def _read_allocation_descriptors(self, data, ad_type, partition_ref):
+        """ (バイト位置, 長さ) の一覧。長さの上位2ビットが 3 なら続きの記述子を読む """
+        extents = []
+        pos, size = 0, 8 if ad_type == 0 else 16
+        while pos + size <= len(data):
+            raw_length, lbn = struct.unpack_from('<II', data, pos)
+            ref = partition_ref if ad_type == 0 else struct.unpack_from('<H', data, pos + 8)[0]
+            length, extent_type = raw_length & 0x3FFFFFFF, raw_length >> 30
+            pos += size
+            if length == 0:
+                break
+            if extent_type == 3:
+                next_data = self._read_sectors(self._physical_sector(ref, lbn))
+                self._tag(next_data, 258)
+                ad_length, = struct.unpack_from('<I', next_data, 20)
+                extents.extend(self._read_allocation_descriptors(next_data[24:24 + ad_length], ad_type, ref))
+                break
+            if extent_type == 0: # 記録済み (未記録の領域は 0 として扱う)
+                extents.append((self._physical_sector(ref, lbn) * self.block_size, length))
+            else:
+                extents.append((None, length))
+        return extents
+
+    def read_file_entry(self, partition_ref, lbn):
+        data = self._read_sectors(self._physical_sector(partition_ref, lbn))
+        tag_id = self._tag(data, (261, 266)) # ファイルエントリ / 拡張ファイルエントリ
+        file_type = data[27]
+        ad_type = struct.unpack_from('<H', data, 34)[0] & 7
+        info_length, = struct.unpack_from('<Q', data, 56)
+        ea_length, ad_length = struct.unpack_from('<II', data, 168 if tag_id == 261 else 208)
+        ad_start = (176 if tag_id == 261 else 216) + ea_length
+        ad_data = data[ad_start:ad_start + ad_length]
+        entry = {"directory": file_type == 4, "size": info_length}
+        if ad_type == 3: # 記述子の中に埋め込まれたデータ
+            entry.update(extents=[], embedded=ad_data[:info_length])
+        else:
+            entry.update(extents=self._read_allocation_descriptors(ad_data, ad_type, partition_ref), embedded=None)
+        return entry
+
+    def read_data(self, entry):
+        if entry["embedded"] is not None:
+            return entry["embedded"]
+        parts = []
+        for offset, length in entry["extents"]:
+            parts.append(self.device.read(offset, length) if offset is not None else b"\0" * length)
+        return b"".join(parts)[:entry["size"]]
+
+    @staticmethod
+    def _decode_name(raw):
+        if not raw:
+            return ""
+        return raw[1:].decode('utf-16-be' if raw[0] == 16 else 'latin-1', errors='replace')
+
+    def walk(self):
+        """ {"BDMV/STREAM/00000.m2ts": {"directory", "size", "extents"}, ...} を返す """
+        entries = {}
+        pending = [("", self.root_icb)]
+        visited = set()
+        while pending:
+            prefix, (lbn, ref) = pending.pop()
+            if (lbn, ref) in visited:
+                raise UdfError("ディレクトリが循環しています")
+            visited.add((lbn, ref))
+            data = self.read_data(self.read_file_entry(ref, lbn))
+            pos = 0
+            while pos + 38 <= len(data):
+                self._tag(data[pos:pos + 16], 257) # ファイル識別記述子
+                characteristics, name_length = data[pos + 18], data[pos + 19]
+                child_lbn, child_ref = struct.unpack_from('<IH', data, pos + 24)
+                iu_length, = struct.unpack_from('<H', data, pos + 36)
+                name = self._decode_name(data[pos + 38 + iu_length:pos + 38 + iu_length + name_length])
+                pos += (38 + iu_length + name_length + 3) & ~3
+                if characteristics & 0x0C: # 親ディレクトリ・削除済み
+                    continue
+                path = prefix + name
+                entry = self.read_file_entry(child_ref, child_lbn)
+                entries[path] = {"directory": entry["directory"], "size": entry["size"], "extents": entry["extents"]}
+                if entry["directory"]:
+                    pending.append((path + "/", (child_lbn, child_ref)))
+        return entries
+
+def check_bdmv_structure(entries, image_size):
+    """ BDMV の必須エントリ・クリップ情報とストリームの対応・サイズを確認し、問題の一覧を返す """
+    problems = [f"{name} がありません" for name in BDMV_REQUIRED_ENTRIES if name not in entries]
+    playlists = [p for p in entries if p.startswith("BDMV/PLAYLIST/") and p.lower().endswith(".mpls")]
+    if "BDMV/PLAYLIST" in entries and not playlists:
+        problems.append("プレイリスト (.mpls) がありません")
+    streams = {os.path.splitext(os.path.basename(p))[0]: p for p in entries
+               if p.startswith("BDMV/STREAM/") and p.lower().endswith(".m2ts")}
+    clips = {os.path.splitext(os.path.basename(p))[0] for p in entries
+             if p.startswith("BDMV/CLIPINF/") and p.lower().endswith(".clpi")}
+    for clip in sorted(set(streams) - clips):
+        problems.append(f"{streams[clip]} に対応するクリップ情報 (CLIPINF/{clip}.clpi) がありません")
+    for clip in sorted(clips - set(streams)):
+        problems.append(f"CLIPINF/{clip}.clpi に対応するストリーム (STREAM/{clip}.m2ts) がありません")
+    for path, stream in sorted(streams.items()):
+        size = entries[stream]["size"]
+        if size == 0 or size % BD_ALIGNED_UNIT:
+            problems.append(f"{stream} のサイズ {size} バイトが {BD_ALIGNED_UNIT} バイト単位ではありません")
+    for path, entry in sorted(entries.items()):
+        recorded = sum(length for _, length in entry["extents"])
+        if not entry["directory"] and entry["extents"] and recorded < entry["size"]:
+            problems.append(f"{path} の記録領域 ({recorded} バイト) がファイルサイズ ({entry['size']} バイト) より小さい")
+        for offset, length in entry["extents"]:
+            if offset is not None and offset + length > image_size:
+                problems.append(f"{path} がイメージの末尾を越えた位置を参照しています")
+                break
+    return problems
+
+def udf_data_span(entries):
+    """ ファイル本体が記録されている範囲 (先頭, 末尾)。これより前後は UDF のメタデータ領域 """
+    extents = [(offset, offset + length) for entry in entries.values() if not entry["directory"]
+               for offset, length in entry["extents"] if offset is not None and length]
+    if not extents:
+        return None
+    return min(start for start, _ in extents), max(end for _, end in extents)
+
+def check_iso_image(iso_path, chunks, chunk_size=ISO_HASH_CHUNK):
+    """
+    ハッシュ済みの ISO の UDF 構造を確認し、マニフェストを書き出す。
+    mux 中に計算したチャンクのうち、最後に書き直される可能性があるメタデータ領域 (先頭と末尾) は計算し直す。
+    """
+    size = os.path.getsize(iso_path)
+    with BlockDevice(iso_path) as device:
+        entries = UdfImage(device).parse().walk()
+    problems = check_bdmv_structure(entries, size)
+    span = udf_data_span(entries) or (size, size)
+    chunks = list(chunks)
+    for index in sorted({*range(0, span[0] // chunk_size + 1), *range(span[1] // chunk_size, len(chunks))}):
+        if index < len(chunks):
+            chunks[index] = _hash_range(iso_path, index * chunk_size, min(chunk_size, size - index * chunk_size))
+    files = {path: entry["size"] for path, entry in entries.items() if not entry["directory"]}
+    manifest = write_iso_manifest(iso_path, chunks, chunk_size, files)
+    return manifest, problems
+
+def _merge_sector_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def verify_readback(device, iso_path, manifest, log=None):
+    """
+    ディスク (device) を読み戻し、チャンクごとのハッシュをマニフェストと比べる。
+    一致しないチャンクはセクタ単位で ISO と比べて範囲を絞り込み、不一致のセクタ範囲 [(先頭, 末尾), ...] を返す。
+    """
+    chunk_size, size = manifest["chunk_size"], manifest["size"]
+    mismatches = []
+    reported = -1
+    for index, expected in enumerate(manifest["chunks"]):
+        offset = index * chunk_size
+        length = min(chunk_size, size - offset)
+        data = device.read(offset, length)
+        if hashlib.sha256(data).hexdigest() != expected:
+            with open(iso_path, 'rb') as f:
+                f.seek(offset)
+                reference = f.read(length)
+            for pos in range(0, length, ISO_SECTOR_SIZE):
+                if data[pos:pos + ISO_SECTOR_SIZE] != reference[pos:pos + ISO_SECTOR_SIZE]:
+                    sector = (offset + pos) // ISO_SECTOR_SIZE
+                    mismatches.append((sector, sector))
+        progress = (offset + length) * 10 // size
+        if log and progress != reported:
+            reported = progress
+            log(f"読み戻し検証: {progress * 10}% ({format_size(offset + length)} / {format_size(size)})")
+    return _merge_sector_ranges(mismatches)
+
+# --- BDMV フォルダ出力 (本編クリップの再利用) ---
+TSMUXER_MUXOPT = "--no-pcr-on-video-pid --new-audio-pes --vbr --vbv-len=500" # ISO 出力と BDMV 出力で共通
+BDMV_CLIP_VERSION = 1 # 本編クリップの作り方を変えたら上げる (キャッシュを無効化する)
+BDMV_CLIP_CACHE_KEEP = 2 # 出力フォルダに残す本編クリップの数 (新しい順)
+BDMV_MENU_CLIP = 0 # メニューは 00000.m2ts / 00000.mpls
+BDMV_FEATURE_CLIP = 1 # 本編は 00001.m2ts / 00001.mpls
+BDMV_VOLUME_LABEL = "BDMV_MENU"
+OUTPUT_FORMATS = {"iso": "ISO イメージ", "bdmv": "BDMV フォルダ (本編を再利用)", "bdmv+iso": "BDMV フォルダ + ISO"}
+FICLONE = 0x40049409 # Linux の reflink (btrfs / XFS など)
+
+def _hdmv_play_playlist(playlist):
+    # PlayPL (分岐命令: op_cnt=1, グループ=分岐, サブグループ=再生, 即値オペランド)
+    return struct.pack('>III', 0x22800000, playlist, 0)
+
+def build_movie_object_bdmv(objects):
+    """ objects: ムービーオブジェクトごとの再生プレイリスト番号の列。プレイリストを順に再生するだけのオブジェクトを作る """
+    body = b"".join(struct.pack('>HH', 0, len(playlists)) + b"".join(_hdmv_play_playlist(p) for p in playlists)
+                    for playlists in objects)
+    data = struct.pack('>IH', 0, len(objects)) + body
+    return b"MOBJ0200" + struct.pack('>I', 0) + bytes(28) + struct.pack('>I', len(data)) + data
+
+def build_index_bdmv(first_play_object, title_objects):
+    """ First Playback とトップメニューを first_play_object に、タイトル N を title_objects[N-1] に割り当てる """
+    def hdmv_object(object_id):
+        # オブジェクト種別 HDMV / 再生種別 ムービー
+        return struct.pack('>IHHI', 0x40000000, 0, object_id, 0)
+    app_info = struct.pack('>I', 34) + bytes(34)
+    indexes = hdmv_object(first_play_object) * 2 + struct.pack('>H', len(title_objects))
+    indexes += b"".join(hdmv_object(object_id) for object_id in title_objects)
+    indexes_start = 40 + len(app_info)
+    return b"INDX0200" + struct.pack('>II', indexes_start, 0) + bytes(24) + app_info + struct.pack('>I', len(indexes)) + indexes
+
+def reflink_file(src, dst):
+    """ コピーオンライトの複製 (reflink / clonefile) を試す。対応していなければ False """
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+            return False
+    if sys.platform == "darwin":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+    return False
+
+def link_or_copy(src, dst):
+    """ ハードリンク → reflink → コピーの順に試し、使った方法を返す """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    if reflink_file(src, dst):
+        return "reflink"
+    shutil.copyfile(src, dst)
+    return "copy"
+
+def scan_bdmv_folder(folder):
+    """ フォルダを check_bdmv_structure と同じ形式の一覧にする """
+    entries = {}
+    for root, dirs, files in os.walk(folder):
+        relative = os.path.relpath(root, folder).replace(os.sep, "/")
+        prefix = "" if relative == "." else relative + "/"
+        for name in dirs:
+            entries[prefix + name] = {"directory": True, "size": 0, "extents": []}
+        for name in files:
+            entries[prefix + name] = {"directory": False, "size": os.path.getsize(os.path.join(root, name)), "extents": []}
+    return entries
+
+def assemble_bdmv_folder(output_folder, clip_folders, playlist_objects, title_objects=None):
+    """
+    tsMuxeR が別々に書いたクリップ (clip_folders の BDMV/) を1つの BDMV フォルダにまとめる。
+    ストリームはリンク (同じファイルシステムならコピーしない)、index.bdmv / MovieObject.bdmv はここで作る。
+    title_objects を省略するとタイトル N はオブジェクト N-1 になる。使ったリンク方法の集計を返す。
+    """
+    partial = output_folder + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    bdmv = os.path.join(partial, "BDMV")
+    for sub in ("PLAYLIST", "CLIPINF", "STREAM", "AUXDATA", "BDJO", "JAR", "META",
+                "BACKUP/PLAYLIST", "BACKUP/CLIPINF", "BACKUP/BDJO"):
+        os.makedirs(os.path.join(bdmv, sub))
+    os.makedirs(os.path.join(partial, "CERTIFICATE", "BACKUP"))
+    methods = {}
+    for clip_folder in clip_folders:
+        source = os.path.join(clip_folder, "BDMV")
+        for sub in ("PLAYLIST", "CLIPINF", "STREAM"):
+            for name in os.listdir(os.path.join(source, sub)):
+                src, dst = os.path.join(source, sub, name), os.path.join(bdmv, sub, name)
+                if sub == "STREAM":
+                    method = link_or_copy(src, dst)
+                    methods[method] = methods.get(method, 0) + 1
+                else:
+                    shutil.copyfile(src, dst)
+                    shutil.copyfile(src, os.path.join(bdmv, "BACKUP", sub, name))
+    if title_objects is None:
+        title_objects = list(range(len(playlist_objects)))
+    files = {"index.bdmv": build_index_bdmv(0, title_objects),
+             "MovieObject.bdmv": build_movie_object_bdmv(playlist_objects)}
+    for name, data in files.items():
+        for directory in (bdmv, os.path.join(bdmv, "BACKUP")):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+    shutil.rmtree(output_folder, ignore_errors=True) # 前回のフォルダ (本編はリンクなのでキャッシュは残る)
+    os.replace(partial, output_folder)
+    return methods
+
+def prune_bdmv_clip_cache(cache_root, keep=BDMV_CLIP_CACHE_KEEP):
+    clips = [e for e in os.scandir(cache_root) if e.is_dir() and not e.name.endswith(".partial")]
+    for entry in sorted(clips, key=lambda e: e.stat().st_mtime, reverse=True)[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+ISO_PACKERS = ("hdiutil", "oscdimg", "mkisofs", "genisoimage") # BDMV フォルダを ISO にするツール (優先順)
+
+def find_iso_packer():
+    """ 使える ISO 作成ツールの (名前, パス)。無ければ None """
+    registry = get_tool_registry()
+    for name in ISO_PACKERS:
+        exe = registry.locate(name)
+        if exe:
+            return name, exe
+    return None
+
+def pack_bdmv_iso(folder, iso_path, log=None, volume_label=BDMV_VOLUME_LABEL):
+    """ BDMV フォルダを UDF の ISO にする。使えるツール (hdiutil / oscdimg / mkisofs / genisoimage) を順に探す """
+    packer = find_iso_packer()
+    if packer is None:
+        raise RuntimeError(f"ISO を作成するツール ({' / '.join(ISO_PACKERS)}) が見つかりません")
+    name, exe = packer
+    commands = {
+        "hdiutil": [exe, "makehybrid", "-udf", "-udf-version", "2.50", "-udf-volume-name", volume_label, "-o", iso_path, folder],
+        "oscdimg": [exe, "-u2", "-udfver250", "-m", f"-l{volume_label}", folder, iso_path],
+        "mkisofs": [exe, "-udf", "-allow-limited-size", "-iso-level", "3", "-V", volume_label, "-o", iso_path, folder],
+        "genisoimage": [exe, "-udf", "-allow-limited-size", "-iso-level", "3", "-V", volume_label, "-o", iso_path, folder],
+    }
+    if name in ("mkisofs", "genisoimage") and log:
+        log(f"注意: {name} は UDF 1.02 で書き出します (UDF 2.50 を要求するプレーヤーでは再生できない場合があります)")
+    if os.path.exists(iso_path):
+        os.remove(iso_path)
+    command = commands[name]
+    if log:
+        log(f"コマンド: {' '.join(command)}")
+    returncode, _ = run_command(command, log=log)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return iso_path
+
+# --- インタラクティブメニュー (HDMV IG) ---
+# tsMuxeR は IG ストリームを mux できないため、メニュークリップを CBR で mux してヌルパケットの位置に
+# IG のパケットを書き込み、PMT・クリップ情報・プレイリストに IG ストリームを登録する。
+# ソースパケットの数と位置は変えないので、tsMuxeR が作った EP マップはそのまま使える。
+IG_PID = 0x1400
+IG_STREAM_TYPE = 0x91
+IG_RENDER_VERSION = 1 # ボタン画像の描き方を変えたら上げる (キャッシュを無効化する)
+IG_MENU_BITRATE_KBPS = 24000
+IG_MENU_MUXOPT = f"--no-pcr-on-video-pid --new-audio-pes --cbr --bitrate={IG_MENU_BITRATE_KBPS} --vbv-len=500"
+IG_STATES = ("normal", "selected", "activated")
+IG_STATE_STYLES = { # ボタンの "selected_font_color" などで上書きできる
+    "normal": {},
+    "selected": {"font_color": "#ffd700", "border_color": "#ffd700", "background_color": "rgba(40, 40, 40, 0.85)"},
+    "activated": {"font_color": "#000000", "border_color": "#ffffff", "background_color": "rgba(255, 215, 0, 0.9)"},
+}
+IG_FRAME_RATE_CODES = {"23.976": 1, "24": 2, "25": 3, "29.97": 4, "50": 6, "59.94": 7}
+IG_DECODE_BYTES_PER_SEC = 2 * 1024 * 1024 # 表示時刻を決めるときに見込むオブジェクトのデコード速度
+TS_NULL_PID = 0x1FFF
+TS_VIDEO_STREAM_TYPES = (0x02, 0x1B, 0x24, 0xEA)
+
+def _hdmv_play_playlist_mark(playlist, mark):
+    # PlayPL at Mark (op_cnt=2, 分岐-再生, 即値オペランド2つ)
+    return struct.pack('>III', 0x42C20000, playlist, mark)
+
+def _hdmv_jump_title(title):
+    # JumpTitle (op_cnt=1, 分岐-ジャンプ, 即値オペランド)
+    return struct.pack('>III', 0x21810000, title, 0)
+
+def ig_button_command(time_str, chapters):
+    """ ボタンの time_str (チャプターの時刻 または "title:N") を、押したときに実行する HDMV コマンドにする """
+    if time_str and time_str.startswith("title:"):
+        return _hdmv_jump_title(int(time_str.split(":", 1)[1]))
+    marks = sorted(set(['00:00:00'] + list(chapters))) # 本編プレイリストのマーク (build_feature_meta と同じ並び)
+    return _hdmv_play_playlist_mark(BDMV_FEATURE_CLIP, marks.index(time_str) if time_str in marks else 0)
+
+def ig_button_neighbors(rects):
+    """
+    ボタンの矩形 [(x, y, 幅, 高さ), ...] から、上・下・左・右キーの移動先 (ボタン番号) を決める。
+    その方向の扇形 (軸から約60度以内) にある最も近いボタンを選び、無ければ自分自身にする。
+    """
+    centers = [(x + w / 2, y + h / 2) for x, y, w, h in rects]
+    neighbors = []
+    for i, center in enumerate(centers):
+        row = []
+        for axis, sign in ((1, -1), (1, 1), (0, -1), (0, 1)): # 上, 下, 左, 右
+            best, best_score = i, None
+            for j, other in enumerate(centers):
+                primary = (other[axis] - center[axis]) * sign
+                secondary = abs(other[1 - axis] - center[1 - axis])
+                if j == i or primary <= 0 or secondary > primary * 2:
+                    continue
+                score = primary + secondary * 2
+                if best_score is None or score < best_score:
+                    best, best_score = j, score
+            row.append(best)
+        neighbors.append(tuple(row))
+    return neighbors
+
+def ig_state_properties(properties, state):
+    """ ボタンの状態ごとの体裁 (既定の IG_STATE_STYLES を、ボタンの "{状態}_font_color" などで上書きする) """
+    keys = ("text", "width", "height", "background_color", "border_color") + MENU_STYLE_KEYS
+    props = {key: properties[key] for key in keys if key in properties} # 位置は含めない (同じ体裁ならキャッシュを共有する)
+    props.update(IG_STATE_STYLES[state])
+    for key in ("font_color", "background_color", "border_color"):
+        if f"{state}_{key}" in properties:
+            props[key] = properties[f"{state}_{key}"]
+    return props
+
+def build_ig_palette(histogram, max_colors=255):
+    """
+    色 (ARGB) ごとの画素数から、メディアンカットで max_colors 色以下のパレットを作る。
+    先頭 (インデックス0) は透明で、RLE では0の連続として符号化される。
+    """
+    def box_stats(box):
+        ranges = [max(c[k] for c in box) - min(c[k] for c in box) for k in range(4)]
+        axis = max(range(4), key=lambda k: ranges[k])
+        return sum(c[4] for c in box) * ranges[axis], axis, box
+
+    colors = [((argb >> 16) & 0xFF, (argb >> 8) & 0xFF, argb & 0xFF, argb >> 24, count)
+              for argb, count in histogram.items() if argb >> 24]
+    boxes = [box_stats(colors)] if colors else []
+    while len(boxes) < max_colors:
+        index = max(range(len(boxes)), key=lambda i: boxes[i][0], default=None)
+        if index is None or boxes[index][0] == 0:
+            break
+        _, axis, box = boxes.pop(index)
+        box.sort(key=lambda c: c[axis])
+        half, total = sum(c[4] for c in box) / 2, 0
+        for split, color in enumerate(box, start=1):
+            total += color[4]
+            if total >= half:
+                break
+        split = min(max(split, 1), len(box) - 1)
+        boxes += [box_stats(box[:split]), box_stats(box[split:])]
+    palette = [0]
+    for _, _, box in boxes:
+        weight = sum(c[4] for c in box)
+        r, g, b, a = (int(round(sum(c[k] * c[4] for c in box) / weight)) for k in range(4))
+        palette.append((a << 24) | (r << 16) | (g << 8) | b)
+    return palette
+
+def ig_palette_entries(palette):
+    """ ARGB のパレットを PDS のエントリ (インデックス, Y, Cr, Cb, 不透明度) にする """
+    entries = []
+    for index, argb in enumerate(palette):
+        alpha = argb >> 24
+        y, cr, cb = _rgb_to_ycrcb709((argb >> 16) & 0xFF, (argb >> 8) & 0xFF, argb & 0xFF) if alpha else (16, 128, 128)
+        entries.append((index, y, cr, cb, alpha))
+    return entries
+
+def _ig_cache_dir():
+    path = os.path.join(get_cache_dir(), "ig_buttons")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _render_ig_button_state(properties, width, height, image_path):
+    """ (プロセスプールで実行) ボタンの1状態を出力解像度で描画して保存し、色ごとの画素数を返す """
+    _init_menu_process()
+    scene = GridGraphicsScene()
+    scene.setSceneRect(0, 0, properties["width"], properties["height"])
+    add_menu_button(scene, dict(properties, pos_x=0, pos_y=0), None)
+    image = render_menu_image(scene, width, height)
+    if not image.save(image_path + ".partial.png"):
+        raise OSError(f"画像を保存できません: {image_path}")
+    os.replace(image_path + ".partial.png", image_path)
+    pixels = memoryview(bytes(image.constBits())).cast('I') # Format_ARGB32 はネイティブの 0xAARRGGBB
+    histogram = {}
+    for argb in pixels.tolist():
+        histogram[argb] = histogram.get(argb, 0) + 1
+    return histogram
+
+def _quantize_ig_object(image_path, palette, rle_path):
+    """ (プロセスプールで実行) 描画済みの画像をパレットに減色して RLE にし、保存する """
+    _init_menu_process()
+    image = QImage(image_path).convertToFormat(QImage.Format.Format_ARGB32)
+    indexed = image.convertToFormat(QImage.Format.Format_Indexed8, palette)
+    width, height, stride = indexed.width(), indexed.height(), indexed.bytesPerLine()
+    data = bytes(indexed.constBits())
+    rle = encode_pgs_rle(b''.join(data[y * stride:y * stride + width] for y in range(height)), width, height)
+    with open(rle_path + ".partial", 'wb') as f:
+        f.write(rle)
+    os.replace(rle_path + ".partial", rle_path)
+
+def render_ig_objects(states, log=None, jobs=None):
+    """
+    ボタンの状態ごとの画像を描画してパレットに減色する。states は [(体裁, 出力の幅, 高さ), ...]。
+    (パレット, [(幅, 高さ, RLE), ...]) を返す。描画は体裁ごと、減色は体裁とパレットの組ごとにキャッシュし、
+    キャッシュに無いものだけをプロセスプールで並行に処理する。
+    """
+    cache_dir = _ig_cache_dir()
+    keys = []
+    for properties, width, height in states:
+        key = {"version": IG_RENDER_VERSION, "properties": properties, "size": [width, height]}
+        keys.append(hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:24])
+    image_paths = [os.path.join(cache_dir, key + ".png") for key in keys]
+    histogram_paths = [os.path.join(cache_dir, key + ".json") for key in keys]
+    pool = None
+    try:
+        # 同じ体裁のボタン (と状態) は1回だけ描く
+        missing = list({keys[i]: i for i in range(len(keys))
+                        if not (os.path.exists(histogram_paths[i]) and os.path.exists(image_paths[i]))}.values())
+        workers = max(1, min(len(states), jobs or (os.cpu_count() or 2) - 1))
+        if missing:
+            if log:
+                log(f"IG のボタン画像 {len(missing)}/{len(set(keys))}種類を {workers}プロセスで描画しています...")
+            # Qt のスレッドを抱えたプロセスを fork しないよう spawn を使う
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            futures = {i: pool.submit(_render_ig_button_state, states[i][0], states[i][1], states[i][2], image_paths[i])
+                       for i in missing}
+            for i, future in futures.items():
+                with open(histogram_paths[i], 'w', encoding='utf-8') as f:
+                    json.dump(future.result(), f)
+        histogram = {}
+        for path in sorted(set(histogram_paths)):
+            with open(path, 'r', encoding='utf-8') as f:
+                for argb, count in json.load(f).items():
+                    histogram[int(argb)] = histogram.get(int(argb), 0) + count
+        palette = build_ig_palette(histogram)
+        palette_key = hashlib.sha256(json.dumps(palette).encode('ascii')).hexdigest()[:16]
+        rle_paths = [os.path.join(cache_dir, f"{key}-{palette_key}.rle") for key in keys]
+        missing = list({rle_paths[i]: i for i in range(len(keys)) if not os.path.exists(rle_paths[i])}.values())
+        if missing:
+            if log:
+                log(f"IG のボタン画像 {len(missing)}種類を {len(palette)}色に減色しています...")
+            pool = pool or ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            for future in [pool.submit(_quantize_ig_object, image_paths[i], palette, rle_paths[i]) for i in missing]:
+                future.result()
+        note_cache("ig_buttons", pool is None)
+    finally:
+        if pool:
+            pool.shutdown()
+    objects = []
+    for (_, width, height), path in zip(states, rle_paths):
+        with open(path, 'rb') as f:
+            objects.append((width, height, f.read()))
+    return palette, objects
+
+def _ig_segment(segment_type, payload):
+    return struct.pack('>BH', segment_type, len(payload)) + payload
+
+def build_ig_segments(width, height, fps_str, buttons, palette, objects):
+    """
+    1ページ・ボタンごとに1つのグループ (BOG) の IG 表示セット (ICS, PDS, ODS..., END) のセグメントを返す。
+    buttons: [{"x", "y", "neighbors" (上, 下, 左, 右), "command"}, ...]、
+    objects: ボタンごとに normal / selected / activated の順の (幅, 高さ, RLE)。オブジェクト番号はその並び順。
+    """
+    page = struct.pack('>BB', 0, 0) + bytes(8) # ページ番号, 版, UO マスク
+    page += bytes(4) # 表示・消去の効果なし
+    page += struct.pack('>BHHBB', 0, 0, 0xFFFF, 0, len(buttons)) # 最初はボタン0を選択, 自動で決定しない, パレット0
+    for number, button in enumerate(buttons):
+        normal, selected, activated = (number * len(IG_STATES) + k for k in range(len(IG_STATES)))
+        page += struct.pack('>HB', number, 1) # BOG (ボタン1つ)
+        page += struct.pack('>HHBHH', number, number + 1, 0, button["x"], button["y"])
+        page += struct.pack('>HHHH', *button["neighbors"])
+        page += struct.pack('>HHB', normal, normal, 0)
+        page += struct.pack('>BHHB', 0xFF, selected, selected, 0) # 効果音なし
+        page += struct.pack('>BHH', 0xFF, activated, activated)
+        page += struct.pack('>H', 1) + button["command"]
+    # 多重化モデル・常時表示, タイムアウトなし, 1ページ
+    composition = bytes(1) + bytes(10) + bytes(3) + struct.pack('>B', 1) + page
+    ics = struct.pack('>HHB', width, height, IG_FRAME_RATE_CODES.get(fps_str, 1) << 4)
+    ics += struct.pack('>HBB', 0, 0x80, 0xC0) # 構成番号0, エポック開始, 1つ目かつ最後の断片
+    ics += struct.pack('>I', len(composition))[1:] + composition
+    if len(ics) > 0xFFFF:
+        raise ValueError(f"ボタンが多すぎて IG の構成が1セグメントに収まりません ({len(buttons)}個)")
+    segments = [_ig_segment(0x18, ics),
+                _ig_segment(0x14, bytes((0, 0)) + b"".join(bytes(entry) for entry in ig_palette_entries(palette)))]
+    for object_id, (object_width, object_height, rle) in enumerate(objects):
+        segments += [_ig_segment(0x15, payload) for payload in
+                     object_definition_payloads(object_id, object_width, object_height, rle)]
+    segments.append(_ig_segment(0x80, b""))
+    return segments
+
+def write_ig_file(path, segments):
+    """ IG の表示セットを .sup と同じ枠 ("IG" + PTS + DTS + セグメント) で書く。時刻は mux 時に決める """
+    with open(path, 'wb') as f:
+        for segment in segments:
+            f.write(b'IG' + struct.pack('>II', 0, 0) + segment)
+
+def read_ig_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    segments, pos = [], 0
+    while pos < len(data):
+        if data[pos:pos + 2] != b'IG':
+            raise ValueError(f"IG ファイルの形式が不正です: {path}")
+        length = struct.unpack('>H', data[pos + 11:pos + 13])[0]
+        segments.append(data[pos + 10:pos + 13 + length])
+        pos += 13 + length
+    return segments
+
+_MPEG_CRC_TABLE = []
+for _byte in range(256):
+    _crc = _byte << 24
+    for _ in range(8):
+        _crc = ((_crc << 1) ^ 0x04C11DB7) if _crc & 0x80000000 else (_crc << 1)
+    _MPEG_CRC_TABLE.append(_crc & 0xFFFFFFFF)
+
+def mpeg_crc32(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _MPEG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+def _pes_timestamp(prefix, ticks):
+    ticks &= (1 << 33) - 1
+    return bytes(((prefix << 4) | ((ticks >> 29) & 0x0E) | 1, (ticks >> 22) & 0xFF, ((ticks >> 14) & 0xFE) | 1,
+                  (ticks >> 7) & 0xFF, ((ticks << 1) & 0xFE) | 1))
+
+def _ts_payload_offset(packet):
+    """ 188 バイトの TS パケットのペイロード開始位置 (ペイロードが無ければ None) """
+    control = (packet[3] >> 4) & 0x3
+    if not control & 0x1:
+        return None
+    offset = 4 + (1 + packet[4] if control & 0x2 else 0)
+    return offset if offset < 188 else None
+
+def _ts_packets_for_pes(pid, pes, continuity):
+    """ PES を TS パケットに分ける (最後のパケットはアダプテーションフィールドで埋める) """
+    packets = []
+    for start in range(0, len(pes), 184):
+        chunk = pes[start:start + 184]
+        header = bytes((0x47, (0x40 if start == 0 else 0) | (pid >> 8), pid & 0xFF))
+        stuffing = 184 - len(chunk)
+        if stuffing:
+            adaptation = bytes((stuffing - 1,)) + (bytes((0x00,)) + b'\xff' * (stuffing - 2) if stuffing > 1 else b'')
+            packets.append(header + bytes((0x30 | continuity,)) + adaptation + chunk)
+        else:
+            packets.append(header + bytes((0x10 | continuity,)) + chunk)
+        continuity = (continuity + 1) & 0x0F
+    return packets, continuity
+
+def inject_ig_stream(m2ts_path, segments):
+    """
+    BD の m2ts (192 バイトのソースパケット) のヌルパケットを IG の PES に置き換え、PMT に IG ストリームを加える。
+    IG は最初の映像の表示時刻以降、IG のパケットが届き終わってから表示されるように時刻を付ける。
+    """
+    with open(m2ts_path, 'rb') as f:
+        data = bytearray(f.read())
+    count = len(data) // 192
+    pmt_pid = video_pid = first_video_pts = None
+    pmt_packets, null_packets = [], []
+    for index in range(count):
+        packet = data[index * 192 + 4:index * 192 + 192]
+        if packet[0] != 0x47:
+            raise ValueError(f"TS の同期バイトがありません (パケット {index})")
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        start = packet[1] & 0x40
+        offset = _ts_payload_offset(packet)
+        if pid == TS_NULL_PID:
+            if pmt_packets:
+                null_packets.append(index)
+        elif pid == 0 and start and pmt_pid is None and offset is not None:
+            section = packet[offset + 1 + packet[offset]:]
+            end = 3 + (((section[1] & 0x0F) << 8) | section[2]) - 4
+            for pos in range(8, end, 4):
+                if (section[pos] << 8) | section[pos + 1]:
+                    pmt_pid = ((section[pos + 2] & 0x1F) << 8) | section[pos + 3]
+                    break
+        elif pid == pmt_pid and start and offset is not None:
+            pmt_packets.append(index)
+            if video_pid is None:
+                section = packet[offset + 1 + packet[offset]:]
+                pos, end = 12 + (((section[10] & 0x0F) << 8) | section[11]), 3 + (((section[1] & 0x0F) << 8) | section[2]) - 4
+                while pos < end:
+                    stream_pid = ((section[pos + 1] & 0x1F) << 8) | section[pos + 2]
+                    if stream_pid == IG_PID:
+                        raise ValueError("クリップには既に IG ストリームがあります")
+                    if section[pos] in TS_VIDEO_STREAM_TYPES and video_pid is None:
+                        video_pid = stream_pid
+                    pos += 5 + (((section[pos + 3] & 0x0F) << 8) | section[pos + 4])
+        elif pid == video_pid and start and first_video_pts is None and offset is not None:
+            pes = packet[offset:]
+            if pes[0:3] == b'\x00\x00\x01' and pes[7] & 0x80:
+                p = pes[9:14]
+                first_video_pts = (((p[0] >> 1) & 0x07) << 30) | (p[1] << 22) | ((p[2] >> 1) << 15) | (p[3] << 7) | (p[4] >> 1)
+    if not pmt_packets or first_video_pts is None:
+        raise ValueError("PMT または映像の表示時刻が見つかりません")
+
+    # 必要なパケット数を求めてから、IG が届き終わる時刻 (ATS, 27MHz) を表示時刻に反映する
+    payload_size = sum(len(segment) for segment in segments)
+    needed = sum((len(segment) + 19 + 183) // 184 for segment in segments)
+    if needed > len(null_packets):
+        raise ValueError(f"IG を入れる空きがありません (必要 {needed} / 空き {len(null_packets)} パケット)")
+    first_ats = struct.unpack('>I', data[0:4])[0] & 0x3FFFFFFF
+    last_ats = struct.unpack('>I', data[null_packets[needed - 1] * 192:null_packets[needed - 1] * 192 + 4])[0] & 0x3FFFFFFF
+    delivered = ((last_ats - first_ats) & 0x3FFFFFFF) // 300 # 27MHz → 90kHz
+    dts = first_video_pts + delivered
+    pts = dts + int(payload_size * 90000 / IG_DECODE_BYTES_PER_SEC) + 3003
+
+    ig_packets, continuity = [], 0
+    for segment in segments:
+        if segment[0] == 0x18: # ICS だけが表示時刻を持つ
+            header = bytes((0x81, 0xC0, 10)) + _pes_timestamp(0x3, pts) + _pes_timestamp(0x1, dts)
+        else:
+            header = bytes((0x81, 0xC0, 10)) + _pes_timestamp(0x3, dts) + _pes_timestamp(0x1, dts)
+        body = header + segment
+        pes = b'\x00\x00\x01\xbd' + struct.pack('>H', len(body)) + body
+        packets, continuity = _ts_packets_for_pes(IG_PID, pes, continuity)
+        ig_packets += packets
+    for index, packet in zip(null_packets, ig_packets):
+        data[index * 192 + 4:index * 192 + 192] = packet # ATS (先頭4バイト) はヌルパケットのものを使う
+
+    for index in pmt_packets:
+        packet = data[index * 192 + 4:index * 192 + 192]
+        offset = _ts_payload_offset(packet)
+        pointer = packet[offset]
+        section_start = offset + 1 + pointer
+        section_length = ((packet[section_start + 1] & 0x0F) << 8) | packet[section_start + 2]
+        body = packet[section_start:section_start + 3 + section_length - 4]
+        body += bytes((IG_STREAM_TYPE, 0xE0 | (IG_PID >> 8), IG_PID & 0xFF, 0xF0, 0x00))
+        body[1:3] = struct.pack('>H', (body[1] & 0xF0) << 8 | (len(body) + 4 - 3))
+        section = body + struct.pack('>I', mpeg_crc32(body))
+        if section_start + len(section) > 188:
+            raise ValueError("PMT が1パケットに収まりません")
+        packet[section_start:] = section + b'\xff' * (188 - section_start - len(section))
+        data[index * 192 + 4:index * 192 + 192] = packet
+    with open(m2ts_path + ".partial", 'wb') as f:
+        f.write(data)
+    os.replace(m2ts_path + ".partial", m2ts_path)
+    return needed
+
+def add_ig_to_clip_info(clpi_path):
+    """ クリップ情報 (.clpi) の ProgramInfo に IG ストリームを加える """
+    with open(clpi_path, 'rb') as f:
+        data = bytearray(f.read())
+    if data[:4] != b'HDMV':
+        raise ValueError(f"クリップ情報の形式が不正です: {clpi_path}")
+    program_info = struct.unpack('>I', data[12:16])[0]
+    if data[program_info + 5] < 1:
+        raise ValueError(f"クリップ情報にプログラムがありません: {clpi_path}")
+    program = program_info + 6 # 先頭のプログラム
+    pos = program + 8
+    for _ in range(data[program + 6]):
+        pos += 3 + data[pos + 2] # PID + StreamCodingInfo
+    entry = struct.pack('>HBB', IG_PID, 5, IG_STREAM_TYPE) + b'und' + bytes(1)
+    data[pos:pos] = entry
+    data[program + 6] += 1
+    data[program_info:program_info + 4] = struct.pack('>I', struct.unpack('>I', data[program_info:program_info + 4])[0] + len(entry))
+    for field in range(16, 28, 4): # CPI, ClipMark, ExtensionData の開始位置
+        address = struct.unpack('>I', data[field:field + 4])[0]
+        if address > program_info:
+            data[field:field + 4] = struct.pack('>I', address + len(entry))
+    with open(clpi_path, 'wb') as f:
+        f.write(data)
+
+def add_ig_to_playlist(mpls_path, still=True):
+    """ プレイリスト (.mpls) の各 PlayItem の STN テーブルに IG ストリームを加え、still なら最後の画で止める """
+    with open(mpls_path, 'rb') as f:
+        data = bytearray(f.read())
+    if data[:4] != b'MPLS':
+        raise ValueError(f"プレイリストの形式が不正です: {mpls_path}")
+    playlist = struct.unpack('>I', data[8:12])[0]
+    entry = bytes((9, 1)) + struct.pack('>H', IG_PID) + bytes(6) + bytes((5, IG_STREAM_TYPE)) + b'und' + bytes(1)
+    item = playlist + 10
+    added = 0
+    for _ in range(struct.unpack('>H', data[playlist + 6:playlist + 8])[0]):
+        if data[item + 12] & 0x10:
+            raise ValueError("マルチアングルのプレイリストには対応していません")
+        if still:
+            data[item + 31:item + 34] = bytes((0x02, 0, 0)) # 無期限の静止 (IG のボタンで先に進む)
+        stn = item + 34
+        pos = stn + 16
+        for _ in range(sum(data[stn + 4:stn + 8])): # 映像, 音声, PG, IG の後ろに加える
+            pos += 1 + data[pos]
+            pos += 1 + data[pos]
+        data[pos:pos] = entry
+        data[stn + 7] += 1
+        added += len(entry)
+        for field, size in ((stn, 2), (item, 2), (playlist, 4)):
+            fmt = '>H' if size == 2 else '>I'
+            data[field:field + size] = struct.pack(fmt, struct.unpack(fmt, data[field:field + size])[0] + len(entry))
+        item += 2 + struct.unpack('>H', data[item:item + 2])[0]
+    for field in (12, 16): # PlayListMark, ExtensionData の開始位置
+        address = struct.unpack('>I', data[field:field + 4])[0]
+        if address > playlist:
+            data[field:field + 4] = struct.pack('>I', address + added)
+    with open(mpls_path, 'wb') as f:
+        f.write(data)
+
+def add_ig_to_clip(clip_folder, clip_number, ig_path):
+    """ tsMuxeR が書いたクリップ (clip_folder/BDMV) に IG ストリームを入れる。使ったパケット数を返す """
+    name = f"{clip_number:05d}"
+    bdmv = os.path.join(clip_folder, "BDMV")
+    packets = inject_ig_stream(os.path.join(bdmv, "STREAM", name + ".m2ts"), read_ig_file(ig_path))
+    add_ig_to_clip_info(os.path.join(bdmv, "CLIPINF", name + ".clpi"))
+    add_ig_to_playlist(os.path.join(bdmv, "PLAYLIST", name + ".mpls"))
+    return packets
+
+# --- 複数タイトル (タイトルごとのエンコードと無劣化の結合) ---
+TITLE_MIN_THREADS = 2 # 並行するタイトルのエンコード1本に最低限回すスレッド数
+TITLE_JOIN_CRF = 14 # 形式の揃わないパートをつなぐ中間ファイルの画質 (本編エンコードの前段なので高めにする)
+BD_COPY_VIDEO_CODECS = {"h264"} # 再エンコードせずに BD に入れられる映像
+BD_COPY_PROFILES = {"Main", "High"}
+BD_COPY_MAX_LEVEL = 41
+BD_COPY_PIX_FMTS = {"yuv420p"}
+BD_COPY_FORMATS = {(1920, 1080): (23.976, 24.0), (1280, 720): (23.976, 24.0, 50.0, 59.94)} # プログレッシブで入れられる解像度とfps
+AUDIO_CHANNEL_LAYOUTS = {1: "mono", 2: "stereo", 6: "5.1", 8: "7.1"}
+
+def title_join_key(probe):
+    """ パートをストリームコピーで連結できるかの判定に使う、形式 (映像と音声の並び) """
+    key = []
+    for st in probe["streams"]:
+        if st["type"] == "video":
+            key.append(("video", st["codec"], st.get("profile", ""), st["width"], st["height"], round(st["fps"], 3),
+                        st["pix_fmt"], st["field_order"]))
+        elif st["type"] == "audio":
+            key.append(("audio", st["codec"], st["channels"], st["sample_rate"]))
+    return tuple(key)
+
+def bd_copy_problems(probe, resolution_fps):
+    """ 本編映像を再エンコードせずに BD に入れられない理由の一覧 (空ならストリームコピーできる) """
+    video = next((st for st in probe["streams"] if st["type"] == "video"), None)
+    if video is None:
+        return ["映像ストリームがありません"]
+    problems = []
+    if video["codec"] not in BD_COPY_VIDEO_CODECS:
+        problems.append(f"コーデック {video['codec']}")
+    if video.get("profile") and video["profile"] not in BD_COPY_PROFILES:
+        problems.append(f"プロファイル {video['profile']}")
+    if video.get("level", 0) > BD_COPY_MAX_LEVEL:
+        problems.append(f"レベル {video['level'] / 10:g}")
+    if video["pix_fmt"] not in BD_COPY_PIX_FMTS:
+        problems.append(f"画素形式 {video['pix_fmt'] or '不明'}")
+    if video["field_order"] not in ("progressive", ""):
+        problems.append("インターレース")
+    if video.get("bit_rate", 0) > BD_MAX_VIDEO_BITRATE:
+        problems.append(f"ビットレート {video['bit_rate'] // 1000} kb/s")
+    size = (video["width"], video["height"])
+    rates = BD_COPY_FORMATS.get(size, ())
+    if not any(abs(video["fps"] - rate) < 0.01 for rate in rates):
+        problems.append(f"{size[0]}x{size[1]} {video['fps']:.3f}fps は BD の形式ではありません")
+    if resolution_fps:
+        width, height, fps = parse_resolution_fps(resolution_fps)
+        if size != (width, height) or abs(video["fps"] - _parse_rate(fps)) > 0.01:
+            problems.append(f"出力設定 ({resolution_fps}) と異なります")
+    return problems
+
+# --- 外部ツールの登録 (検出と機能の調査) ---
+TOOL_REGISTRY_VERSION = 2 # 調べる内容を変えたら上げる (キャッシュを無効化する)
+VIDEO_ENCODER_CHOICES = [("CPU (高品質)", "libx264"), ("NVIDIA (高速)", "h264_nvenc"),
+                         ("AMD (高速)", "h264_amf"), ("Intel (高速)", "h264_qsv")]
+
+def _parse_ffmpeg_listing(lines, pattern, separated=True):
+    """ `ffmpeg -encoders` などの一覧から、区切り線 (---) 以降で pattern に合う名前を取り出す (-filters は区切り線なし) """
+    names = []
+    started = not separated
+    for line in lines:
+        if not started:
+            started = line.startswith("--")
+            continue
+        match = re.match(pattern, line)
+        if match:
+            names.append(match.group(1))
+    return names
+
+def test_video_encoder(ffmpeg_path, encoder):
+    """ 1フレームだけ実際にエンコードしてみる (ビルドに含まれていてもデバイスやドライバが無ければ失敗する) """
+    returncode, _ = run_command([ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                                 '-i', 'color=c=black:s=320x240:r=24', '-frames:v', '1', '-c:v', encoder,
+                                 '-pix_fmt', 'yuv420p', '-f', 'null', '-'])
+    return returncode == 0
+
+def probe_tool_capabilities(name, path):
+    """ ツールを実行してバージョンと機能 (ffmpeg はエンコーダ・フィルタ・フォーマット) を調べる """
+    if name == "tsMuxeR":
+        # 引数なしで起動すると先頭にバージョンを表示する
+        _, lines = run_command([path], capture=True)
+        return {"version": next((line for line in lines if "version" in line.lower()), lines[0] if lines else "")}
+    _, lines = run_command([path, '-hide_banner', '-version'], capture=True)
+    capabilities = {"version": lines[0] if lines else ""}
+    if name != "ffmpeg":
+        return capabilities
+    _, lines = run_command([path, '-hide_banner', '-encoders'], capture=True)
+    capabilities["encoders"] = _parse_ffmpeg_listing(lines, r'[VAS][A-Z.]{5}\s+(\S+)')
+    _, lines = run_command([path, '-hide_banner', '-filters'], capture=True)
+    capabilities["filters"] = _parse_ffmpeg_listing(lines, r'[T.][S.][C.]\s+(\S+)\s+\S*->\S*', separated=False)
+    _, lines = run_command([path, '-hide_banner', '-muxers'], capture=True)
+    capabilities["muxers"] = _parse_ffmpeg_listing(lines, r'E[d ]?\s+(\S+)')
+    _, lines = run_command([path, '-hide_banner', '-demuxers'], capture=True)
+    capabilities["demuxers"] = _parse_ffmpeg_listing(lines, r'D[d ]?\s+(\S+)')
+    capabilities["usable_encoders"] = [encoder for _, encoder in VIDEO_ENCODER_CHOICES
+                                       if encoder in capabilities["encoders"]
+                                       and (encoder not in HW_H264_ENCODERS or test_video_encoder(path, encoder))]
+    capabilities["uhd"] = UHD_VIDEO_ENCODER in capabilities["encoders"] # 2160p (UHD BD) の出力ができるか
+    return capabilities
+
+class ToolRegistry:
+    """
+    外部ツール (ffmpeg / ffprobe / tsMuxeR) の場所と機能を管理する。
+    場所はプロセス内で覚えておき、機能はバイナリのパス・サイズ・更新時刻をキーにディスク上のJSONへキャッシュする。
+    """
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path or os.path.join(get_cache_dir(), "tool_registry.json")
+        self._lock = threading.RLock()
+        self._locations = {} # ツール名 -> パス
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def locate(self, name):
+        """ main.py と同じフォルダ → PATH の順に探す。見つけた場所は、消えていない限り再利用する """
+        with self._lock:
+            path = self._locations.get(name)
+            if path and os.path.exists(path):
+                return path
+            exe_name = f"{name}.exe" if sys.platform == "win32" else name
+            local_path = os.path.join(get_base_path(), exe_name)
+            path = local_path if os.path.exists(local_path) else shutil.which(exe_name)
+            self._locations[name] = path
+            return path
+
+    @staticmethod
+    def _fingerprint(path):
+        st = os.stat(path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    def cached(self, path):
+        """ キャッシュ済みの機能を返す (バイナリが更新されていれば None)。プロセスは起動しない """
+        try:
+            fingerprint = self._fingerprint(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(path))
+        if not entry or entry.get("version") != TOOL_REGISTRY_VERSION or entry.get("fingerprint") != fingerprint:
+            return None
+        return entry["capabilities"]
+
+    def capabilities(self, name, path, refresh=False):
+        """ 機能を返す。キャッシュが無いか refresh なら実際に調べて保存する """
+        capabilities = None if refresh else self.cached(path)
+        if capabilities is not None:
+            return capabilities
+        fingerprint = self._fingerprint(path)
+        capabilities = probe_tool_capabilities(name, path)
+        with self._lock:
+            self._entries[os.path.abspath(path)] = {"version": TOOL_REGISTRY_VERSION, "tool": name,
+                                                    "fingerprint": fingerprint, "capabilities": capabilities}
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, indent=1, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        return capabilities
+
+_tool_registry = None
+_tool_registry_lock = threading.Lock()
+
+def get_tool_registry():
+    global _tool_registry
+    with _tool_registry_lock:
+        if _tool_registry is None:
+            _tool_registry = ToolRegistry()
+        return _tool_registry
+
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QGridLayout,
     QLabel, QPushButton, QLineEdit, QTextEdit, QListWidget,
     QVBoxLayout, QFrame, QFileDialog,
     QGraphicsView, QGraphicsScene, QGraphicsPixmapItem,
     QGraphicsProxyWidget, QFontComboBox, QSpinBox, QColorDialog,
-    QHBoxLayout, QSlider, QComboBox,
+    QHBoxLayout, QSlider, QComboBox, QCheckBox, QDoubleSpinBox,
     QGraphicsTextItem, QToolButton, QSizePolicy,
     QScrollArea
 )
 from PySide6.QtGui import (
     QPixmap, QCursor, QImage, QPainter, QFont, QColor,
-    QTextOption, QPen
+    QTextOption, QPen, QPainterPath, QFontMetricsF, QGuiApplication, QLinearGradient
 )
-from PySide6.QtCore import Qt, QObject, Signal, QRunnable, QThreadPool, QPointF, QUrl
-from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
-from PySide6.QtMultimediaWidgets import QVideoWidget
+from PySide6.QtCore import Qt, QObject, Signal, QRunnable, QThreadPool, QPointF, QRectF, QUrl, QEventLoop, QTimer
+# QtMultimedia は最初に動画を読み込むときに import する (MainWindow.ensure_player)
 
 # --- スタイルシート ---
 STYLE_SHEET = """
@@ -103,7 +3515,7 @@ STYLE_SHEET = """
         border: 1px solid #3c3c3c;
         padding: 2px;
     }
-    QVideoWidget {
+    QVideoWidget, QWidget#videoContainer {
         background-color: black;
     }
 """
@@ -282,13 +3694,979 @@ class GridGraphicsScene(QGraphicsScene):
         for y in range(first_y, bottom, self.grid_size):
             painter.drawLine(left, y, right, y)
 
+# --- メニューの組み立てと描画 (プレビューと一括描画で共通) ---
+MENU_DEFAULT_TITLE = {"text": "My Blu-ray Title", "pos_x": 100, "pos_y": 50, "font_family": "Impact", "font_size": 72,
+                      "font_color": "#ffff00", "is_bold": False, "is_italic": False}
+MENU_DEFAULT_BUTTON = {"font_family": "Arial", "font_size": 50, "font_color": "#ffffff", "is_bold": False, "is_italic": False}
+MENU_STYLE_KEYS = ("font_family", "font_size", "font_color", "is_bold", "is_italic")
+
+def style_menu_button(button_proxy):
+    font_family = button_proxy.property("font_family")
+    font_size = button_proxy.property("font_size")
+    font_color = button_proxy.property("font_color")
+    is_bold = button_proxy.property("is_bold")
+    is_italic = button_proxy.property("is_italic")
+
+    background_color = button_proxy.property("background_color") or "rgba(0, 0, 0, 0.6)"
+    border_color = button_proxy.property("border_color") or "white"
+
+    font_weight = "bold" if is_bold else "normal"
+    font_style = "italic" if is_italic else "normal"
+
+    style = f"""QTextEdit {{
+                background-color: {background_color};
+                color: {font_color};
+                border: 1px solid {border_color};
+                border-radius: 5px;
+                padding: 10px;
+                font-family: '{font_family}';
+                font-size: {font_size}px;
+                font-weight: {font_weight};
+                font-style: {font_style};
+            }}"""
+    button_proxy.widget().setStyleSheet(style)
+
+    if isinstance(button_proxy.widget(), QTextEdit):
+        button_proxy.widget().setAlignment(Qt.AlignCenter)
+
+def style_menu_text(text_item):
+    font = QFont()
+    font.setFamily(text_item.property("font_family"))
+    font.setPointSize(text_item.property("font_size"))
+    font.setBold(text_item.property("is_bold"))
+    font.setItalic(text_item.property("is_italic"))
+
+    text_item.setFont(font)
+    text_item.setDefaultTextColor(QColor(text_item.property("font_color")))
+
+def add_menu_background(scene, pixmap):
+    # 元画像の画素はそのまま保持し、アイテムの変換でシーンを覆うように拡大縮小する
+    # (出力解像度でレンダリングする際に、縮小済み画像からの再拡大を避けるため)
+    bg_item = QGraphicsPixmapItem(pixmap)
+    bg_item.setTransformationMode(Qt.TransformationMode.SmoothTransformation)
+    scale = max(scene.width() / pixmap.width(), scene.height() / pixmap.height()) # Fit by expanding/cropping
+    bg_item.setScale(scale)
+    bg_item.setPos((scene.width() - pixmap.width() * scale) / 2,
+                   (scene.height() - pixmap.height() * scale) / 2)
+    scene.addItem(bg_item)
+    return bg_item
+
+def add_menu_title(scene, properties, defaults=MENU_DEFAULT_TITLE):
+    title_item = DraggableTextItem(properties.get("text", "Title"))
+    for key in MENU_STYLE_KEYS:
+        title_item.setProperty(key, properties.get(key, defaults[key]))
+    style_menu_text(title_item)
+    scene.addItem(title_item)
+    title_item.setPos(properties.get("pos_x", 100), properties.get("pos_y", 50))
+    return title_item
+
+def add_menu_button(scene, properties, chapter_time, defaults=MENU_DEFAULT_BUTTON):
+    button = QTextEdit()
+    button.setText(properties["text"])
+    button.setReadOnly(True)
+
+    proxy_widget = DraggableProxyWidget()
+    proxy_widget.setWidget(button)
+    proxy_widget.setProperty("time_str", chapter_time)
+    for key in MENU_STYLE_KEYS:
+        proxy_widget.setProperty(key, properties.get(key, defaults[key]))
+    for key in ("background_color", "border_color"): # 省略時は style_menu_button の既定 (IG の選択状態などで使う)
+        if key in properties:
+            proxy_widget.setProperty(key, properties[key])
+    style_menu_button(proxy_widget)
+    scene.addItem(proxy_widget)
+    proxy_widget.setPos(properties["pos_x"], properties["pos_y"])
+    if "width" in properties and "height" in properties:
+        proxy_widget.resize(properties["width"], properties["height"])
+    return proxy_widget
+
+def build_menu_scene(layout_data):
+    """ レイアウト (背景は絶対パス) からメニューのシーンを組み立てる。ウィンドウが無くても使える """
+    scene = GridGraphicsScene()
+    scene.setSceneRect(0, 0, MENU_LAYOUT_WIDTH, MENU_LAYOUT_HEIGHT)
+    pixmap = QPixmap(layout_data["background"])
+    if pixmap.isNull():
+        raise ValueError(f"背景画像を読み込めません: {layout_data['background']}")
+    add_menu_background(scene, pixmap)
+    add_menu_title(scene, layout_data.get("title") or MENU_DEFAULT_TITLE)
+    for button_data in layout_data.get("buttons", []):
+        add_menu_button(scene, button_data, button_data.get("time_str"))
+    return scene
+
+def render_menu_image(scene, width=None, height=None):
+    # シーン(論理座標)を出力解像度の画像へ直接レンダリングする
+    scene_rect = scene.sceneRect()
+    if not width or not height:
+        width, height = int(scene_rect.width()), int(scene_rect.height())
+    image = QImage(width, height, QImage.Format.Format_ARGB32)
+    image.fill(Qt.GlobalColor.transparent)
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setRenderHint(QPainter.RenderHint.TextAntialiasing)
+    painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+
+    scene.show_grid = False # グリッドを非表示
+    try:
+        # target を出力サイズにすることで、source(シーン全体) からのスケール変換で描画される
+        scene.render(painter, target=QRectF(0, 0, width, height), source=scene_rect)
+    finally:
+        scene.show_grid = True # 終わったら元に戻す
+
+    painter.end()
+    return image
+
+def render_menu_scene(scene, save_path, width=None, height=None):
+    image = render_menu_image(scene, width, height)
+    if not image.save(save_path):
+        raise OSError(f"画像を保存できません: {save_path}")
+
+# --- メニューテンプレート (差し込み値からの一括描画) ---
+MENU_TEMPLATE_VERSION = 1 # 描画の仕方を変えたら上げる (描画済みのメニュー画像を使わなくなる)
+MENU_TEMPLATE_FIELD = re.compile(r'\{(\w+)\}')
+MENU_LIST_SEPARATOR = "|" # CSV の1つのセルにリスト (エピソード名など) を書くときの区切り
+MENU_VARIANT_STATE = "menu_variant.json"
+MENU_BATCH_MANIFEST = "menus.json"
+
+def fill_menu_template(text, values, index=None):
+    """
+    {名前} を values の値で置き換える。リストの値は index 番目 (ボタンの並び順) の要素を使う。
+    値の無い名前はそのまま残す。
+    """
+    def replace(match):
+        value = values.get(match.group(1))
+        if isinstance(value, (list, tuple)):
+            value = value[index] if index is not None and index < len(value) else None
+        return match.group(0) if value is None else str(value)
+    return MENU_TEMPLATE_FIELD.sub(replace, text)
+
+def menu_template_fields(layout_data):
+    """ タイトルとボタンの文字列に使われている差し込み名 """
+    texts = [(layout_data.get("title") or {}).get("text", "")] + [b.get("text", "") for b in layout_data.get("buttons", [])]
+    return {name for text in texts for name in MENU_TEMPLATE_FIELD.findall(text)}
+
+def menu_list_buttons(buttons, values):
+    """ リストの値 (エピソード名など) を差し込むボタンの位置 """
+    return [i for i, b in enumerate(buttons)
+            if any(isinstance(values.get(name), (list, tuple)) for name in MENU_TEMPLATE_FIELD.findall(b.get("text", "")))]
+
+def expand_menu_buttons(buttons, count, repeat=None):
+    """
+    繰り返すボタン (repeat の位置、省略時はすべて) を count 個に揃え、(ボタン, 繰り返すボタンの位置) を返す。
+    足りない分は繰り返す最後のボタンの体裁で、その先頭2つの間隔 (無ければ70) を空けて直後に足し、
+    それより下にあるボタンは足した分だけ下げる。余る分は繰り返すボタンの後ろから除く。
+    """
+    buttons = [dict({"pos_x": 100, "pos_y": 150}, **b) for b in (buttons or [{}])]
+    repeat = list(repeat) if repeat else list(range(len(buttons)))
+    # 間隔は繰り返すボタン同士でだけ測る (固定のボタンとの距離は使わない)
+    step = buttons[repeat[1]]["pos_y"] - buttons[repeat[0]]["pos_y"] if len(repeat) > 1 else 70
+    if len(repeat) > count:
+        dropped = set(repeat[count:])
+        buttons = [b for i, b in enumerate(buttons) if i not in dropped]
+        repeat = repeat[:count]
+    added = count - len(repeat)
+    if added > 0:
+        last = repeat[-1]
+        bottom = buttons[last]["pos_y"]
+        clones = [dict(buttons[last], pos_y=bottom + step * n) for n in range(1, added + 1)]
+        rest = [dict(b, pos_y=b["pos_y"] + step * added) if b["pos_y"] > bottom else b for b in buttons[last + 1:]]
+        buttons = buttons[:last + 1] + clones + rest
+        repeat += range(last + 1, last + 1 + added)
+    return buttons, repeat
+
+def apply_menu_template(layout_data, values, button_count=None):
+    """
+    タイトルとボタンの文字列 (と time_str) に差し込み値を埋めたレイアウトのコピーを返す。
+    リストの値を使うボタン (無ければすべてのボタン) を繰り返し、その数は button_count、
+    省略時はリストの値の長さに合わせる。「全話再生」のような固定のボタンはそのまま残す。
+    {n} は繰り返すボタンの中での番号 (固定のボタンでは並び順の番号)。
+    """
+    layout = json.loads(json.dumps(layout_data))
+    values = dict(layout.pop("template_values", {}), **values)
+    buttons = layout.get("buttons", [])
+    repeat = menu_list_buttons(buttons, values) or list(range(len(buttons)))
+    if button_count is None:
+        used = {name for i in repeat for name in MENU_TEMPLATE_FIELD.findall(buttons[i].get("text", ""))}
+        lengths = [len(values[name]) for name in used if isinstance(values.get(name), (list, tuple))]
+        button_count = max(lengths) if lengths else len(repeat)
+    if button_count != len(repeat):
+        buttons, repeat = expand_menu_buttons(buttons, button_count, repeat)
+    order = {index: n for n, index in enumerate(repeat)}
+    layout["buttons"] = []
+    for i, b in enumerate(buttons):
+        index = order.get(i, i)
+        button = dict(b, text=fill_menu_template(b.get("text", ""), dict(values, n=index + 1), index))
+        if isinstance(b.get("time_str"), str):
+            button["time_str"] = fill_menu_template(b["time_str"], dict(values, n=index + 1), index)
+        layout["buttons"].append(button)
+    if layout.get("title"):
+        layout["title"]["text"] = fill_menu_template(layout["title"].get("text", ""), values)
+    return layout
+
+def load_menu_variants(path):
+    """
+    差し込み値のファイルを読む。JSON は値の辞書のリスト (または {"variants": [...]})、
+    CSV は1行が1つのメニューで、"|" を含む列はリストとして扱う。"name" が出力フォルダ名になる。
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+        # どこかの行に "|" があれば、その列は (要素が1つの行も含めて) リストの列とみなす
+        list_columns = {key for row in rows for key, value in row.items() if value and MENU_LIST_SEPARATOR in value}
+        variants = [{key: value.split(MENU_LIST_SEPARATOR) if key in list_columns else value
+                     for key, value in row.items() if key and value not in (None, "")} for row in rows]
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            variants = json.load(f)
+        if isinstance(variants, dict):
+            variants = variants.get("variants", [])
+    names = set()
+    for index, values in enumerate(variants, start=1):
+        values["name"] = re.sub(r'[^\w.-]+', '_', str(values.get("name") or f"variant_{index:03}"))
+        if values["name"] in names:
+            raise ValueError(f"差し込み値の name が重複しています: {values['name']}")
+        names.add(values["name"])
+    return variants
+
+def menu_variant_key(layout, resolution_fps):
+    """ 描画結果を決めるもの (値を埋めたレイアウト・背景画像・解像度) のハッシュ """
+    st = os.stat(layout["background"])
+    key = {"version": MENU_TEMPLATE_VERSION, "layout": layout, "background": [st.st_size, st.st_mtime_ns],
+           "resolution_fps": resolution_fps}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _init_menu_process():
+    # ボタンは QTextEdit のプロキシなので QApplication が必要 (画面は不要なので offscreen)
+    if QApplication.instance() is None:
+        _init_menu_process.app = QApplication(['bdcopy-menu', '-platform', 'offscreen'])
+
+def _render_menu_variant(layout, image_path, width, height):
+    """ (プロセスプールで実行) 値を埋めたレイアウトをウィンドウ無しで描画する """
+    _init_menu_process()
+    render_menu_scene(build_menu_scene(layout), image_path, width, height)
+    return image_path
+
+def render_menu_batch(layout_path, variants, output_dir, resolution_fps, ffmpeg_path=None, duration_sec=10.0,
+                      jobs=None, log=print):
+    """
+    テンプレートのレイアウトに差し込み値を埋めて、値の組ごとにメニュー画像 (と ffmpeg があればメニュー動画) を作る。
+    出力は output_dir/<name>/ (menu_image.png, menu.m2ts, 値を埋めた layout.json)。
+    前回と同じ内容の組は描画もエンコードもせずに前回の出力を使う。
+    """
+    with open(layout_path, 'r', encoding='utf-8') as f:
+        template = json.load(f)
+    layout_dir = os.path.dirname(os.path.abspath(layout_path))
+    width, height, _ = parse_resolution_fps(resolution_fps)
+    manifest = {"layout": os.path.abspath(layout_path), "resolution_fps": resolution_fps, "variants": []}
+    pending = []
+    for values in variants:
+        layout = apply_menu_template(template, {k: v for k, v in values.items() if k != "background"})
+        background = values.get("background") or template["background"]
+        layout["background"] = background if os.path.isabs(background) else os.path.join(layout_dir, background)
+        variant_dir = os.path.join(output_dir, values["name"])
+        os.makedirs(variant_dir, exist_ok=True)
+        entry = {"name": values["name"], "image": os.path.join(variant_dir, "menu_image.png"), "rendered": False}
+        manifest["variants"].append(entry)
+        with open(os.path.join(variant_dir, "layout.json"), 'w', encoding='utf-8') as f:
+            json.dump(layout, f, indent=4, ensure_ascii=False)
+        try:
+            key = menu_variant_key(layout, resolution_fps)
+        except OSError as e:
+            entry["error"] = f"背景画像を読み込めません: {e}"
+            continue
+        state_path = os.path.join(variant_dir, MENU_VARIANT_STATE)
+        state = {}
+        if os.path.exists(state_path) and os.path.exists(entry["image"]):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        if state.get("key") != key:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            pending.append((entry, layout, state_path, key))
+
+    log(f"メニュー {len(manifest['variants'])}件のうち {len(pending)}件を描画します (残りは前回の画像を使います)。")
+    if pending:
+        workers = max(1, min(len(pending), jobs or (os.cpu_count() or 2) - 1))
+        with pipeline_stage("menu_render", outputs=[entry["image"] for entry, _, _, _ in pending]):
+            # Qt のスレッドを抱えたプロセスを fork しないよう spawn を使う
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [(pool.submit(_render_menu_variant, layout, entry["image"], width, height), entry, state_path, key)
+                           for entry, layout, state_path, key in pending]
+                for future, entry, state_path, key in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        entry["error"] = f"描画に失敗: {e}"
+                        log(f"{entry['name']}: {entry['error']}")
+                        continue
+                    entry["rendered"] = True
+                    with open(state_path, 'w', encoding='utf-8') as f:
+                        json.dump({"key": key}, f)
+                    log(f"{entry['name']}: メニュー画像を描画しました。")
+
+    if ffmpeg_path:
+        def encode(entry):
+            try:
+                entry["video"] = encode_menu_video(entry["image"], duration_sec, resolution_fps, ffmpeg_path,
+                                                   log=lambda message: None) # ffmpeg の進捗は並行すると読めないので出さない
+            except Exception as e:
+                entry["error"] = f"メニュー動画エンコード失敗: {e}"
+                log(f"{entry['name']}: {entry['error']}")
+        ready = [entry for entry in manifest["variants"] if "error" not in entry]
+        with ThreadPoolExecutor(max_workers=max(1, min(len(ready), jobs or os.cpu_count() or 1))) as pool:
+            list(pool.map(encode, ready))
+
+    with open(os.path.join(output_dir, MENU_BATCH_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    return manifest
+
+# --- 字幕 (SRT/ASS → Blu-ray PGS) ---
+def _subtitle_time_to_sec(h, m, s, frac):
+    return int(h) * 3600 + int(m) * 60 + int(s) + int(frac) / (10 ** len(frac))
+
+def parse_subtitle_file(path):
+    """ SRT / ASS(SSA) を読み込み、(開始秒, 終了秒, テキスト) のリストを返す """
+    with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        text = f.read().replace('\r\n', '\n')
+    events = []
+    if path.lower().endswith(('.ass', '.ssa')):
+        fields = None
+        in_events = False
+        for line in text.split('\n'):
+            line = line.strip()
+            if line.startswith('['):
+                in_events = line.lower() == '[events]'
+                continue
+            if not in_events:
+                continue
+            if line.startswith('Format:'):
+                fields = [f.strip().lower() for f in line[len('Format:'):].split(',')]
+            elif line.startswith('Dialogue:') and fields:
+                values = line[len('Dialogue:'):].split(',', len(fields) - 1)
+                row = dict(zip(fields, (v.strip() for v in values)))
+                start = re.match(r'(\d+):(\d+):(\d+)\.(\d+)', row.get('start', ''))
+                end = re.match(r'(\d+):(\d+):(\d+)\.(\d+)', row.get('end', ''))
+                if not start or not end:
+                    continue
+                body = re.sub(r'\{[^}]*\}', '', row.get('text', '')) # 上書きタグは無視する
+                body = body.replace('\\N', '\n').replace('\\n', '\n').replace('\\h', ' ').strip()
+                if body:
+                    events.append((_subtitle_time_to_sec(*start.groups()), _subtitle_time_to_sec(*end.groups()), body))
+    else:
+        for block in re.split(r'\n\s*\n', text.strip()):
+            lines = block.split('\n')
+            for i, line in enumerate(lines):
+                match = re.match(r'(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)', line.strip())
+                if match:
+                    g = match.groups()
+                    body = '\n'.join(re.sub(r'<[^>]+>', '', l) for l in lines[i + 1:]).strip()
+                    if body:
+                        events.append((_subtitle_time_to_sec(*g[:4]), _subtitle_time_to_sec(*g[4:]), body))
+                    break
+    events.sort(key=lambda e: e[0])
+    # PGS は同時に1つの表示セットのみ扱うため、重なる字幕は次の開始時刻で打ち切る
+    for i in range(len(events) - 1):
+        if events[i][1] > events[i + 1][0]:
+            events[i] = (events[i][0], events[i + 1][0], events[i][2])
+    return [e for e in events if e[1] > e[0]]
+
+def _rgb_to_ycrcb709(r, g, b):
+    """ BT.709 (リミテッドレンジ) の Y, Cr, Cb に変換する """
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    cb = (b - y) / 1.8556
+    cr = (r - y) / 1.5748
+    return (int(round(16 + 219 * y / 255)), int(round(128 + 224 * cr / 255)), int(round(128 + 224 * cb / 255)))
+
+def build_subtitle_palette(fill_color, outline_color):
+    """
+    塗り・縁取りのアルファ (各4bit) の組み合わせを 256 色パレットに割り当てる。
+    インデックスは (塗り << 4) | 縁取り、0 は透明。
+    """
+    fill = QColor(fill_color)
+    outline = QColor(outline_color)
+    palette = []
+    for index in range(1, 256):
+        fa = (index >> 4) / 15.0
+        oa = (index & 0x0F) / 15.0
+        alpha = fa + oa * (1 - fa)
+        if alpha <= 0:
+            palette.append((index, 16, 128, 128, 0))
+            continue
+        mix = [(cf * fa + co * oa * (1 - fa)) / alpha for cf, co in
+               ((fill.red(), outline.red()), (fill.green(), outline.green()), (fill.blue(), outline.blue()))]
+        y, cr, cb = _rgb_to_ycrcb709(*mix)
+        palette.append((index, y, cr, cb, int(round(alpha * 255))))
+    return palette
+
+_PGS_RUN_RE = re.compile(rb'(.)\1*', re.S)
+
+def encode_pgs_rle(indices, width, height):
+    """ パレットインデックス列を PGS のランレングス形式に符号化する """
+    out = bytearray()
+    for y in range(height):
+        row = indices[y * width:(y + 1) * width]
+        for match in _PGS_RUN_RE.finditer(row):
+            color = row[match.start()]
+            length = match.end() - match.start()
+            while length > 0:
+                n = min(length, 16383)
+                if color == 0:
+                    out += bytes((0, n)) if n < 64 else bytes((0, 0x40 | (n >> 8), n & 0xFF))
+                elif n < 3:
+                    out += bytes((color,)) * n
+                elif n < 64:
+                    out += bytes((0, 0x80 | n, color))
+                else:
+                    out += bytes((0, 0xC0 | (n >> 8), n & 0xFF, color))
+                length -= n
+        out += b'\x00\x00' # 行末
+    return bytes(out)
+
+# サブプロセスごとの描画済みグリフ列 (1行分のマスク) のキャッシュ
+_glyph_run_cache = OrderedDict()
+_GLYPH_RUN_CACHE_SIZE = 4096
+
+def _init_subtitle_process():
+    # フォント描画には QGuiApplication が必要 (画面は不要なので offscreen)
+    if QGuiApplication.instance() is None:
+        _init_subtitle_process.app = QGuiApplication(['bdcopy-subtitle', '-platform', 'offscreen'])
+
+def _render_glyph_run(text, font_family, pixel_size, outline):
+    """ 1行分の (幅, 高さ, 塗りマスク, 縁取りマスク) を返す。同じ行は再描画しない """
+    key = (text, font_family, pixel_size, outline)
+    cached = _glyph_run_cache.get(key)
+    if cached:
+        _glyph_run_cache.move_to_end(key)
+        return cached
+    font = QFont(font_family)
+    font.setPixelSize(pixel_size)
+    metrics = QFontMetricsF(font)
+    path = QPainterPath()
+    path.addText(0, 0, font, text)
+    bounds = path.boundingRect()
+    width = max(1, int(math.ceil(bounds.width())) + outline * 2 + 2)
+    height = int(math.ceil(metrics.ascent() + metrics.descent())) + outline * 2
+    path.translate(outline + 1 - bounds.left(), outline + metrics.ascent())
+
+    masks = []
+    for with_outline in (False, True):
+        image = QImage(width, height, QImage.Format.Format_Grayscale8)
+        image.fill(0)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        if with_outline:
+            pen = QPen(QColor(255, 255, 255), outline * 2)
+            pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
+            painter.strokePath(path, pen)
+        painter.fillPath(path, QColor(255, 255, 255))
+        painter.end()
+        stride = image.bytesPerLine()
+        data = bytes(image.constBits())
+        masks.append(b''.join(data[y * stride:y * stride + width] for y in range(height)))
+    result = (width, height, masks[0], masks[1])
+    _glyph_run_cache[key] = result
+    if len(_glyph_run_cache) > _GLYPH_RUN_CACHE_SIZE:
+        _glyph_run_cache.popitem(last=False)
+    return result
+
+def _render_subtitle_chunk(events, font_family, pixel_size, outline, video_width, video_height):
+    """
+    (プロセスプールで実行) 字幕イベント群をビットマップ化し、PGS の RLE まで済ませて返す。
+    戻り値: [(開始秒, 終了秒, x, y, 幅, 高さ, RLEデータ), ...]
+    """
+    _init_subtitle_process()
+    results = []
+    for start, end, text in events:
+        runs = [_render_glyph_run(line, font_family, pixel_size, outline) for line in text.split('\n') if line.strip()]
+        if not runs:
+            continue
+        width = min(max(r[0] for r in runs), video_width)
+        height = min(sum(r[1] for r in runs), video_height)
+        fill = bytearray(width * height)
+        edge = bytearray(width * height)
+        top = 0
+        for run_width, run_height, run_fill, run_edge in runs:
+            left = max(0, (width - run_width) // 2)
+            copy_width = min(run_width, width)
+            for y in range(min(run_height, height - top)):
+                dst = (top + y) * width + left
+                fill[dst:dst + copy_width] = run_fill[y * run_width:y * run_width + copy_width]
+                edge[dst:dst + copy_width] = run_edge[y * run_width:y * run_width + copy_width]
+            top += run_height
+        # (塗り上位4bit) | (縁取り上位4bit >> 4) をまとめて計算する
+        n = width * height
+        fill_int = int.from_bytes(fill, 'big') & int.from_bytes(b'\xf0' * n, 'big')
+        edge_int = (int.from_bytes(edge, 'big') >> 4) & int.from_bytes(b'\x0f' * n, 'big')
+        indices = (fill_int | edge_int).to_bytes(n, 'big')
+        x = (video_width - width) // 2
+        y = max(0, video_height - int(video_height * 0.06) - height)
+        results.append((start, end, x, y, width, height, encode_pgs_rle(indices, width, height)))
+    return results
+
+def _pgs_segment(pts, segment_type, payload):
+    return b'PG' + struct.pack('>IIBH', pts, 0, segment_type, len(payload)) + payload
+
+def object_definition_payloads(object_id, width, height, rle):
+    """ ビットマップ (RLE) を ODS のペイロードに分ける (1セグメントに収まらない分は続きの ODS にする)。PGS と IG で共通 """
+    data = struct.pack('>I', len(rle) + 4)[1:] + struct.pack('>HH', width, height) + rle
+    chunk_size = 0xFFFF - 4
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    return [struct.pack('>HBB', object_id, 0, (0x80 if i == 0 else 0) | (0x40 if i == len(chunks) - 1 else 0)) + chunk
+            for i, chunk in enumerate(chunks)]
+
+def write_pgs_file(path, rendered_events, palette, video_width, video_height):
+    """ ビットマップ化済みの字幕を PGS (.sup) として書き出す """
+    with open(path, 'wb') as f:
+        composition = 0
+        for start, end, x, y, width, height, rle in rendered_events:
+            pts = int(round(start * 90000))
+            window = struct.pack('>BBHHHH', 1, 0, x, y, width, height)
+            # 表示: PCS(エポック開始) → WDS → PDS → ODS → END
+            pcs = struct.pack('>HHBHBBBB', video_width, video_height, 0x10, composition & 0xFFFF, 0x80, 0, 0, 1)
+            pcs += struct.pack('>HBBHH', 0, 0, 0, x, y)
+            f.write(_pgs_segment(pts, 0x16, pcs))
+            f.write(_pgs_segment(pts, 0x17, window))
+            f.write(_pgs_segment(pts, 0x14, bytes((0, 0)) + b''.join(bytes(entry) for entry in palette)))
+            for payload in object_definition_payloads(0, width, height, rle):
+                f.write(_pgs_segment(pts, 0x15, payload))
+            f.write(_pgs_segment(pts, 0x80, b''))
+            composition += 1
+            # 消去: オブジェクト無しの PCS → WDS → END
+            end_pts = int(round(end * 90000))
+            pcs = struct.pack('>HHBHBBBB', video_width, video_height, 0x10, composition & 0xFFFF, 0x00, 0, 0, 0)
+            f.write(_pgs_segment(end_pts, 0x16, pcs))
+            f.write(_pgs_segment(end_pts, 0x17, window))
+            f.write(_pgs_segment(end_pts, 0x80, b''))
+            composition += 1
+
 # --- バックグラウンド処理のためのWorker ---
 class WorkerSignals(QObject):
     finished = Signal(str)
     error = Signal(str)
     log = Signal(str)
+    result = Signal(object) # 構造化された結果 (プローブ結果など)
+    stage = Signal(object) # 処理段階の実測値 (pipeline_stage の記録。メトリクス用)
+
+# --- メトリクスの収集 ---
+class MetricsCollector(QObject):
+    """
+    Worker のシグナルからメトリクスを集める。
+    シグナルは GUI スレッドにあるこのオブジェクトへキュー経由で届くので、Worker 側は待たされない。
+    """
+    FPS_PATTERN = re.compile(r'frame=\s*\d+\s+fps=\s*([\d.]+)')
+
+    def __init__(self, registry, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+        self.job_states = {"queued": 0, "running": 0}
+        self.cache_counts = {} # キャッシュ名 -> [ヒット, 合計]
+        self._publish_job_states()
+        self.registry.inc("bdcopy_jobs_completed_total", "完了したジョブ数", 0)
+        self.registry.inc("bdcopy_jobs_failed_total", "失敗したジョブ数", 0)
+
+    def _publish_job_states(self):
+        for state, count in self.job_states.items():
+            self.registry.set("bdcopy_jobs", "状態ごとのジョブ数", count, state=state)
+
+    def watch(self, signals, label):
+        # label は ffmpeg の進捗行 (fps) をどの段階として数えるか
+        signals.setProperty("metrics_label", label)
+        signals.stage.connect(self.record_stage)
+        signals.log.connect(self.record_log)
+
+    def watch_job(self, job):
+        job.started.connect(self.job_started)
+        job.finished.connect(self.job_finished)
+        job.error.connect(self.job_failed)
+
+    def set_queued(self, count):
+        # 開始待ちのジョブ数 (監視フォルダのキューなど、キューを持つ側が通知する)
+        self.job_states["queued"] = count
+        self._publish_job_states()
+
+    def job_started(self):
+        self.job_states["running"] += 1
+        self._publish_job_states()
+
+    def job_finished(self, _path):
+        self.job_states["running"] -= 1
+        self.registry.inc("bdcopy_jobs_completed_total", "完了したジョブ数")
+        self._publish_job_states()
+
+    def job_failed(self, _message):
+        self.job_states["running"] -= 1
+        self.registry.inc("bdcopy_jobs_failed_total", "失敗したジョブ数")
+        self._publish_job_states()
+
+    def record_log(self, line):
+        match = self.FPS_PATTERN.search(line)
+        if match and self.sender() is not None:
+            self.registry.set("bdcopy_encode_fps", "エンコード中の処理速度 (ffmpeg の進捗表示)",
+                              float(match.group(1)), stage=self.sender().property("metrics_label") or "unknown")
+
+    def record_stage(self, record):
+        stage = stage_kind(record["name"]) # ラベルの種類を増やさない
+        self.registry.observe("bdcopy_stage_duration_seconds", "処理段階の所要時間", record["wall_sec"], stage=stage)
+        if record.get("bytes_written"):
+            self.registry.inc("bdcopy_bytes_written_total", "処理段階が書き出したバイト数", record["bytes_written"], stage=stage)
+        if not record.get("ok", True):
+            self.registry.inc("bdcopy_stage_failures_total", "失敗した処理段階の数", stage=stage)
+        for tool, code in record.get("exit_codes", []):
+            self.registry.inc("bdcopy_subprocess_exits_total", "外部ツールの終了コード", tool=tool, code=str(code))
+        for cache, hit in record.get("cache", []):
+            counts = self.cache_counts.setdefault(cache, [0, 0])
+            counts[0] += int(hit)
+            counts[1] += 1
+            self.registry.inc("bdcopy_cache_requests_total", "キャッシュの参照数", cache=cache, result="hit" if hit else "miss")
+            self.registry.set("bdcopy_cache_hit_ratio", "キャッシュのヒット率", counts[0] / counts[1], cache=cache)
+
+_metrics_collector = None
+
+def get_metrics_collector():
+    # GUI スレッドで最初に呼ぶこと (シグナルをGUIスレッドで受けるため)
+    global _metrics_collector
+    if _metrics_collector is None:
+        _metrics_collector = MetricsCollector(get_metrics_registry())
+    return _metrics_collector
+
+# --- ジョブ履歴 (SQLite) と所要時間の予測 ---
+JOB_HISTORY_FILE = "job_history.sqlite3"
+HISTORY_MIN_SAMPLES = 3 # 同じ条件の記録がこれより少なければ、より粗い条件で予測する
+HISTORY_MAX_SAMPLES = 50 # 予測には直近の記録だけを使う (マシンやツールの更新に追従する)
+HISTORY_REGRESSION_RATIO = 1.5 # 予測のこの倍より遅かった段階を警告する
+HISTORY_REGRESSION_MIN_SEC = 10.0 # 予測との差がこれ未満なら警告しない (短い段階のぶれ)
+HISTORY_ETA_LOG_SEC = 60.0 # 完了予定がこれ以上変わったときだけログに出す
+# 予測に使う条件 (一致する記録が足りなければ次の粗い条件に落とす)
+HISTORY_MATCH_LEVELS = (("encoder", "preset", "resolution_fps"), ("encoder", "resolution_fps"), ("resolution_fps",), ())
+QUEUE_ORDERS = ("fifo", "shortest", "deadline") # 監視フォルダのキューの順序
+
+JOB_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    source TEXT,
+    duration_sec REAL, -- ソースの長さ (複数タイトルは合計。本編クリップを再利用したジョブは NULL)
+    width INTEGER,
+    height INTEGER,
+    encoder TEXT,
+    preset TEXT,
+    resolution_fps TEXT,
+    output_format TEXT,
+    media_target TEXT,
+    titles INTEGER NOT NULL,
+    wall_sec REAL NOT NULL,
+    output_bytes INTEGER,
+    encode_fps REAL,
+    result TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    stage TEXT NOT NULL, -- stage_kind の名前
+    name TEXT NOT NULL,
+    wall_sec REAL NOT NULL,
+    cpu_sec REAL,
+    bytes_written INTEGER,
+    cached INTEGER NOT NULL, -- キャッシュを使った段階 (予測には使わない)
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_by_kind ON stages (stage, job_id);
+"""
+
+def format_duration(seconds):
+    if not math.isfinite(seconds):
+        return "不明"
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}時間{seconds % 3600 // 60:02}分"
+    if seconds >= 60:
+        return f"{seconds // 60}分{seconds % 60:02}秒"
+    return f"{seconds}秒"
+
+def path_size(path):
+    """ ファイルならそのサイズ、フォルダ (BDMV 出力) なら中のファイルの合計 """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+    return os.path.getsize(path)
+
+def fit_duration_model(samples):
+    """
+    (ソースの長さ, 所要秒) の組から 所要秒 = a + b × 長さ の (a, b) を最小二乗で求める。
+    長さが揃っていて傾きが決まらない・切片が負になる場合は長さに比例、傾きが負なら一定とみなす。
+    """
+    xs = [x for x, _ in samples]
+    ys = [y for _, y in samples]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x > 1e-6 * mean_x ** 2 * len(xs):
+        b = sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x
+        a = mean_y - b * mean_x
+        if b < 0:
+            return statistics.median(ys), 0.0
+        if a >= 0:
+            return a, b
+    return 0.0, statistics.median(y / x for x, y in samples)
+
+class JobHistory:
+    """
+    ジョブと処理段階ごとの実測値 (ソースの長さ・解像度・エンコーダ・所要時間・出力サイズ) を SQLite に保存し、
+    同じ条件の履歴から所要時間を予測する。
+    """
+    JOB_COLUMNS = ("started_at", "source", "duration_sec", "width", "height", "encoder", "preset", "resolution_fps",
+                   "output_format", "media_target", "titles", "wall_sec", "output_bytes", "encode_fps", "result")
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_cache_dir(), JOB_HISTORY_FILE)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self.db:
+            self.db.executescript(JOB_HISTORY_SCHEMA)
+
+    def record_job(self, job, stages):
+        """ 1ジョブ分 (job は JOB_COLUMNS の dict、stages は pipeline_stage の記録のリスト) を保存し、id を返す """
+        with self._lock, self.db:
+            cursor = self.db.execute(f"INSERT INTO jobs ({', '.join(self.JOB_COLUMNS)}) "
+                                     f"VALUES ({', '.join('?' * len(self.JOB_COLUMNS))})",
+                                     [job.get(column) for column in self.JOB_COLUMNS])
+            self.db.executemany("INSERT INTO stages (job_id, stage, name, wall_sec, cpu_sec, bytes_written, cached, ok) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(cursor.lastrowid, stage_kind(record["name"]), record["name"], record["wall_sec"],
+                                  record.get("cpu_sec"), record.get("bytes_written", 0),
+                                  int(any(hit for _, hit in record.get("cache", []))), int(record.get("ok", True)))
+                                 for record in stages])
+        return cursor.lastrowid
+
+    def recent_jobs(self, limit=20):
+        with self._lock:
+            rows = self.db.execute(f"SELECT id, {', '.join(self.JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?",
+                                   (limit,)).fetchall()
+        return [dict(zip(("id",) + self.JOB_COLUMNS, row)) for row in rows]
+
+    def _predict(self, query, conditions, params, features):
+        duration = features.get("duration_sec")
+        if not duration:
+            return None
+        with self._lock:
+            for keys in HISTORY_MATCH_LEVELS:
+                where = conditions + [f"j.{key} IS ?" for key in keys] # IS: 未指定 (NULL) 同士も一致させる
+                rows = self.db.execute(f"{query} WHERE {' AND '.join(where)} ORDER BY j.id DESC LIMIT ?",
+                                       params + [features.get(key) for key in keys] + [HISTORY_MAX_SAMPLES]).fetchall()
+                if len(rows) >= HISTORY_MIN_SAMPLES:
+                    a, b = fit_duration_model(rows)
+                    return {"seconds": a + b * duration, "samples": len(rows),
+                            "basis": " / ".join(str(features.get(key) or "既定") for key in keys) or "全条件"}
+        return None
+
+    def predict_stage(self, stage, features):
+        """ 処理段階 (stage_kind の名前) の所要秒を予測する。履歴が足りなければ None """
+        # 複数タイトルのジョブは段階ごとのソースの長さが分からないので使わない
+        return self._predict("SELECT j.duration_sec, s.wall_sec FROM stages s JOIN jobs j ON j.id = s.job_id",
+                             ["s.stage = ?", "s.ok = 1", "s.cached = 0", "j.titles = 1", "j.duration_sec > 0"],
+                             [stage], features)
+
+    def wall_ratio(self):
+        """ 全ジョブの 所要秒 / ソースの長さ の中央値 (条件ごとに予測できないときの換算用)。履歴が足りなければ None """
+        with self._lock:
+            rows = self.db.execute("SELECT wall_sec / duration_sec FROM jobs WHERE result = 'ok' AND duration_sec > 0 "
+                                   "ORDER BY id DESC LIMIT ?", (HISTORY_MAX_SAMPLES,)).fetchall()
+        return statistics.median(row[0] for row in rows) if len(rows) >= HISTORY_MIN_SAMPLES else None
+
+    def predict_job(self, features):
+        """ ジョブ全体 (開始から完了まで) の所要秒を予測する。履歴が足りなければ None """
+        return self._predict("SELECT j.duration_sec, j.wall_sec FROM jobs j",
+                             ["j.result = 'ok'", "j.titles = ?", "j.output_format = ?", "j.duration_sec > 0"],
+                             [features.get("titles", 1), features.get("output_format")], features)
+
+_job_history = None
+
+def get_job_history():
+    global _job_history
+    if _job_history is None:
+        _job_history = JobHistory()
+    return _job_history
+
+class JobHistoryRecorder(QObject):
+    """
+    ジョブの処理段階の記録を集め、終了時 (失敗時も) にジョブ履歴へ保存する。
+    ソースのプローブが済んだら履歴から所要時間を予測して完了予定をログに出し、
+    段階が終わるたびに予測との比で完了予定を更新する。予測より大幅に遅い段階は警告する。
+    """
+    def __init__(self, registry, parent=None):
+        super().__init__(parent)
+        self.registry = registry
+
+    def watch_job(self, job):
+        run = {"started": time.perf_counter(), "started_at": datetime.now().isoformat(timespec="seconds"),
+               "stages": [], "prediction": None, "predicted_sec": 0.0, "actual_sec": 0.0, "done": False,
+               "features": {"source": job.sources[0], "encoder": video_encoder_for(job.encoder, job.resolution_fps),
+                            "preset": job.preset, "resolution_fps": job.resolution_fps, "output_format": job.output_format,
+                            "media_target": job.media_target, "titles": max(1, len(job.titles))}}
+        job.stage.connect(lambda record: self.stage_recorded(job, run, record))
+        job.source_ready.connect(lambda source: self.source_ready(job, run, source))
+        job.finished.connect(lambda path: self.job_done(job, run, "ok", path))
+        job.error.connect(lambda _message: self.job_done(job, run, "error", None))
+
+    def source_ready(self, job, run, source):
+        run["features"].update(source)
+        try:
+            run["prediction"] = get_job_history().predict_job(run["features"])
+            for record in run["stages"]:
+                self.check_stage(job, run, record)
+        except sqlite3.Error as e:
+            job.log.emit(f"警告: ジョブ履歴を読み込めません: {e}")
+            return
+        prediction = run["prediction"]
+        if prediction:
+            job.log.emit(f"所要時間の予測: 約{format_duration(prediction['seconds'])} "
+                         f"({prediction['basis']} の履歴 {prediction['samples']}件から)")
+            self.report_eta(job, run)
+
+    def stage_recorded(self, job, run, record):
+        run["stages"].append(record)
+        if "duration_sec" not in run["features"] or run["done"]:
+            return # 予測はプローブの後 (それまでの段階は source_ready でまとめて確認する)
+        try:
+            if self.check_stage(job, run, record):
+                self.report_eta(job, run)
+        except sqlite3.Error as e:
+            job.log.emit(f"警告: ジョブ履歴を読み込めません: {e}")
+
+    def check_stage(self, job, run, record):
+        """ 段階の所要時間を予測と比べる。予測があれば True """
+        features = run["features"]
+        if features["titles"] > 1 or not record.get("ok", True) or any(hit for _, hit in record.get("cache", [])):
+            return False
+        stage = stage_kind(record["name"])
+        prediction = get_job_history().predict_stage(stage, features)
+        if not prediction:
+            return False
+        run["predicted_sec"] += prediction["seconds"]
+        run["actual_sec"] += record["wall_sec"]
+        if (record["wall_sec"] > prediction["seconds"] * HISTORY_REGRESSION_RATIO
+                and record["wall_sec"] - prediction["seconds"] >= HISTORY_REGRESSION_MIN_SEC):
+            job.log.emit(f"⚠️ 処理時間の悪化: {record['name']} に {format_duration(record['wall_sec'])}かかりました "
+                         f"(予測 {format_duration(prediction['seconds'])}、{prediction['basis']} の履歴 {prediction['samples']}件)")
+            self.registry.inc("bdcopy_stage_regressions_total", "履歴からの予測より大幅に遅かった処理段階の数", stage=stage)
+        return True
+
+    def report_eta(self, job, run):
+        # 終わった段階の実測と予測の比で、ジョブ全体の予測を補正する
+        if not run["prediction"]:
+            return
+        pace = run["actual_sec"] / run["predicted_sec"] if run["predicted_sec"] else 1.0
+        remaining = run["prediction"]["seconds"] * pace - (time.perf_counter() - run["started"])
+        self.registry.set("bdcopy_job_eta_seconds", "実行中のジョブの残り時間の予測", max(remaining, 0.0),
+                          source=os.path.basename(run["features"]["source"]))
+        finish = datetime.now() + timedelta(seconds=remaining)
+        if remaining > 0 and (run.get("finish") is None or abs((finish - run["finish"]).total_seconds()) >= HISTORY_ETA_LOG_SEC):
+            run["finish"] = finish
+            job.log.emit(f"残り約{format_duration(remaining)} (完了予定 {finish.strftime('%H:%M')})")
+
+    def job_done(self, job, run, result, output_path):
+        if run["done"]:
+            return
+        run["done"] = True
+        features = run["features"]
+        wall_sec = time.perf_counter() - run["started"]
+        encode_fps = None
+        encode = next((record for record in run["stages"] if record["name"] == "video_encode" and record.get("ok", True)), None)
+        if encode and features.get("duration_sec") and features["titles"] == 1 and encode["wall_sec"] > 0:
+            fps = float(Fraction(parse_resolution_fps(job.resolution_fps)[2]))
+            encode_fps = round(features["duration_sec"] * fps / encode["wall_sec"], 2)
+        try:
+            output_bytes = path_size(output_path) if output_path else None
+        except OSError:
+            output_bytes = None
+        try:
+            get_job_history().record_job(dict(features, started_at=run["started_at"], wall_sec=round(wall_sec, 3),
+                                              output_bytes=output_bytes, encode_fps=encode_fps, result=result), run["stages"])
+        except sqlite3.Error as e:
+            job.log.emit(f"警告: ジョブ履歴に保存できませんでした: {e}")
+            return
+        self.registry.set("bdcopy_job_eta_seconds", "実行中のジョブの残り時間の予測", 0.0,
+                          source=os.path.basename(features["source"]))
+        if run["prediction"] and result == "ok":
+            job.log.emit(f"所要時間: {format_duration(wall_sec)} (予測 {format_duration(run['prediction']['seconds'])})")
+
+_job_history_recorder = None
+
+def get_job_history_recorder():
+    # GUI スレッドで最初に呼ぶこと (シグナルをGUIスレッドで受けるため)
+    global _job_history_recorder
+    if _job_history_recorder is None:
+        _job_history_recorder = JobHistoryRecorder(get_metrics_registry())
+    return _job_history_recorder
 
 # --- メニュー動画エンコード用Worker ---
+MENU_VIDEO_VERSION = 1 # メニュー動画のエンコード設定を変えたら上げる (前回の menu.m2ts を使わなくなる)
+MENU_VIDEO_KEY_FILE = "menu.m2ts.key"
+
+def menu_video_key(image_path, duration_sec, resolution_fps):
+    """ メニュー動画の内容を決めるもの (画像の中身・長さ・解像度) のハッシュ """
+    digest = hashlib.sha256(f"{MENU_VIDEO_VERSION}|{float(duration_sec)}|{resolution_fps}|".encode('utf-8'))
+    with open(image_path, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def encode_menu_video(image_path, duration_sec, resolution_fps, ffmpeg_path, log, report=None):
+    """
+    メニュー画像から無音付きのメニュー動画 (画像と同じフォルダの menu.m2ts) を作る。
+    同じ画像・設定で作った前回の menu.m2ts があればエンコードせずにそれを返す。
+    """
+    image_path_normalized = image_path.replace('\\', '/')
+    output_dir = os.path.dirname(image_path_normalized)
+    output_path = os.path.join(output_dir, "menu.m2ts").replace('\\', '/')
+    key_path = os.path.join(output_dir, MENU_VIDEO_KEY_FILE)
+    key = menu_video_key(image_path_normalized, duration_sec, resolution_fps)
+    previous_key = None
+    if os.path.exists(output_path) and os.path.exists(key_path):
+        with open(key_path, 'r', encoding='utf-8') as f:
+            previous_key = f.read().strip()
+    if previous_key == key:
+        with pipeline_stage("menu_encode", outputs=[output_path], report=report):
+            note_cache("menu_video", True)
+        log(f"メニュー画像が前回と同じため、メニュー動画を再利用します: {output_path}")
+        return output_path
+    if os.path.exists(key_path):
+        os.remove(key_path) # エンコードが途中で止まった出力を再利用しないよう、先に消す
+
+    # 画像は出力解像度で直接レンダリング済みなので、ここではfpsのみ使う
+    _, _, fps = parse_resolution_fps(resolution_fps)
+    video_args = ['-c:v', 'libx264', '-preset', 'medium', '-crf', '20'] # H.264
+    video_filter = 'format=yuv420p'
+    if is_uhd_output(resolution_fps):
+        # UHD は本編と同じ HEVC 10bit。画像 (sRGB) は BT.709 として YUV にしてから BT.2020 (SDR) に変換する
+        video_args = build_uhd_codec_args({"mode": "crf", "crf": 20}, 'medium', None, resolution_fps)
+        video_filter = f"scale=out_color_matrix=bt709:out_range=tv,format=yuv444p,{bt2020_sdr_filter()}"
+
+    # ★★★ 修正箇所: メニュー動画に *無音の* オーディオトラックを戻す ★★★
+    command = [
+        ffmpeg_path,
+        '-loop', '1', '-i', image_path_normalized, # 画像をループ入力
+        '-f', 'lavfi', '-i', 'anullsrc=channel_layout=stereo:sample_rate=48000', # 仮想的な無音 (復活)
+        *video_args,
+        '-c:a', 'ac3', '-b:a', '448k', # AC-3 (復活)
+        '-t', str(duration_sec), # 動画の長さ
+        '-r', fps, # フレームレート
+        '-vf', video_filter, # ピクセルフォーマット (スケールは不要)
+        # '-an', # 削除
+        '-y', output_path
+    ]
+
+    log(f"メニュー動画エンコード ({duration_sec}秒) を開始します...")
+    log(f"コマンド: {' '.join(command)}")
+    with pipeline_stage("menu_encode", outputs=[output_path], report=report), \
+            get_resource_governor().lease("menu_encode") as cpu:
+        note_cache("menu_video", False)
+        command[1:1] = ['-threads', str(cpu.threads)] # 静止画なので少ないスレッドで足りる
+        command[-2:-2] = ['-threads', str(cpu.threads)]
+        log(f"CPU割り当て: {cpu.describe()}")
+        returncode, _ = run_command(command, log=log, cpu=cpu)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+    with open(key_path, 'w', encoding='utf-8') as f:
+        f.write(key)
+    return output_path
+
 class MenuEncoderWorker(QRunnable):
     def __init__(self, image_path, duration_sec, resolution_fps, ffmpeg_path):
         super().__init__()
@@ -303,54 +4681,36 @@ class MenuEncoderWorker(QRunnable):
              self.signals.error.emit("ffmpeg実行ファイルが見つかりませんでした。")
              return
         try:
-            image_path_normalized = self.image_path.replace('\\', '/')
-            output_dir = os.path.dirname(image_path_normalized)
-            output_path = os.path.join(output_dir, "menu.m2ts").replace('\\', '/')
-
-            res, fps = "1920x1080", "23.976" # デフォルト
-            if self.resolution_fps:
-                res_part, fps_part = self.resolution_fps.split(':')
-                if res_part: res = res_part
-                if fps_part: fps = fps_part
-
-            # ★★★ 修正箇所: メニュー動画に *無音の* オーディオトラックを戻す ★★★
-            command = [
-                self.ffmpeg_path,
-                '-loop', '1', '-i', image_path_normalized, # 画像をループ入力
-                '-f', 'lavfi', '-i', 'anullsrc=channel_layout=stereo:sample_rate=48000', # 仮想的な無音 (復活)
-                '-c:v', 'libx264', '-preset', 'medium', '-crf', '20', # H.264
-                '-c:a', 'ac3', '-b:a', '448k', # AC-3 (復活)
-                '-t', str(self.duration_sec), # 動画の長さ
-                '-r', fps, # フレームレート
-                '-vf', f'scale={res},format=yuv420p', # 解像度とピクセルフォーマット
-                # '-an', # 削除
-                '-y', output_path
-            ]
-
-            self.signals.log.emit(f"メニュー動画エンコード ({self.duration_sec}秒) を開始します...")
-            self.signals.log.emit(f"コマンド: {' '.join(command)}")
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
-            for line in process.stdout:
-                self.signals.log.emit(line.strip())
-            process.wait()
-
-            if process.returncode == 0:
-                self.signals.finished.emit(output_path)
-            else:
-                error_cmd = ' '.join(command)
-                raise subprocess.CalledProcessError(process.returncode, error_cmd)
+            output_path = encode_menu_video(self.image_path, self.duration_sec, self.resolution_fps, self.ffmpeg_path,
+                                            self.signals.log.emit, report=self.signals.stage.emit)
+            self.signals.finished.emit(output_path)
         except Exception as e:
             self.signals.error.emit(f"メニュー動画エンコード失敗: {str(e)}")
 
 class EncoderWorker(QRunnable):
-    def __init__(self, video_path, chapters, encoder, resolution_fps, ffmpeg_path):
+    def __init__(self, video_path, chapters, encoder, resolution_fps, ffmpeg_path, prefilters=None, rate_control=None,
+                 preset='medium', threads=None, output_dir=None, coordinator=None, secondary_outputs=(), min_threads=None,
+                 probe=None):
         super().__init__()
         self.signals = WorkerSignals()
         self.video_path = video_path
+        self.output_dir = output_dir # None ならソースと同じフォルダ
+        self.coordinator = coordinator # EncodeCoordinator があればエージェントに分散してエンコードする
         self.chapters = chapters
         self.encoder_option = encoder
         self.resolution_fps = resolution_fps
         self.ffmpeg_path = ffmpeg_path
+        self.prefilters = [f for f in (prefilters or []) if f] # 事前解析で決まったフィルタ (デインターレース, クロップ)
+        self.rate_control = rate_control # None なら CRF 20 固定
+        self.preset = preset
+        self.threads = threads
+        self.min_threads = min_threads # 複数タイトルの並行エンコードでは、この数が空くまで待ってから始める
+        self.secondary_outputs = list(secondary_outputs) # 同じデコードから作る追加出力 (SECONDARY_OUTPUTS の名前)
+        self.probe = probe # UHD で HDR10 のメタデータを引き継ぎ、並行エンコードのセグメントを決めるのに使う
+
+    def codec_args(self, threads):
+        return build_video_codec_args(self.encoder_option, self.rate_control, self.preset, threads,
+                                      self.resolution_fps, source_video_stream(self.probe))
 
     def run(self):
         if not self.ffmpeg_path:
@@ -358,67 +4718,433 @@ class EncoderWorker(QRunnable):
              return
         try:
             video_path_normalized = self.video_path.replace('\\', '/')
-            output_dir = os.path.dirname(video_path_normalized)
+            output_dir = self.output_dir or os.path.dirname(video_path_normalized)
             base_name = os.path.basename(video_path_normalized)
             file_name, _ = os.path.splitext(base_name)
             output_path = os.path.join(output_dir, f"encoded_video.m2ts").replace('\\', '/')
             
             # EncoderWorkerではチャプターメタデータを生成・使用しない (前回の修正)
-            
-            scale_filter = ""
-            fps_option = []
-            if self.resolution_fps:
-                res, fps = self.resolution_fps.split(':')
-                
-                # padフィルターの解像度指定を 'x' から ':' に変更
-                pad_res = res.replace('x', ':') # '1920x1080' を '1920:1080' に変換
-                scale_filter = f"scale={res}:force_original_aspect_ratio=decrease,pad={pad_res}:(ow-iw)/2:(oh-ih)/2"
-                
-                fps_option = ['-r', fps] if fps else []
-
 
             # FFmpegコマンドからチャプター関連の入力を削除 (前回の修正)
-            command = [
-                self.ffmpeg_path,
-                '-i', video_path_normalized, 
-                '-map', '0:v:0', '-map', '0:a:0', 
-            ]
-            if scale_filter: command.extend(['-vf', scale_filter])
-            command.extend(fps_option)
-
-            # エンコーダによって品質オプション (-crf または -cq) を切り替える
-            command.extend(['-c:v', self.encoder_option, '-preset', 'medium'])
-
-            if self.encoder_option == 'libx264':
-                command.extend(['-crf', '20'])
-            elif self.encoder_option in ['h264_nvenc', 'h264_amf', 'h264_qsv']:
-                command.extend(['-cq', '20']) 
-            else:
-                command.extend(['-crf', '20'])
-
-            # 音声を 48kHz (Blu-ray規格) にリサンプルする
-            command.extend([
-                '-pix_fmt', 'yuv420p',
-                '-c:a', 'ac3', '-b:a', '448k',
-                '-ar', '48000', # Blu-ray規格 (48kHz) にリサンプル
-                '-y', output_path
-            ])
-            
-            self.signals.log.emit(f"FFmpeg本編エンコード({self.encoder_option}, {self.resolution_fps if self.resolution_fps else 'original'})を開始します...")
-            self.signals.log.emit(f"コマンド: {' '.join(command)}")
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
-            for line in process.stdout:
-                self.signals.log.emit(line.strip())
-            process.wait()
-            
-            if process.returncode == 0:
+            # 音声は AudioEncoderWorker が別プロセスでエレメンタリストリームとして処理する
+            if self.coordinator and uses_vbv(self.rate_control, self.resolution_fps):
+                # 別々のエンコーダで作ったセグメントでは継ぎ目で VBV のバッファ状態が引き継がれず、
+                # BD のバッファモデルを守れる保証がないので、上限付きVBR と UHD は1本のエンコーダでエンコードする
+                self.signals.log.emit("注意: ビットレートの上限 (VBV) を守るため、分散エンコードせずこのマシンの1本のエンコーダで"
+                                      "エンコードします。")
+            elif self.coordinator:
+                if self.secondary_outputs:
+                    self.signals.log.emit("警告: 分散エンコードでは追加出力 (プロキシなど) を作成しません。")
+                encode_args = build_video_filter_args(self.resolution_fps, self.prefilters)
+                encode_args.extend(self.codec_args(self.threads))
+                self.run_distributed(video_path_normalized, encode_args, output_path)
+                return
+            encoder = video_encoder_for(self.encoder_option, self.resolution_fps)
+            # プリセットのベンチマークで決まったスレッド数があれば、それを上限に予算から割り当てる
+            with pipeline_stage("video_encode", outputs=[output_path], report=self.signals.stage.emit), \
+                    get_resource_governor().lease("video_encode", max_threads=self.threads, min_threads=self.min_threads) as cpu:
+                codec_args = self.codec_args(cpu.threads)
+                command = [
+                    self.ffmpeg_path,
+                    '-threads', str(cpu.threads), # デコード
+                    '-i', video_path_normalized,
+                ]
+                secondary_paths = {}
+                if self.secondary_outputs:
+                    # 1回のデコードを split で本編と追加出力に分ける
+                    command.extend(['-filter_complex_threads', str(cpu.threads)])
+                    output_args, secondary_paths = build_multi_output_args(
+                        self.resolution_fps, self.prefilters, codec_args, output_path, self.secondary_outputs,
+                        output_dir, self.chapters, cpu.threads)
+                    command.extend(output_args)
+                else:
+                    command.extend(['-map', '0:v:0', '-filter_threads', str(cpu.threads)])
+                    command.extend(build_video_filter_args(self.resolution_fps, self.prefilters))
+                    command.extend(codec_args)
+                    command.extend([
+                        '-an', # 映像のみ
+                        '-y', output_path
+                    ])
+
+                self.signals.log.emit(f"FFmpeg本編映像エンコード({encoder} {self.preset}, {self.resolution_fps if self.resolution_fps else 'original'})を開始します...")
+                self.signals.log.emit(f"CPU割り当て: {cpu.describe()}")
+                self.signals.log.emit(f"コマンド: {' '.join(command)}")
+                returncode, _ = run_command(command, log=self.signals.log.emit, cpu=cpu)
+
+            if returncode == 0:
+                if secondary_paths:
+                    self.signals.result.emit(self.collect_secondary_outputs(secondary_paths))
                 self.signals.finished.emit(output_path)
             else:
                 error_cmd = ' '.join(command)
-                raise subprocess.CalledProcessError(process.returncode, error_cmd)
+                raise subprocess.CalledProcessError(returncode, error_cmd)
         except Exception as e:
             self.signals.error.emit(str(e))
 
+    def collect_secondary_outputs(self, paths):
+        outputs = dict(paths)
+        if "scene_feed" in paths:
+            json_path = os.path.splitext(paths["scene_feed"])[0] + ".json"
+            changes = parse_scene_changes(paths["scene_feed"], json_path)
+            outputs["scene_feed"] = json_path
+            self.signals.log.emit(f"シーンチェンジ解析: {len(changes)}箇所 (しきい値 {SCENE_CHANGE_THRESHOLD})")
+        for name, path in outputs.items():
+            self.signals.log.emit(f"追加出力 ({SECONDARY_OUTPUTS[name][0]}): {path}")
+        return outputs
+
+    def run_distributed(self, video_path, encode_args, output_path):
+        probe = load_source_probe(video_path, self.ffmpeg_path, log=self.signals.log.emit)
+        fps = parse_resolution_fps(self.resolution_fps)[2] if self.resolution_fps else None
+        if not fps:
+            video = next((st for st in probe["streams"] if st["type"] == "video"), None)
+            fps = (video and video["fps"]) or 23.976
+        self.signals.log.emit(f"FFmpeg本編映像エンコード({video_encoder_for(self.encoder_option, self.resolution_fps)} {self.preset}, 分散)を開始します...")
+        with pipeline_stage("video_encode", outputs=[output_path], report=self.signals.stage.emit):
+            returncode = self.coordinator.encode(video_path, encode_args, output_path, self.ffmpeg_path,
+                                                 probe["duration"], fps, log=self.signals.log.emit)
+        if returncode != 0:
+            raise RuntimeError(f"セグメントの結合に失敗しました (終了コード {returncode})")
+        self.signals.finished.emit(output_path)
+
+class ProbeWorker(QRunnable):
+    """ ソースのストリーム構成を取得する (索引にキャッシュがあればそれを使う) """
+    def __init__(self, video_path, ffmpeg_path, ffprobe_path=None):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.ffmpeg_path = ffmpeg_path
+        self.ffprobe_path = ffprobe_path
+
+    def run(self):
+        try:
+            with pipeline_stage("probe", report=self.signals.stage.emit):
+                probe = load_source_probe(self.video_path, self.ffmpeg_path, self.ffprobe_path, log=self.signals.log.emit)
+            self.signals.result.emit(probe)
+            self.signals.finished.emit(self.video_path)
+        except Exception as e:
+            self.signals.error.emit(f"ソース情報の取得に失敗しました: {e}")
+
+# Blu-rayにそのまま格納できる音声コーデック (48kHz のときのみパススルー)
+PASSTHROUGH_AUDIO_CODECS = {"ac3": ("A_AC3", "ac3"), "dts": ("A_DTS", "dts")}
+
+class SourceAnalysisWorker(QRunnable):
+    """ サンプリングによる事前解析を行う (結果はプローブ索引にキャッシュする) """
+    def __init__(self, video_path, probe, ffmpeg_path):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.probe = probe
+        self.ffmpeg_path = ffmpeg_path
+
+    def run(self):
+        try:
+            with pipeline_stage("analysis", report=self.signals.stage.emit), get_resource_governor().lease("analysis") as cpu:
+                analysis = load_source_analysis(self.video_path, self.ffmpeg_path, self.probe, log=self.signals.log.emit, cpu=cpu)
+            self.signals.log.emit(f"事前解析: 走査={analysis['scan']} (インターレース率 {analysis['interlaced_ratio']:.0%}), "
+                                  f"クロップ={analysis['crop'] or 'なし'}")
+            self.signals.result.emit(analysis)
+        except Exception as e:
+            self.signals.error.emit(f"ソースの事前解析に失敗: {e}")
+
+class PlanningWorker(QRunnable):
+    """
+    メディア容量に収まるレート制御を計画する。
+    probe / prefilters が未指定なら (見積もりボタンから呼ばれた場合) 索引から読み込む。
+    """
+    def __init__(self, video_path, encoder, resolution_fps, media, ffmpeg_path, ffprobe_path=None,
+                 probe=None, prefilters=None, analyze_source=True, menu_duration_sec=10.0,
+                 subtitle_count=0, normalize_loudness=False, preset='medium'):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.encoder = encoder
+        self.resolution_fps = resolution_fps
+        self.media = media
+        self.ffmpeg_path = ffmpeg_path
+        self.ffprobe_path = ffprobe_path
+        self.probe = probe
+        self.prefilters = prefilters
+        self.analyze_source = analyze_source
+        self.menu_duration_sec = menu_duration_sec
+        self.subtitle_count = subtitle_count
+        self.normalize_loudness = normalize_loudness
+        self.preset = preset
+
+    def run(self):
+        try:
+            log = self.signals.log.emit
+            probe = self.probe or load_source_probe(self.video_path, self.ffmpeg_path, self.ffprobe_path, log=log)
+            prefilters = self.prefilters
+            if prefilters is None:
+                prefilters = []
+                if self.analyze_source:
+                    analysis = load_source_analysis(self.video_path, self.ffmpeg_path, probe, log=log)
+                    prefilters = [analysis.get("deinterlace"), analysis.get("crop")]
+                prefilters.append(uhd_color_filter(source_video_stream(probe), self.resolution_fps))
+            prefilters = [f for f in prefilters if f]
+
+            with pipeline_stage("planning", report=self.signals.stage.emit):
+                curve = load_rate_curve(self.video_path, self.ffmpeg_path, probe, self.encoder, self.resolution_fps,
+                                        prefilters, preset=self.preset, log=log)
+
+            plan = plan_bitrate(probe, curve, self.media, self.menu_duration_sec, self.subtitle_count, self.normalize_loudness,
+                                max_bitrate=max_video_bitrate(self.resolution_fps))
+            log(f"容量計画: {describe_plan(plan)}")
+            self.signals.result.emit(plan)
+        except Exception as e:
+            self.signals.error.emit(f"容量計画に失敗: {e}")
+
+class SetPlanningWorker(QRunnable):
+    """ ディスクセット用に、各ソースを1タイトルとして入れたときの大きさを予測する (サンプル結果は索引にキャッシュ) """
+    def __init__(self, sources, encoder, resolution_fps, ffmpeg_path, ffprobe_path=None, preset='medium',
+                 analyze_source=True, normalize_loudness=False):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.sources = list(sources)
+        self.encoder = encoder
+        self.resolution_fps = resolution_fps
+        self.ffmpeg_path = ffmpeg_path
+        self.ffprobe_path = ffprobe_path
+        self.preset = preset
+        self.analyze_source = analyze_source
+        self.normalize_loudness = normalize_loudness
+
+    def run(self):
+        try:
+            log = self.signals.log.emit
+            sizes = []
+            with pipeline_stage("set_planning", report=self.signals.stage.emit):
+                for path in self.sources:
+                    probe = load_source_probe(path, self.ffmpeg_path, self.ffprobe_path, log=log)
+                    prefilters = []
+                    if self.analyze_source:
+                        analysis = load_source_analysis(path, self.ffmpeg_path, probe, log=log)
+                        prefilters = [f for f in (analysis.get("deinterlace"), analysis.get("crop")) if f]
+                    color = uhd_color_filter(source_video_stream(probe), self.resolution_fps)
+                    if color:
+                        prefilters.append(color)
+                    if not prefilters and not bd_copy_problems(probe, self.resolution_fps):
+                        # AuthoringJob.can_copy_video と同じ条件で、再エンコードせずに入るソース
+                        size = predict_title_bytes(probe, None, self.normalize_loudness, source_size=source_video_bytes(probe, path))
+                    else:
+                        curve = load_rate_curve(path, self.ffmpeg_path, probe, self.encoder, self.resolution_fps,
+                                                prefilters, preset=self.preset, log=log)
+                        size = predict_title_bytes(probe, curve, self.normalize_loudness,
+                                                   max_bitrate=max_video_bitrate(self.resolution_fps))
+                    log(f"{os.path.basename(path)}: 予測 {format_size(size)} ({probe['duration'] / 60:.1f}分)")
+                    sizes.append(size)
+            self.signals.result.emit(sizes)
+        except Exception as e:
+            self.signals.error.emit(f"ディスクセットの容量予測に失敗: {e}")
+
+class PresetBenchmarkWorker(QRunnable):
+    """ エンコーダのプリセット/スレッド数を総当たりで計測し、マシンのプロファイルに保存する """
+    def __init__(self, encoder, resolution_fps, ffmpeg_path):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.encoder = encoder
+        self.resolution_fps = resolution_fps
+        self.ffmpeg_path = ffmpeg_path
+
+    def run(self):
+        try:
+            self.signals.log.emit(f"{self.encoder} のプリセットベンチマークを開始します (マシン: {get_machine_id()})...")
+            results = benchmark_encoder_presets(self.ffmpeg_path, self.encoder, self.resolution_fps, log=self.signals.log.emit)
+            save_encoder_profile(self.encoder, self.resolution_fps, results)
+            self.signals.log.emit(f"ベンチマーク結果を保存しました: {get_encoder_profile_path()}")
+            self.signals.finished.emit(get_encoder_profile_path())
+        except Exception as e:
+            self.signals.error.emit(f"プリセットベンチマークに失敗: {e}")
+
+class DriveListWorker(QRunnable):
+    """ 書き込みドライブを列挙する (起動時と一定間隔の更新) """
+    def __init__(self):
+        super().__init__()
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            self.signals.result.emit(enumerate_optical_drives())
+        except Exception as e:
+            self.signals.error.emit(f"ドライブ一覧の取得に失敗: {e}")
+
+class ToolProbeWorker(QRunnable):
+    """ 外部ツールの機能を調べてレジストリに保存する (キャッシュが無い初回やツールの更新後に使う) """
+    def __init__(self, name, path, refresh=False):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.name = name
+        self.path = path
+        self.refresh = refresh
+
+    def run(self):
+        try:
+            capabilities = get_tool_registry().capabilities(self.name, self.path, refresh=self.refresh)
+            self.signals.result.emit(capabilities)
+        except Exception as e:
+            self.signals.error.emit(f"{self.name} の機能の確認に失敗しました: {e}")
+
+class VerificationWorker(QRunnable):
+    """ エンコード済み本編をソースと比較する。mux と並行に走らせる """
+    def __init__(self, encoded_path, video_path, probe, resolution_fps, chapters, ffmpeg_path, prefilters=None):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.encoded_path = encoded_path
+        self.video_path = video_path
+        self.probe = probe
+        self.resolution_fps = resolution_fps
+        self.chapters = chapters
+        self.ffmpeg_path = ffmpeg_path
+        self.prefilters = prefilters
+
+    def run(self):
+        try:
+            with pipeline_stage("verification", report=self.signals.stage.emit), get_resource_governor().lease("verification") as cpu:
+                result = verify_encode(self.ffmpeg_path, self.encoded_path, self.video_path, self.probe,
+                                       self.resolution_fps, self.chapters, self.prefilters, log=self.signals.log.emit, cpu=cpu)
+            self.signals.result.emit(result)
+        except Exception as e:
+            self.signals.error.emit(f"品質検証に失敗: {e}")
+
+class LoudnessAnalysisWorker(QRunnable):
+    """
+    音声トラック1本のラウドネスを測定する (loudnorm の1パス目)。
+    音声ストリームだけをマップするので映像はデコードしない。結果はプローブ索引に保存する。
+    """
+    def __init__(self, video_path, audio_index, ffmpeg_path):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.audio_index = audio_index
+        self.ffmpeg_path = ffmpeg_path
+
+    def measure(self):
+        target = f"I={LOUDNORM_TARGET['I']}:TP={LOUDNORM_TARGET['TP']}:LRA={LOUDNORM_TARGET['LRA']}"
+        command = [self.ffmpeg_path, '-hide_banner', '-nostats', '-threads', '1', '-i', self.video_path.replace('\\', '/'),
+                   '-map', f'0:a:{self.audio_index}', '-vn', '-sn', '-dn',
+                   '-af', f'loudnorm={target}:print_format=json', '-f', 'null', '-']
+        self.signals.log.emit(f"音声トラック {self.audio_index} のラウドネスを測定しています...")
+        self.signals.log.emit(f"コマンド: {' '.join(command)}")
+        with get_resource_governor().lease("loudness") as cpu:
+            returncode, lines = run_command(command, capture=True, cpu=cpu)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ' '.join(command))
+        # loudnorm は最後に JSON ブロックを出力する
+        start = max(i for i, line in enumerate(lines) if line.startswith('{'))
+        end = next(i for i in range(start, len(lines)) if lines[i].startswith('}'))
+        return json.loads('\n'.join(lines[start:end + 1]))
+
+    def run(self):
+        try:
+            index = get_source_probe_index()
+            key = loudnorm_target_key(self.audio_index)
+            entry = index.get(self.video_path) or {}
+            measured = entry.get("loudness", {}).get(key)
+            with pipeline_stage(f"loudness_{self.audio_index}", report=self.signals.stage.emit):
+                note_cache("loudness", measured)
+                if measured:
+                    self.signals.log.emit(f"音声トラック {self.audio_index} のラウドネス測定値を索引から再利用します (I={measured['input_i']} LUFS)。")
+                else:
+                    measured = self.measure()
+                    index.update_section(self.video_path, "loudness", key, measured)
+                    self.signals.log.emit(f"音声トラック {self.audio_index}: I={measured['input_i']} LUFS, TP={measured['input_tp']} dBTP, LRA={measured['input_lra']} LU")
+            self.signals.result.emit({"audio_index": self.audio_index, "measured": measured})
+        except Exception as e:
+            self.signals.error.emit(f"音声トラック {self.audio_index} のラウドネス測定に失敗: {e}")
+
+class AudioEncoderWorker(QRunnable):
+    """ 音声トラック1本をエレメンタリストリームとして書き出す (AC-3/DTSはパススルー) """
+    def __init__(self, video_path, audio_index, track_info, output_dir, ffmpeg_path, loudnorm_filter=None):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.audio_index = audio_index # 音声ストリーム内での番号 (0:a:N の N)
+        self.track_info = track_info
+        self.output_dir = output_dir
+        self.ffmpeg_path = ffmpeg_path
+        self.loudnorm_filter = loudnorm_filter
+        # 正規化する場合は再エンコードが必要
+        self.passthrough = (not loudnorm_filter
+                            and track_info.get("codec") in PASSTHROUGH_AUDIO_CODECS
+                            and track_info.get("sample_rate") in (0, 48000))
+        ext = PASSTHROUGH_AUDIO_CODECS[track_info["codec"]][1] if self.passthrough else "ac3"
+        self.output_path = os.path.join(output_dir, f"audio_{audio_index}.{ext}").replace('\\', '/')
+
+    def run(self):
+        try:
+            command = [self.ffmpeg_path, '-threads', '1', '-i', self.video_path.replace('\\', '/'),
+                       '-map', f'0:a:{self.audio_index}', '-vn', '-sn', '-dn']
+            if self.passthrough:
+                command.extend(['-c:a', 'copy', '-f', PASSTHROUGH_AUDIO_CODECS[self.track_info["codec"]][1]])
+            else:
+                channels = self.track_info.get("channels") or 2
+                if self.loudnorm_filter:
+                    command.extend(['-af', self.loudnorm_filter])
+                command.extend(['-c:a', 'ac3', '-b:a', '640k' if channels > 2 else '448k',
+                                '-ar', '48000', # Blu-ray規格 (48kHz) にリサンプル
+                                '-ac', str(min(channels, 6)), '-f', 'ac3'])
+            command.extend(['-y', self.output_path])
+
+            mode = "パススルー" if self.passthrough else ("ラウドネス正規化 + AC-3エンコード" if self.loudnorm_filter else "AC-3エンコード")
+            self.signals.log.emit(f"音声トラック {self.audio_index} ({self.track_info.get('language', 'und')}, {mode}) を開始します...")
+            self.signals.log.emit(f"コマンド: {' '.join(command)}")
+            with pipeline_stage(f"audio_encode_{self.audio_index}", outputs=[self.output_path], report=self.signals.stage.emit), \
+                    get_resource_governor().lease("audio_encode") as cpu:
+                returncode, _ = run_command(command, log=self.signals.log.emit, cpu=cpu)
+            if returncode == 0:
+                self.signals.finished.emit(self.output_path)
+            else:
+                raise subprocess.CalledProcessError(returncode, ' '.join(command))
+        except Exception as e:
+            self.signals.error.emit(f"音声トラック {self.audio_index} の処理に失敗: {e}")
+
+class SubtitleRenderWorker(QRunnable):
+    """
+    SRT/ASS 字幕をメニューのフォントで描画し、PGS (.sup) を生成する。
+    イベントのビットマップ化と RLE 符号化はプロセスプールに分散する。
+    """
+    CHUNK_SIZE = 64
+
+    def __init__(self, subtitle_path, output_path, resolution_fps, font_family,
+                 fill_color="#ffffff", outline_color="#000000"):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.subtitle_path = subtitle_path
+        self.output_path = output_path
+        self.resolution_fps = resolution_fps
+        self.font_family = font_family
+        self.fill_color = fill_color
+        self.outline_color = outline_color
+
+    def run(self):
+        try:
+            video_width, video_height = graphics_plane_size(self.resolution_fps)
+            events = parse_subtitle_file(self.subtitle_path)
+            if not events:
+                raise RuntimeError("字幕イベントが見つかりませんでした。")
+            pixel_size = max(16, int(round(video_height * 0.055)))
+            outline = max(2, pixel_size // 14)
+            chunks = [events[i:i + self.CHUNK_SIZE] for i in range(0, len(events), self.CHUNK_SIZE)]
+            workers = max(1, min(len(chunks), (os.cpu_count() or 2) - 1))
+            self.signals.log.emit(f"字幕 {os.path.basename(self.subtitle_path)} ({len(events)}イベント) を {workers}プロセスで描画しています...")
+
+            rendered = []
+            with pipeline_stage(os.path.splitext(os.path.basename(self.output_path))[0], outputs=[self.output_path],
+                                report=self.signals.stage.emit):
+                # Qt のスレッドを抱えたプロセスを fork しないよう spawn を使う
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    futures = [pool.submit(_render_subtitle_chunk, chunk, self.font_family, pixel_size, outline,
+                                           video_width, video_height) for chunk in chunks]
+                    for future in futures:
+                        rendered.extend(future.result())
+
+                write_pgs_file(self.output_path, rendered, build_subtitle_palette(self.fill_color, self.outline_color),
+                               video_width, video_height)
+            self.signals.log.emit(f"PGS字幕を書き出しました: {self.output_path}")
+            self.signals.finished.emit(self.output_path)
+        except Exception as e:
+            self.signals.error.emit(f"字幕 {self.subtitle_path} の変換に失敗: {e}")
+
 class AuthoringWorker(QRunnable):
     def __init__(self, tsmuxer_path, meta_path, output_path):
         super().__init__()
@@ -442,77 +5168,1016 @@ class AuthoringWorker(QRunnable):
             command = [self.tsmuxer_path, self.meta_path, self.output_path]
             self.signals.log.emit("tsMuxeRによるオーサリング (ISO生成) を開始します...")
             self.signals.log.emit(f"コマンド: {' '.join(command)}")
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
-            for line in process.stdout:
-                self.signals.log.emit(line.strip())
-            process.wait()
+            with pipeline_stage("mux", outputs=[self.output_path], report=self.signals.stage.emit):
+                returncode, _ = run_command(command, log=self.signals.log.emit)
             # メタファイルは成功しても失敗しても削除
             if os.path.exists(self.meta_path):
                  os.remove(self.meta_path)
 
-            if process.returncode == 0:
+            if returncode == 0:
                 self.signals.finished.emit(self.output_path)
             else:
-                raise subprocess.CalledProcessError(process.returncode, command)
+                raise subprocess.CalledProcessError(returncode, command)
         except Exception as e:
             if os.path.exists(self.meta_path):
                  os.remove(self.meta_path)
             self.signals.error.emit(f"tsMuxeRの実行に失敗しました: {e}")
 
+class BdmvAuthoringWorker(QRunnable):
+    """
+    BDMV フォルダを作る。メニューと各タイトルの本編を別々のクリップとして mux し、本編クリップはキャッシュする。
+    clips は [(クリップ番号, .meta または None, キャッシュ先フォルダ), ...] で、.meta が None ならキャッシュ済みの
+    クリップを再利用する (メニューだけを mux し直す)。iso_path を渡すと最後に ISO にまとめる。
+    menu_ig (IgMenuWorker の出力) を渡すと、メニュークリップに IG を入れてボタンで選べるメニューにする。
+    """
+    def __init__(self, tsmuxer_path, menu_meta, clips, output_folder, iso_path=None, menu_ig=None):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.tsmuxer_path = tsmuxer_path
+        self.menu_meta = menu_meta
+        self.clips = list(clips)
+        self.output_folder = output_folder
+        self.iso_path = iso_path
+        self.menu_ig = menu_ig
+
+    def mux(self, meta_path, output_path):
+        shutil.rmtree(output_path, ignore_errors=True)
+        command = [self.tsmuxer_path, meta_path, output_path]
+        self.signals.log.emit(f"コマンド: {' '.join(command)}")
+        try:
+            returncode, _ = run_command(command, log=self.signals.log.emit)
+        finally:
+            os.remove(meta_path)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    def run(self):
+        menu_folder = os.path.join(os.path.dirname(self.output_folder), "bdmv_menu.partial")
+        try:
+            for number, meta, clip_dir in self.clips:
+                if meta:
+                    self.signals.log.emit(f"tsMuxeRで本編クリップ {number} を作成します (次回からは再利用します)...")
+                    with pipeline_stage("mux_feature", outputs=[clip_dir], report=self.signals.stage.emit):
+                        note_cache("bdmv_clip", False)
+                        self.mux(meta, clip_dir + ".partial")
+                        os.replace(clip_dir + ".partial", clip_dir)
+                    prune_bdmv_clip_cache(os.path.dirname(clip_dir))
+                else:
+                    os.utime(clip_dir) # 使った順に残す
+            self.signals.log.emit("tsMuxeRでメニュークリップを作成します...")
+            with pipeline_stage("mux_menu", outputs=[menu_folder], report=self.signals.stage.emit):
+                note_cache("bdmv_clip", all(meta is None for _, meta, _ in self.clips))
+                self.mux(self.menu_meta, menu_folder)
+            numbers = [number for number, _, _ in self.clips]
+            if self.menu_ig:
+                with pipeline_stage("ig_mux", outputs=[menu_folder], report=self.signals.stage.emit):
+                    packets = add_ig_to_clip(menu_folder, BDMV_MENU_CLIP, self.menu_ig)
+                self.signals.log.emit(f"メニュークリップに IG ストリームを入れました ({packets}パケット)。")
+                # メニューは最後の画で止まってボタンを待ち、タイトル N は本編 N だけを再生する
+                playlist_objects = [[BDMV_MENU_CLIP]] + [[number] for number in numbers]
+                title_objects = list(range(1, len(numbers) + 1))
+            else:
+                # タイトル1はメニュー → 全タイトルを順に再生し、タイトル2以降は各本編のみを再生する
+                playlist_objects = [[BDMV_MENU_CLIP] + numbers] + [[number] for number in numbers]
+                title_objects = None
+            with pipeline_stage("bdmv_assemble", outputs=[self.output_folder], report=self.signals.stage.emit):
+                methods = assemble_bdmv_folder(self.output_folder, [menu_folder] + [clip_dir for _, _, clip_dir in self.clips],
+                                               playlist_objects, title_objects)
+                shutil.rmtree(menu_folder, ignore_errors=True)
+                problems = check_bdmv_structure(scan_bdmv_folder(self.output_folder), 0)
+            if problems:
+                raise RuntimeError("BDMV フォルダの構造に問題があります:\n" + "\n".join(problems))
+            self.signals.log.emit(f"BDMV フォルダを作成しました: {self.output_folder} "
+                                  f"(ストリーム: {', '.join(f'{m} {n}本' for m, n in sorted(methods.items()))})")
+            if self.iso_path:
+                self.signals.log.emit("BDMV フォルダを ISO にまとめます...")
+                with pipeline_stage("iso_pack", outputs=[self.iso_path], report=self.signals.stage.emit):
+                    pack_bdmv_iso(self.output_folder, self.iso_path, log=self.signals.log.emit)
+            self.signals.finished.emit(self.iso_path or self.output_folder)
+        except Exception as e:
+            for _, _, clip_dir in self.clips:
+                shutil.rmtree(clip_dir + ".partial", ignore_errors=True)
+            shutil.rmtree(menu_folder, ignore_errors=True)
+            self.signals.error.emit(f"BDMV フォルダの作成に失敗しました: {e}")
+
+class IgMenuWorker(QRunnable):
+    """
+    メニューのボタンから IG ストリーム (各ボタンの通常・選択・決定の3状態、上下左右の移動先、押したときのコマンド) を作る。
+    buttons は get_item_properties の形式 (シーン座標) に "text" を加えたもの。
+    """
+    def __init__(self, buttons, chapters, resolution_fps, fps_str, output_path):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.buttons = [dict(button) for button in buttons]
+        self.chapters = list(chapters)
+        self.resolution_fps = resolution_fps
+        self.fps_str = fps_str
+        self.output_path = output_path
+
+    def run(self):
+        try:
+            if not self.buttons:
+                raise ValueError("メニューにボタンがありません")
+            width, height = graphics_plane_size(self.resolution_fps)
+            scale_x, scale_y = width / MENU_LAYOUT_WIDTH, height / MENU_LAYOUT_HEIGHT
+            rects, states = [], []
+            for button in self.buttons:
+                # 出力解像度での位置と大きさ (画面からはみ出す分は切り詰める)
+                x = min(max(0, int(round(button["pos_x"] * scale_x))), width - 1)
+                y = min(max(0, int(round(button["pos_y"] * scale_y))), height - 1)
+                w = max(1, min(int(round(button["width"] * scale_x)), width - x))
+                h = max(1, min(int(round(button["height"] * scale_y)), height - y))
+                rects.append((x, y, w, h))
+                # 切り詰めた分は描画範囲 (シーン座標) も合わせる
+                properties = dict(button, width=w / scale_x, height=h / scale_y)
+                states += [(ig_state_properties(properties, state), w, h) for state in IG_STATES]
+            with pipeline_stage("ig_menu", outputs=[self.output_path], report=self.signals.stage.emit):
+                palette, objects = render_ig_objects(states, log=self.signals.log.emit)
+                buttons = [{"x": x, "y": y, "neighbors": neighbors,
+                            "command": ig_button_command(button.get("time_str"), self.chapters)}
+                           for (x, y, _, _), neighbors, button in zip(rects, ig_button_neighbors(rects), self.buttons)]
+                write_ig_file(self.output_path, build_ig_segments(width, height, self.fps_str, buttons, palette, objects))
+            self.signals.log.emit(f"IG メニューを作成しました: ボタン{len(buttons)}個, {len(palette)}色 ({self.output_path})")
+            self.signals.finished.emit(self.output_path)
+        except Exception as e:
+            self.signals.error.emit(f"IG メニューの作成に失敗: {e}")
+
+class TitleJoinWorker(QRunnable):
+    """
+    複数のファイルに分かれたタイトルを1本にまとめる。
+    パートの形式 (コーデック・解像度・フレームレート・音声) が揃っていれば concat でストリームコピーし、
+    揃っていなければ先頭のパートに合わせて変換しながら中間ファイルに書き出す。
+    結果は {"path", "method", "boundaries" (各パートの開始秒)} を result で通知する。
+    """
+    def __init__(self, sources, output_dir, ffmpeg_path, ffprobe_path=None):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.sources = list(sources)
+        self.output_dir = output_dir
+        self.ffmpeg_path = ffmpeg_path
+        self.ffprobe_path = ffprobe_path
+
+    def run(self):
+        output_path = os.path.join(self.output_dir, "title_joined.mkv").replace('\\', '/')
+        try:
+            log = self.signals.log.emit
+            probes = [load_source_probe(path, self.ffmpeg_path, self.ffprobe_path, log=log) for path in self.sources]
+            boundaries = [0.0]
+            for probe in probes[:-1]:
+                boundaries.append(boundaries[-1] + probe["duration"])
+            os.makedirs(self.output_dir, exist_ok=True)
+            with pipeline_stage("title_join", outputs=[output_path], report=self.signals.stage.emit):
+                if len({title_join_key(probe) for probe in probes}) == 1:
+                    method = "copy"
+                    log(f"{len(self.sources)}個のパートは形式が揃っているため、再エンコードせずに連結します...")
+                    returncode = self.join_copy(output_path)
+                else:
+                    method = "transcode"
+                    log(f"{len(self.sources)}個のパートは形式が異なるため、先頭のパートに合わせて変換しながら連結します...")
+                    returncode = self.join_transcode(probes, output_path)
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg の終了コード {returncode}")
+            self.signals.result.emit({"path": output_path, "method": method, "boundaries": boundaries})
+            self.signals.finished.emit(output_path)
+        except Exception as e:
+            self.signals.error.emit(f"タイトルのパートの連結に失敗しました: {e}")
+
+    def join_copy(self, output_path):
+        list_path = os.path.join(self.output_dir, "title_parts.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for path in self.sources:
+                f.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+        command = [self.ffmpeg_path, '-hide_banner', '-f', 'concat', '-safe', '0', '-i', list_path,
+                   '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', '-y', output_path]
+        self.signals.log.emit(f"コマンド: {' '.join(command)}")
+        returncode, _ = run_command(command, log=self.signals.log.emit)
+        os.remove(list_path)
+        return returncode
+
+    def join_transcode(self, probes, output_path):
+        video = next(st for st in probes[0]["streams"] if st["type"] == "video")
+        audio = [next((st for st in probe["streams"] if st["type"] == "audio"), None) for probe in probes]
+        with_audio = all(audio)
+        if not with_audio and any(audio):
+            self.signals.log.emit("警告: 音声の無いパートがあるため、連結したタイトルは映像のみになります。")
+        width, height = video["width"], video["height"]
+        # 10bit や HDR のパートは 10bit のまま、色の情報 (BT.2020 / PQ など) も引き継ぐ (UHD の HDR10 をそのまま出すため)
+        hdr = video["color_transfer"] in UHD_PASSTHROUGH_TRANSFERS or video["color_primaries"] == "bt2020"
+        deep = hdr or bool(re.search(r'p1[02]', video["pix_fmt"] or ""))
+        pix_fmt = "yuv420p10le" if deep else "yuv420p"
+        layout = AUDIO_CHANNEL_LAYOUTS.get(audio[0]["channels"], "stereo") if with_audio else None
+        chains, inputs = [], ""
+        for i in range(len(probes)):
+            chains.append(f"[{i}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                          f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={video['fps']:.6f},format={pix_fmt}[v{i}]")
+            inputs += f"[v{i}]"
+            if with_audio:
+                chains.append(f"[{i}:a:0]aresample=48000,aformat=sample_rates=48000:channel_layouts={layout}[a{i}]")
+                inputs += f"[a{i}]"
+        chains.append(f"{inputs}concat=n={len(probes)}:v=1:a={int(with_audio)}[v]" + ("[a]" if with_audio else ""))
+        with get_resource_governor().lease("title_join") as cpu:
+            command = [self.ffmpeg_path, '-hide_banner']
+            for path in self.sources:
+                command.extend(['-threads', str(cpu.threads), '-i', path.replace('\\', '/')])
+            command.extend(['-filter_complex', ';'.join(chains), '-filter_complex_threads', str(cpu.threads), '-map', '[v]'])
+            if with_audio:
+                command.extend(['-map', '[a]', '-c:a', 'flac'])
+            if deep:
+                params = []
+                if video["color_transfer"] == HDR10_TRANSFER:
+                    params.append("hdr10=1")
+                    if video.get("mastering_display"):
+                        params.append(f"master-display={x265_master_display(video['mastering_display'])}")
+                    if video.get("content_light"):
+                        params.append(f"max-cll={video['content_light']['max_cll']},{video['content_light']['max_fall']}")
+                command.extend(['-c:v', UHD_VIDEO_ENCODER, '-preset', 'veryfast', '-crf', str(TITLE_JOIN_CRF),
+                                '-profile:v', 'main10', '-pix_fmt', pix_fmt])
+                if params:
+                    command.extend(['-x265-params', ':'.join(params)])
+            else:
+                command.extend(['-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(TITLE_JOIN_CRF)])
+            for option, key in (('-color_primaries', "color_primaries"), ('-color_trc', "color_transfer"),
+                                ('-colorspace', "color_space")):
+                if video[key]:
+                    command.extend([option, video[key]])
+            command.extend(['-threads', str(cpu.threads), '-y', output_path])
+            self.signals.log.emit(f"コマンド: {' '.join(command)}")
+            returncode, _ = run_command(command, log=self.signals.log.emit, cpu=cpu)
+        return returncode
+
+class StreamCopyWorker(QRunnable):
+    """ BD の規格に収まっている本編映像を、再エンコードせずに取り出す (EncoderWorker の代わり) """
+    def __init__(self, video_path, output_dir, ffmpeg_path):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.video_path = video_path
+        self.output_dir = output_dir
+        self.ffmpeg_path = ffmpeg_path
+
+    def run(self):
+        output_path = os.path.join(self.output_dir, "encoded_video.m2ts").replace('\\', '/')
+        command = [self.ffmpeg_path, '-hide_banner', '-i', self.video_path.replace('\\', '/'),
+                   '-map', '0:v:0', '-c:v', 'copy', '-an', '-sn', '-y', output_path]
+        try:
+            self.signals.log.emit("本編映像は BD の規格に収まっているため、再エンコードせずにコピーします...")
+            self.signals.log.emit(f"コマンド: {' '.join(command)}")
+            with pipeline_stage("video_copy", outputs=[output_path], report=self.signals.stage.emit):
+                returncode, _ = run_command(command, log=self.signals.log.emit)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ' '.join(command))
+            self.signals.finished.emit(output_path)
+        except Exception as e:
+            self.signals.error.emit(f"本編映像のコピーに失敗しました: {e}")
+
+class IsoCheckWorker(QRunnable):
+    """
+    tsMuxeR が書いている ISO をチャンクごとにハッシュし (mux と並行)、書き終わったら UDF の構造を確認する。
+    結果のマニフェストは書き込み後の読み戻し検証に使う。
+    """
+    def __init__(self, iso_path, writer_done, aborted):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.iso_path = iso_path
+        self.writer_done = writer_done # tsMuxeR の終了 (成功・失敗とも) でセットされる
+        self.aborted = aborted # ジョブの失敗でセットされる
+
+    def run(self):
+        try:
+            with pipeline_stage("iso_hash", report=self.signals.stage.emit):
+                chunks = hash_iso_chunks(self.iso_path, self.writer_done)
+            if self.aborted.is_set():
+                return
+            with pipeline_stage("iso_check", outputs=[get_iso_manifest_path(self.iso_path)], report=self.signals.stage.emit):
+                manifest, problems = check_iso_image(self.iso_path, chunks)
+            self.signals.result.emit({"manifest": manifest, "problems": problems})
+        except Exception as e:
+            self.signals.error.emit(f"ISO の検証に失敗しました: {e}")
+
 class BurnerWorker(QRunnable):
-    def __init__(self, iso_path, drive_id):
+    def __init__(self, iso_path, drive_id, verify=False):
         super().__init__()
         self.signals = WorkerSignals()
         self.iso_path = iso_path
         self.drive_id = drive_id # Windowsでは "E:" など、 macOSでは "disk2" など
+        self.verify = verify # 書き込み後にディスクを読み戻して ISO と比べる
 
     def run(self):
         try:
             command = []
 
-            # OSを判別してコマンドを構築
-            if sys.platform == "win32":
-                # Windows: isoburn.exe を使用
-                if not self.drive_id:
-                    self.signals.error.emit("Windowsでは書き込みドライブ（E:など）の指定が必要です。")
-                    return
-                # isoburn.exe /Q [ドライブ] [ISOパス]
-                command = ['isoburn.exe', '/Q', self.drive_id, self.iso_path]
+            # OSを判別してコマンドを構築
+            if sys.platform == "win32":
+                # Windows: isoburn.exe を使用
+                if not self.drive_id:
+                    self.signals.error.emit("Windowsでは書き込みドライブ（E:など）の指定が必要です。")
+                    return
+                # isoburn.exe /Q [ドライブ] [ISOパス]
+                command = ['isoburn.exe', '/Q', self.drive_id, self.iso_path]
+
+            elif sys.platform == "darwin":
+                # macOS: drutil を使用
+                if not self.drive_id:
+                    self.signals.error.emit("macOSでは書き込みドライブ（disk2など）の指定が必要です。")
+                    return
+                # drutil burn -device [ドライブID] [ISOパス] (読み戻す場合は書き込み後に排出させない)
+                command = ['drutil', 'burn', '-device', self.drive_id]
+                if self.verify:
+                    command.append('-noeject')
+                command.append(self.iso_path)
+
+            else:
+                self.signals.error.emit(f"サポートされていないOSです: {sys.platform}")
+                return
+
+            self.signals.log.emit(f"{sys.platform}用の書き込みコマンドを実行します...")
+            self.signals.log.emit(f"コマンド: {' '.join(command)}")
+
+            with pipeline_stage("burn", report=self.signals.stage.emit):
+                returncode, _ = run_command(command, log=self.signals.log.emit)
+
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
+            if self.verify:
+                self.verify_disc()
+            self.signals.finished.emit(self.iso_path)
+
+        except Exception as e:
+            self.signals.error.emit(f"書き込みに失敗しました: {e}")
+
+    def verify_disc(self):
+        manifest = load_iso_manifest(self.iso_path)
+        if manifest is None:
+            self.signals.log.emit("ISO のマニフェストが無いため、先に ISO のハッシュを計算します...")
+            manifest = write_iso_manifest(self.iso_path, hash_iso_chunks(self.iso_path))
+        with pipeline_stage("readback", report=self.signals.stage.emit):
+            try:
+                device = open_readback_device(self.drive_id, log=self.signals.log.emit)
+            except RuntimeError as e:
+                # 書き込み自体は成功しているので、読めないだけならエラーにしない
+                self.signals.log.emit(f"警告: 読み戻し検証を省略しました: {e}")
+                return
+            with device:
+                mismatches = verify_readback(device, self.iso_path, manifest, log=self.signals.log.emit)
+        if mismatches:
+            ranges = ", ".join(f"{start}-{end}" for start, end in mismatches[:10])
+            raise RuntimeError(f"読み戻し検証で ISO と一致しないセクタがあります: {ranges}"
+                               + (f" ほか {len(mismatches) - 10} 箇所" if len(mismatches) > 10 else ""))
+        self.signals.log.emit(f"読み戻し検証: ディスクの内容は ISO と一致しました ({manifest['digest'][:16]})")
+
+def open_readback_device(target, log=None, timeout_sec=READBACK_OPEN_TIMEOUT_SEC):
+    """ 書き込み直後はドライブがメディアを認識し直すまで読めないことがあるので、読めるまで待つ """
+    deadline = time.monotonic() + timeout_sec
+    while True:
+        try:
+            device = BlockDevice.open(target)
+            if len(device.read(0, ISO_SECTOR_SIZE)) == ISO_SECTOR_SIZE:
+                return device
+            device.close()
+            error = "先頭セクタを読めません"
+        except OSError as e:
+            error = str(e)
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"読み戻しのためにドライブを開けません ({target}): {error}")
+        if log:
+            log(f"ドライブの準備を待っています ({error})...")
+        time.sleep(5)
+
+
+# --- オーサリングジョブ (エンコード → Mux の段取り) ---
+class AuthoringJob(QObject):
+    """
+    1枚のディスクのオーサリング手順を管理する。
+    メニュー動画・本編映像・各音声トラックを並行にエンコードし、
+    すべて揃ったら tsMuxeR 用の .meta を生成して ISO を作成する。
+    titles を渡すと、タイトルごとに本編だけを担当する子ジョブ (feature_only) を並行に走らせ、
+    メニューとすべてのタイトルのクリップを1つの BDMV にまとめる。
+    """
+    log = Signal(str)
+    started = Signal()
+    finished = Signal(str)
+    error = Signal(str)
+    plan_ready = Signal(object) # 容量計画 (エンコード開始前に通知)
+    stage = Signal(object) # 処理段階の記録 (子ジョブの分も含む。ジョブ履歴用)
+    source_ready = Signal(object) # プローブしたソースの長さと解像度 (所要時間の予測用)
+
+    def __init__(self, video_path, chapters, menu_image_path, encoder, resolution_fps,
+                 ffmpeg_path, tsmuxer_path, ffprobe_path=None, menu_duration_sec=10.0,
+                 normalize_loudness=False, subtitle_tracks=None, subtitle_font_family="Arial",
+                 analyze_source=True, media_target=None, preset='medium', threads=None,
+                 verify_ssim_floor=None, check_iso=True, output_format="iso", secondary_outputs=(), trace=None,
+                 output_dir=None, coordinator=None, threadpool=None, titles=None, sources=None,
+                 clip_number=BDMV_FEATURE_CLIP, feature_only=False, min_threads=None, menu_buttons=None, parent=None):
+        super().__init__(parent)
+        self.trace = trace or get_tracer().start_capture() # メニュー描画から含める場合は呼び出し側で開始しておく
+        self.video_path = video_path
+        self.chapters = list(chapters)
+        self.menu_image_path = menu_image_path
+        self.encoder = encoder
+        self.resolution_fps = resolution_fps
+        self.ffmpeg_path = ffmpeg_path
+        self.tsmuxer_path = tsmuxer_path
+        self.ffprobe_path = ffprobe_path
+        self.menu_duration_sec = menu_duration_sec
+        self.normalize_loudness = normalize_loudness
+        self.subtitle_tracks = list(subtitle_tracks or []) # [(字幕ファイル, 言語コード), ...]
+        self.subtitle_font_family = subtitle_font_family
+        self.analyze_source = analyze_source
+        self.analysis = None
+        self.media_target = media_target # "BD-25" など。None なら CRF 固定
+        self.preset = preset
+        self.threads = threads
+        self.verify_ssim_floor = verify_ssim_floor # None なら品質検証をしない
+        self.titles = list(titles or []) # [{"name", "sources", "chapters"}, ...] (複数タイトルのディスク)
+        self.menu_buttons = list(menu_buttons or []) # IG メニューのボタン (空ならメニューは動画だけ)
+        if (self.titles or self.menu_buttons) and output_format == "iso":
+            # タイトルごとのクリップや IG 入りのメニュークリップを BDMV にまとめてから ISO にする
+            output_format = "bdmv+iso"
+        self.check_iso = check_iso and output_format != "bdmv" # ISO のハッシュと UDF 構造の確認をする
+        self.output_format = output_format # "iso" / "bdmv" / "bdmv+iso" (OUTPUT_FORMATS)
+        self.sources = list(sources or [video_path]) # 本編のパート (複数なら連結してからエンコードする)
+        self.clip_number = clip_number # BDMV でのクリップ・プレイリスト番号
+        self.feature_only = feature_only # 子ジョブ: メニューと mux をせず、本編クリップの素材だけを作る
+        self.min_threads = min_threads
+        self.title_jobs = []
+        self.finished_titles = set()
+        self.feature_done = False
+        self.video_copied = False
+        self.secondary_outputs = list(secondary_outputs) # 本編と同じデコードから作る追加出力
+        self.secondary_paths = {} # 追加出力の名前 -> 出力ファイル
+        self.feature_clip_dir = None # BDMV 出力で使う本編クリップのキャッシュ
+        self.reuse_feature_clip = False
+        self.iso_check = None
+        self.iso_written = threading.Event() # tsMuxeR の終了 (IsoCheckWorker に知らせる)
+        self.iso_aborted = threading.Event()
+        self.verification = None
+        self.iso_output_path = None
+        self.rate_plan = None
+        self.threadpool = threadpool or QThreadPool.globalInstance()
+        self.output_dir = output_dir or os.path.dirname(video_path) # 中間ファイルと ISO の出力先
+        self.coordinator = coordinator # 本編映像を分散エンコードする場合の EncodeCoordinator
+
+        self.menu_video_path = None
+        self.menu_ig_path = None
+        self.encoded_video_path = None
+        self.probe = None
+        self.audio_tracks = None # プローブ完了までは None
+        self.audio_outputs = {} # 音声番号 -> 出力ファイル
+        self.pending_audio = {} # 出力ファイル -> 音声番号
+        self.pending_loudness = set() # 測定待ちの音声番号
+        self.subtitle_outputs = {} # 字幕番号 -> .sup
+        self.pending_subtitles = {} # .sup -> 字幕番号
+        self.failed = False
+
+    def start(self):
+        if not self.feature_only:
+            self.finished.connect(self.write_trace)
+            self.error.connect(self.write_trace)
+            self.log.emit(get_resource_governor().describe())
+            if self.output_format == "bdmv+iso" and find_iso_packer() is None:
+                # エンコードを終えてから ISO を作れずに失敗しないよう、開始前に確かめる
+                self.log.emit(f"警告: ISO を作成するツール ({' / '.join(ISO_PACKERS)}) が見つからないため、"
+                              "ISO は作らず BDMV フォルダだけを出力します。")
+                self.output_format = "bdmv"
+                self.check_iso = False
+        self.started.emit()
+        if self.titles:
+            self.start_menu_encoding_process()
+            self.start_title_jobs()
+            return
+        if self.output_format != "iso":
+            self.feature_clip_dir = os.path.join(self.output_dir, "bdmv_clips", self.feature_clip_key()[:16])
+            if os.path.isdir(self.feature_clip_dir):
+                # 本編・音声・字幕はそのまま使えるので、メニューだけ作り直す
+                self.reuse_feature_clip = True
+                self.log.emit(f"本編クリップを再利用します (エンコードと mux を省略): {self.feature_clip_dir}")
+                if self.verify_ssim_floor is not None:
+                    self.log.emit("品質検証は本編クリップの作成時に済んでいるため省略します。")
+                    self.verify_ssim_floor = None
+                if self.feature_only:
+                    self.check_all_encoding_finished()
+                else:
+                    self.start_menu_encoding_process()
+                return
+        # --- 並行エンコード開始 ---
+        if not self.feature_only:
+            self.start_menu_encoding_process() # メニュー動画
+        if len(self.sources) > 1:
+            self.start_join_process() # パートの連結 (→ 本編・音声・字幕)
+        else:
+            self.start_feature_processes()
+
+    def encode_waits_for_probe(self):
+        # UHD は HDR10 のメタデータと色域の変換をプローブ結果から決める
+        return self.analyze_source or self.media_target or is_uhd_output(self.resolution_fps)
+
+    def start_feature_processes(self):
+        if not self.encode_waits_for_probe():
+            self.start_encoding_process() # 本編映像 (事前解析・容量計画をする場合はその後に開始)
+        self.start_probe_process() # ストリームの列挙 (→ 事前解析 / 音声エンコード)
+        self.start_subtitle_processes() # 字幕の PGS 化
+
+    def start_join_process(self):
+        worker = TitleJoinWorker(self.sources, self.output_dir, self.ffmpeg_path, self.ffprobe_path)
+        self._start_worker(worker, "title_join", result_slot=self.join_finished)
+
+    def join_finished(self, result):
+        if self.failed:
+            return
+        self.video_path = result["path"]
+        if not self.chapters:
+            # チャプターの指定が無ければパートの境目をチャプターにする
+            self.chapters = [str(timedelta(seconds=int(start))).zfill(8) for start in result["boundaries"][1:]]
+        self.log.emit(f"パートを連結しました ({'ストリームコピー' if result['method'] == 'copy' else '変換'}): {self.video_path}")
+        self.start_feature_processes()
+
+    def start_title_jobs(self):
+        """ タイトルごとの子ジョブを並行に開始する。スレッドはタイトル数で予算を分け、最低限が空くまで待たせる """
+        governor = get_resource_governor()
+        share = max(TITLE_MIN_THREADS, governor.budget // len(self.titles))
+        threads = min(self.threads or share, share)
+        self.log.emit(f"{len(self.titles)}本のタイトルを並行に処理します (1タイトルあたり最大 {threads}スレッド)。")
+        if self.media_target:
+            self.log.emit("警告: 複数タイトルのディスクでは容量に合わせたレート制御を行いません (CRF 固定でエンコードします)。")
+        if self.subtitle_tracks and len(self.titles) > 1:
+            self.log.emit("注意: 字幕はタイトル1にだけ入れます。")
+        for number, title in enumerate(self.titles, start=1):
+            child = AuthoringJob(title["sources"][0], title.get("chapters", []), None, self.encoder, self.resolution_fps,
+                                 self.ffmpeg_path, self.tsmuxer_path, ffprobe_path=self.ffprobe_path,
+                                 normalize_loudness=self.normalize_loudness,
+                                 subtitle_tracks=self.subtitle_tracks if number == 1 else None,
+                                 subtitle_font_family=self.subtitle_font_family, analyze_source=self.analyze_source,
+                                 preset=self.preset, threads=threads, verify_ssim_floor=self.verify_ssim_floor,
+                                 check_iso=False, output_format="bdmv", secondary_outputs=self.secondary_outputs,
+                                 trace=self.trace, output_dir=os.path.join(self.output_dir, f"title_{number:02}"),
+                                 coordinator=self.coordinator, threadpool=self.threadpool, sources=title["sources"],
+                                 clip_number=number, feature_only=True, min_threads=min(TITLE_MIN_THREADS, threads),
+                                 parent=self)
+            os.makedirs(child.output_dir, exist_ok=True)
+            label = f"[タイトル{number} {title.get('name') or ''}]".replace(" ]", "]")
+            child.log.connect(lambda message, label=label: self.log.emit(f"{label} {message.lstrip()}"))
+            child.error.connect(lambda message, number=number: self.fail(f"タイトル{number}: {message}"))
+            child.finished.connect(lambda _path, number=number: self.title_finished(number))
+            child.stage.connect(self.stage)
+            child.source_ready.connect(self.title_source_ready)
+            self.title_jobs.append(child)
+        self.verify_ssim_floor = None # 品質検証はタイトルごとの子ジョブで行う
+        for child in self.title_jobs:
+            child.start()
+
+    def title_source_ready(self, _source):
+        # すべてのタイトルのプローブが済んだら、合計の長さをディスク全体のソースとして通知する
+        sources = [child.describe_source() for child in self.title_jobs if child.probe]
+        if len(sources) == len(self.title_jobs):
+            self.source_ready.emit({"duration_sec": sum(source["duration_sec"] for source in sources),
+                                    "width": max(source["width"] or 0 for source in sources),
+                                    "height": max(source["height"] or 0 for source in sources)})
+
+    def title_finished(self, number):
+        self.finished_titles.add(number)
+        self.log.emit(f"\n🎉 タイトル{number} の本編・音声・字幕の準備が完了しました ({len(self.finished_titles)}/{len(self.title_jobs)})")
+        self.check_all_encoding_finished()
+
+    def feature_clip_key(self):
+        """ 本編クリップの内容を決める入力と設定のハッシュ (メニューは含めない) """
+        def fingerprint(path):
+            st = os.stat(path)
+            return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+        key = {"version": BDMV_CLIP_VERSION, "clip": self.clip_number, "sources": [fingerprint(path) for path in self.sources],
+               "tsmuxer": fingerprint(self.tsmuxer_path),
+               "encoder": self.encoder, "resolution_fps": self.resolution_fps, "preset": self.preset,
+               "media_target": self.media_target, "analyze_source": self.analyze_source,
+               "normalize_loudness": self.normalize_loudness, "chapters": sorted(self.chapters),
+               "subtitles": [fingerprint(path) + [language] for path, language in self.subtitle_tracks],
+               "subtitle_font_family": self.subtitle_font_family}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _start_worker(self, worker, label, finished_slot=None, result_slot=None):
+        worker.signals.log.connect(self.log)
+        if finished_slot: worker.signals.finished.connect(finished_slot)
+        if result_slot: worker.signals.result.connect(result_slot)
+        worker.signals.error.connect(self.fail)
+        worker.signals.stage.connect(self.stage)
+        get_metrics_collector().watch(worker.signals, label)
+        self.threadpool.start(self.trace.bind(worker.run)) # Worker のスパンをこのジョブのトレースに入れる
+
+    def report_stage(self, record):
+        # Worker を通さずにジョブの中で計測した段階 (.meta の生成など)
+        get_metrics_collector().record_stage(record)
+        self.stage.emit(record)
+
+    def describe_source(self):
+        video = source_video_stream(self.probe) or {}
+        return {"duration_sec": self.probe.get("duration") or 0.0, "width": video.get("width"), "height": video.get("height")}
+
+    def write_trace(self, _=None):
+        # ジョブ終了時 (成功・失敗とも) にトレースを書き出し、段階ごとのサマリをログに出す
+        try:
+            trace_path = self.trace.export(os.path.join(self.output_dir, "authoring_trace.json"))
+        except OSError as e:
+            self.log.emit(f"警告: トレースの書き出しに失敗しました: {e}")
+            return
+        self.log.emit("\n--- 処理時間のサマリ ---")
+        for line in self.trace.summary_lines():
+            self.log.emit(line)
+        self.log.emit(f"トレース (chrome://tracing / Perfetto で表示可): {trace_path}")
+
+    def fail(self, message):
+        # 最初のエラーのみ通知し、以降の完了通知は無視する
+        if self.failed:
+            return
+        self.failed = True
+        self.iso_aborted.set() # ISO のハッシュ計算を止める
+        self.iso_written.set()
+        for child in self.title_jobs:
+            child.failed = True # 残りのタイトルの処理を次の段階に進めない
+        self.error.emit(message)
+
+    def start_menu_encoding_process(self):
+        self.log.emit("メニュー動画エンコード準備中...")
+        worker = MenuEncoderWorker(self.menu_image_path, self.menu_duration_sec, self.resolution_fps, self.ffmpeg_path)
+        self._start_worker(worker, "menu_encode", self.menu_encoding_finished)
+        if self.menu_buttons:
+            worker = IgMenuWorker(self.menu_buttons, self.chapters, self.resolution_fps, self.get_bd_fps(),
+                                  os.path.join(self.output_dir, "menu_ig.sup"))
+            self._start_worker(worker, "ig_menu", self.ig_menu_finished)
+
+    def ig_menu_finished(self, output_path):
+        self.menu_ig_path = output_path
+        self.check_all_encoding_finished()
+
+    def menu_ready(self):
+        return bool(self.menu_video_path) and (not self.menu_buttons or bool(self.menu_ig_path))
+
+    def get_prefilters(self):
+        prefilters = [self.analysis.get("deinterlace"), self.analysis.get("crop")] if self.analysis else []
+        color = uhd_color_filter(source_video_stream(self.probe), self.resolution_fps)
+        return prefilters + [color] if color else prefilters
+
+    def can_copy_video(self):
+        """ 変換もレート制御も追加出力も不要で、ソースが BD の規格内ならストリームコピーで済ませる """
+        if self.probe is None or any(self.get_prefilters()) or self.rate_plan or self.secondary_outputs:
+            return False
+        problems = bd_copy_problems(self.probe, self.resolution_fps)
+        if problems:
+            self.log.emit(f"本編映像は再エンコードします ({'、'.join(problems)})")
+        return not problems
+
+    def start_encoding_process(self):
+        if self.can_copy_video():
+            self.video_copied = True
+            if self.verify_ssim_floor is not None:
+                self.log.emit("本編映像はコピーするため品質検証を省略します。")
+                self.verify_ssim_floor = None
+            self._start_worker(StreamCopyWorker(self.video_path, self.output_dir, self.ffmpeg_path), "video_copy",
+                               self.encoding_finished)
+            return
+        self.log.emit("本編エンコード準備中...")
+        prefilters = self.get_prefilters()
+        worker = EncoderWorker(self.video_path, self.chapters, self.encoder, self.resolution_fps, self.ffmpeg_path,
+                               prefilters=prefilters, rate_control=self.rate_plan, preset=self.preset, threads=self.threads,
+                               output_dir=self.output_dir, coordinator=self.coordinator,
+                               secondary_outputs=self.secondary_outputs, min_threads=self.min_threads, probe=self.probe)
+        self._start_worker(worker, "video_encode", self.encoding_finished, result_slot=self.secondary_outputs_ready)
+
+    def secondary_outputs_ready(self, paths):
+        self.secondary_paths = paths
+
+    def start_analysis_process(self, probe):
+        worker = SourceAnalysisWorker(self.video_path, probe, self.ffmpeg_path)
+        self._start_worker(worker, "analysis", result_slot=self.analysis_finished)
+
+    def analysis_finished(self, analysis):
+        if self.failed:
+            return
+        self.analysis = analysis
+        if self.media_target:
+            self.start_planning_process()
+        else:
+            self.start_encoding_process()
+
+    def start_planning_process(self):
+        prefilters = self.get_prefilters()
+        worker = PlanningWorker(self.video_path, self.encoder, self.resolution_fps, self.media_target, self.ffmpeg_path,
+                                probe=self.probe, prefilters=prefilters, menu_duration_sec=self.menu_duration_sec,
+                                subtitle_count=len(self.subtitle_tracks), normalize_loudness=self.normalize_loudness,
+                                preset=self.preset)
+        self._start_worker(worker, "planning", result_slot=self.planning_finished)
+
+    def planning_finished(self, plan):
+        if self.failed:
+            return
+        self.rate_plan = plan
+        self.plan_ready.emit(plan)
+        if plan["margin_bytes"] < 0:
+            self.log.emit("警告: 予測サイズがメディア容量を超えています。上限付きVBRで可能な限り収めます。")
+        self.start_encoding_process()
+
+    def start_probe_process(self):
+        worker = ProbeWorker(self.video_path, self.ffmpeg_path, self.ffprobe_path)
+        self._start_worker(worker, "probe", result_slot=self.probe_finished)
+
+    def start_subtitle_processes(self):
+        for subtitle_index, (subtitle_path, _language) in enumerate(self.subtitle_tracks):
+            output_path = os.path.join(self.output_dir, f"subtitle_{subtitle_index}.sup").replace('\\', '/')
+            worker = SubtitleRenderWorker(subtitle_path, output_path, self.resolution_fps, self.subtitle_font_family)
+            self.pending_subtitles[output_path] = subtitle_index
+            self._start_worker(worker, "subtitle", self.subtitle_finished)
+
+    def subtitle_finished(self, output_path):
+        self.subtitle_outputs[self.pending_subtitles.pop(output_path)] = output_path
+        self.check_all_encoding_finished()
+
+    def probe_finished(self, probe):
+        if self.failed:
+            return
+        self.probe = probe
+        self.source_ready.emit(self.describe_source())
+        if self.encoded_video_path and self.verify_ssim_floor is not None:
+            self.start_verification_process()
+        if self.analyze_source:
+            self.start_analysis_process(probe)
+        elif self.media_target:
+            self.start_planning_process()
+        elif self.encode_waits_for_probe():
+            self.start_encoding_process()
+        self.audio_tracks = [st for st in probe.get("streams", []) if st.get("type") == "audio"]
+        if not self.audio_tracks:
+            self.log.emit("警告: ソースに音声トラックがありません。映像のみで作成します。")
+        for audio_index, track in enumerate(self.audio_tracks):
+            if self.normalize_loudness:
+                # 測定 (1パス目) は本編映像のエンコードと並行して走り、完了後に音声を書き出す
+                self.pending_loudness.add(audio_index)
+                worker = LoudnessAnalysisWorker(self.video_path, audio_index, self.ffmpeg_path)
+                self._start_worker(worker, "loudness", result_slot=self.loudness_measured)
+            else:
+                self.start_audio_encoding_process(audio_index)
+        self.check_all_encoding_finished()
+
+    def loudness_measured(self, result):
+        if self.failed:
+            return
+        audio_index = result["audio_index"]
+        self.pending_loudness.discard(audio_index)
+        self.start_audio_encoding_process(audio_index, build_loudnorm_filter(result["measured"]))
+
+    def start_audio_encoding_process(self, audio_index, loudnorm_filter=None):
+        worker = AudioEncoderWorker(self.video_path, audio_index, self.audio_tracks[audio_index],
+                                    self.output_dir, self.ffmpeg_path, loudnorm_filter=loudnorm_filter)
+        self.pending_audio[worker.output_path] = audio_index
+        self._start_worker(worker, "audio_encode", self.audio_encoding_finished)
+
+    def menu_encoding_finished(self, output_path):
+        self.log.emit("\n🎉 メニュー動画のエンコードが正常に完了しました！")
+        self.log.emit(f"出力ファイル: {output_path}")
+        self.menu_video_path = output_path
+        self.check_all_encoding_finished() # すべて完了したかチェック
+
+    def encoding_finished(self, output_path):
+        self.log.emit("\n🎉 本編映像のエンコードが正常に完了しました！")
+        self.log.emit(f"出力ファイル: {output_path}")
+        self.encoded_video_path = output_path
+        if self.verify_ssim_floor is not None:
+            self.start_verification_process() # 残りのエンコードや mux と並行に検証する
+        self.check_all_encoding_finished() # すべて完了したかチェック
+
+    def start_verification_process(self):
+        # probe は本編エンコード開始前に必ず完了している (事前解析なし・CRF 固定の場合のみ未完了の可能性がある)
+        if self.probe is None:
+            self.log.emit("プローブ完了後に品質検証を開始します。")
+            return
+        worker = VerificationWorker(self.encoded_video_path, self.video_path, self.probe, self.resolution_fps,
+                                    self.chapters, self.ffmpeg_path, prefilters=self.get_prefilters())
+        self._start_worker(worker, "verification", result_slot=self.verification_finished)
+
+    def verification_finished(self, result):
+        if self.failed:
+            return
+        self.verification = result
+        worst = result["worst_window"]
+        self.log.emit(f"品質検証: 平均 SSIM {result['ssim']} / PSNR {result['psnr']} dB "
+                      f"(最悪区間 {worst['start']:.1f}秒付近 SSIM {worst['ssim']})")
+        for chapter in result["chapters"]:
+            self.log.emit(f"  チャプター{chapter['chapter']}: SSIM {chapter['ssim']} / PSNR {chapter['psnr']} dB")
+        problems = check_verification(result, self.verify_ssim_floor)
+        if problems:
+            self.fail("品質検証で基準を下回りました:\n" + "\n".join(problems))
+            return
+        self.check_job_finished()
 
-            elif sys.platform == "darwin":
-                # macOS: drutil を使用
-                if not self.drive_id:
-                    self.signals.error.emit("macOSでは書き込みドライブ（disk2など）の指定が必要です。")
-                    return
-                # drutil burn -device [ドライブID] [ISOパス]
-                command = ['drutil', 'burn', '-device', self.drive_id, self.iso_path]
+    def audio_encoding_finished(self, output_path):
+        audio_index = self.pending_audio.pop(output_path)
+        self.audio_outputs[audio_index] = output_path
+        self.log.emit(f"音声トラック {audio_index} の処理が完了しました: {output_path}")
+        self.check_all_encoding_finished()
 
+    def check_all_encoding_finished(self):
+        if self.failed:
+            return
+        if self.titles:
+            if self.menu_ready() and len(self.finished_titles) == len(self.title_jobs):
+                self.log.emit("\n--- メニューとすべてのタイトルの準備が完了しました ---")
+                self.start_muxing_process()
             else:
-                self.signals.error.emit(f"サポートされていないOSです: {sys.platform}")
+                waiting = [] if self.menu_ready() else ["メニュー"]
+                waiting += [f"タイトル{child.clip_number}" for child in self.title_jobs if child.clip_number not in self.finished_titles]
+                self.log.emit(f"...{'、'.join(waiting)}の完了待機中...")
+            return
+        if self.reuse_feature_clip:
+            if self.feature_only:
+                self.feature_finished()
+            elif self.menu_ready():
+                self.start_muxing_process()
+            return
+        audio_done = self.audio_tracks is not None and not self.pending_audio and not self.pending_loudness
+        menu_done = self.menu_ready() or self.feature_only
+        if menu_done and self.encoded_video_path and audio_done and not self.pending_subtitles:
+            if self.feature_only:
+                self.feature_finished()
                 return
+            self.log.emit("\n--- メニュー・本編映像・音声のエンコードがすべて完了しました ---")
+            self.start_muxing_process() # すべて完了したらmux処理を開始
+        else:
+            waiting = []
+            if not menu_done: waiting.append("メニュー動画")
+            if not self.encoded_video_path: waiting.append("本編映像")
+            if not audio_done: waiting.append("音声")
+            if self.pending_subtitles: waiting.append("字幕")
+            self.log.emit(f"...{'、'.join(waiting)}のエンコード待機中...")
+
+    def get_bd_fps(self):
+        # --- FPS文字列の決定 ---
+        fps_str = "23.976" # Default
+        if self.resolution_fps:
+            if ":" in self.resolution_fps:
+                 fps_part = self.resolution_fps.split(':')[1]
+                 if fps_part == "60": fps_str = "59.94" # Correct BD FPS for 60
+                 elif fps_part == "30": fps_str = "29.97" # Correct BD FPS for 30
+                 elif "24000/1001" in fps_part: fps_str="23.976"
+        return fps_str
 
-            self.signals.log.emit(f"{sys.platform}用の書き込みコマンドを実行します...")
-            self.signals.log.emit(f"コマンド: {' '.join(command)}")
+    def build_meta_content(self):
+        fps_str = self.get_bd_fps()
+
+        # --- チャプターオフセット計算 ---
+        # ヘルパー関数: HH:MM:SS -> float(秒)
+        def time_to_sec(t):
+            h, m, s = map(int, t.split(':'))
+            return float(h * 3600 + m * 60 + s)
 
-            process = subprocess.Popen(command,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT,
-                                       universal_newlines=True,
-                                       encoding='utf-8',
-                                       creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0)
+        # ヘルパー関数: float(秒) -> HH:MM:SS (ミリ秒を削除)
+        def sec_to_time(s_float):
+            s = int(round(s_float)) # ミリ秒を丸める
+            h = s // 3600
+            m = (s % 3600) // 60
+            s = s % 60
+            return f"{h:02}:{m:02}:{s:02}" 
 
-            for line in process.stdout:
-                self.signals.log.emit(line.strip())
+        offset_sec = self.menu_duration_sec # メニュー動画の長さ
+        all_chapters_time = sorted(['00:00:00'] + self.chapters)
 
-            process.wait()
+        offset_chapters_list = []
+        for time_str in all_chapters_time:
+            original_sec = time_to_sec(time_str)
+            offset_chapters_list.append(sec_to_time(original_sec + offset_sec))
 
-            if process.returncode == 0:
-                self.signals.finished.emit(self.iso_path)
-            else:
-                raise subprocess.CalledProcessError(process.returncode, command)
+        # 最終的なチャプターリスト (ミリ秒なし)
+        final_chapters_list = ["00:00:00"] + offset_chapters_list 
+        chapters_str = ";".join(final_chapters_list)
+
+        # --- .meta ファイル生成 ---
+        # MUXOPT行にチャプター情報 (--chapters="...") を含める
+        meta_content = f'MUXOPT {TSMUXER_MUXOPT} {tsmuxer_blu_ray_options(self.resolution_fps, "--blu-ray-iso")} --chapters="{chapters_str}"\n'
+        meta_content += self.build_menu_tracks(fps_str) # トラック1: メニュー
+        meta_content += self.build_feature_tracks(fps_str) # トラック2: 本編
+        return meta_content
 
+    def build_menu_tracks(self, fps_str):
+        meta_content = f'{tsmuxer_video_codec(self.resolution_fps)}, "{self.menu_video_path}", track=1, fps={fps_str}\n'
+        meta_content += f'A_AC3, "{self.menu_video_path}", track=1\n' # (無音オーディオトラック)
+        return meta_content
+
+    def build_feature_tracks(self, fps_str):
+        # 本編 (映像 + 音声エレメンタリストリーム + 字幕)
+        meta_content = f'{tsmuxer_video_codec(self.resolution_fps)}, "{self.encoded_video_path}", track=1, fps={fps_str}\n'
+        for audio_index in sorted(self.audio_outputs):
+            track = self.audio_tracks[audio_index]
+            audio_path = self.audio_outputs[audio_index]
+            codec_id = "A_DTS" if audio_path.endswith(".dts") else "A_AC3"
+            meta_content += f'{codec_id}, "{audio_path}", lang={track.get("language") or "und"}\n'
+        for subtitle_index in sorted(self.subtitle_outputs):
+            language = self.subtitle_tracks[subtitle_index][1] or "und"
+            meta_content += f'S_HDMV/PGS, "{self.subtitle_outputs[subtitle_index]}", fps={fps_str}, lang={language}\n'
+        return meta_content
+
+    def build_bdmv_meta_files(self):
+        """
+        BDMV 出力用に、メニューと本編 (タイトルごと) を別クリップにする .meta を書く。
+        (メニューの .meta, [(クリップ番号, 本編の .meta または None, キャッシュ先), ...]) を返す
+        """
+        fps_str = self.get_bd_fps()
+        menu_meta = os.path.join(self.output_dir, "tsmuxer_menu.meta").replace('\\', '/')
+        with open(menu_meta, 'w', encoding='utf-8') as f:
+            # IG を入れるメニュークリップは、ヌルパケット (IG の置き場所) ができるよう CBR で mux する
+            muxopt = IG_MENU_MUXOPT if self.menu_buttons else TSMUXER_MUXOPT
+            f.write(f'MUXOPT {muxopt} {tsmuxer_blu_ray_options(self.resolution_fps, "--blu-ray")} '
+                    f'--mplsOffset={BDMV_MENU_CLIP} --m2tsOffset={BDMV_MENU_CLIP}\n')
+            f.write(self.build_menu_tracks(fps_str))
+        features = self.title_jobs or [self]
+        return menu_meta, [(job.clip_number, job.build_feature_meta(fps_str), job.feature_clip_dir) for job in features]
+
+    def build_feature_meta(self, fps_str):
+        """ 本編クリップの .meta を書く (キャッシュ済みの本編を再利用する場合は None) """
+        if self.reuse_feature_clip:
+            return None
+        feature_meta = os.path.join(self.output_dir, "tsmuxer_feature.meta").replace('\\', '/')
+        chapters_str = ";".join(sorted(set(['00:00:00'] + self.chapters))) # 本編は独立したプレイリストなのでずらさない
+        with open(feature_meta, 'w', encoding='utf-8') as f:
+            f.write(f'MUXOPT {TSMUXER_MUXOPT} {tsmuxer_blu_ray_options(self.resolution_fps, "--blu-ray")} '
+                    f'--mplsOffset={self.clip_number} --m2tsOffset={self.clip_number} '
+                    f'--chapters="{chapters_str}"\n')
+            f.write(self.build_feature_tracks(fps_str))
+        return feature_meta
+
+    def start_bdmv_process(self):
+        try:
+            with self.trace.activate(), pipeline_stage("meta", report=self.report_stage):
+                menu_meta, clips = self.build_bdmv_meta_files()
         except Exception as e:
-            self.signals.error.emit(f"書き込みに失敗しました: {e}")
+            self.fail(f"tsMuxeR設定ファイルの作成に失敗: {e}")
+            return
+        output_folder = os.path.join(self.output_dir, BDMV_VOLUME_LABEL)
+        iso_path = os.path.join(self.output_dir, "BDMV_MENU.iso") if self.output_format == "bdmv+iso" else None
+        for _, _, clip_dir in clips:
+            os.makedirs(os.path.dirname(clip_dir), exist_ok=True)
+        worker = BdmvAuthoringWorker(self.tsmuxer_path, menu_meta, clips, output_folder, iso_path, menu_ig=self.menu_ig_path)
+        self._start_worker(worker, "mux", self.bdmv_finished)
+
+    def bdmv_finished(self, output_path):
+        self.iso_output_path = output_path
+        if self.check_iso and output_path.endswith(".iso"):
+            self.iso_written.set() # 書き終わっているのでそのまま検証する
+            self._start_worker(IsoCheckWorker(output_path, self.iso_written, self.iso_aborted), "iso_check",
+                               result_slot=self.iso_check_finished)
+        self.check_job_finished()
+
+    def start_muxing_process(self):
+        if self.output_format != "iso":
+            self.start_bdmv_process()
+            return
+        iso_output_path = os.path.join(self.output_dir, "BDMV_MENU.iso").replace('\\', '/')
+        meta_path = os.path.join(self.output_dir, "tsmuxer.meta").replace('\\', '/')
+
+        # --- tsMuxeR 実行 ---
+        try:
+            with self.trace.activate(), pipeline_stage("meta", outputs=[meta_path], report=self.report_stage), open(meta_path, 'w', encoding='utf-8') as f:
+                f.write(self.build_meta_content())
+            self.log.emit(f"tsMuxeR用の設定ファイルを作成しました (メニュー + 本編 + 音声{len(self.audio_outputs)}本)。")
+        except Exception as e:
+            self.fail(f"tsMuxeR設定ファイルの作成に失敗: {e}")
+            return
+
+        if self.check_iso and os.path.exists(iso_output_path):
+            # 前回の ISO をハッシュしてしまわないよう、並行して読み始める前に消しておく
+            os.remove(iso_output_path)
+        worker = AuthoringWorker(self.tsmuxer_path, meta_path, iso_output_path) # 出力先をISOに変更
+        self._start_worker(worker, "mux", self.muxing_finished)
+        if self.check_iso:
+            self._start_worker(IsoCheckWorker(iso_output_path, self.iso_written, self.iso_aborted), "iso_check",
+                               result_slot=self.iso_check_finished)
+
+    def muxing_finished(self, iso_output_path):
+        self.iso_output_path = iso_output_path
+        self.iso_written.set()
+        self.check_job_finished()
+
+    def iso_check_finished(self, result):
+        if self.failed:
+            return
+        if result["problems"]:
+            self.fail("ISO の構造に問題があります:\n" + "\n".join(result["problems"]))
+            return
+        manifest = result["manifest"]
+        self.iso_check = manifest
+        streams = sorted(p for p in manifest["files"] if p.startswith("BDMV/STREAM/"))
+        self.log.emit(f"ISO の検証: UDF 構造に問題なし (ファイル {len(manifest['files'])}個, ストリーム {len(streams)}本), "
+                      f"SHA-256 (チャンク単位) {manifest['digest'][:16]}")
+        self.check_job_finished()
+
+    def feature_finished(self):
+        self.feature_done = True
+        self.check_job_finished()
+
+    def check_job_finished(self):
+        # mux・品質検証・ISO の検証がすべて終わったら完了 (子ジョブは本編の素材と品質検証まで)
+        if self.failed or not (self.feature_done if self.feature_only else self.iso_output_path):
+            return
+        if self.verify_ssim_floor is not None and self.verification is None:
+            self.log.emit("...品質検証の完了を待機中...")
+            return
+        if self.check_iso and self.iso_check is None:
+            self.log.emit("...ISO の検証の完了を待機中...")
+            return
+        self.finished.emit(self.feature_clip_dir if self.feature_only else self.iso_output_path)
 
 
 # --- メインウィンドウ ---
@@ -521,26 +6186,33 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.selected_video_path = ""
         self.background_image_path = ""
-        self.encoded_video_path = None
         self.generated_iso_path = None
-        self.menu_video_path = None
+        self.current_job = None
+        self.subtitle_tracks = [] # [(字幕ファイル, 言語コード), ...]
+        self.extra_titles = [] # タイトル2以降 [{"name", "sources", "chapters"}, ...] (タイトル1は選択した動画とチャプター)
+        self.tool_paths = {} # 外部ツールの差し替え (ベンチマークのスタブなど): "ffmpeg" / "ffprobe" / "tsMuxeR" -> パス
+        self.output_dir = None # 中間ファイルと ISO の出力先 (None ならソースと同じフォルダ)
+        self.encode_coordinator = None # 本編映像をエージェントに分散する場合の EncodeCoordinator
+        self.check_iso = True # 生成した ISO のハッシュと UDF 構造を確認する (スタブの tsMuxeR では無効にする)
+        self.tool_capabilities = None # ffmpeg の機能 (確認できるまでは None で、すべてのエンコーダを表示する)
         self.menu_duration_sec = 10.0
         self.chapters = []
         self.threadpool = QThreadPool()
         self.menu_buttons = []
         self.title_item = None
         self.selected_item = None # Can be DraggableProxyWidget or DraggableTextItem
-        self.default_button_font_family = "Arial"
-        self.default_button_font_size = 50
-        self.default_button_font_color = "#ffffff"
-        self.default_title_font_family = "Impact"
-        self.default_title_font_size = 72
-        self.default_title_font_color = "#ffff00"
-        self.player = QMediaPlayer()
-        self.audio_output = QAudioOutput()
-        self.player.setAudioOutput(self.audio_output)
-        self.player.positionChanged.connect(self.update_timecode)
-        self.player.durationChanged.connect(self.update_timecode)
+        self.default_button_font_family = MENU_DEFAULT_BUTTON["font_family"]
+        self.default_button_font_size = MENU_DEFAULT_BUTTON["font_size"]
+        self.default_button_font_color = MENU_DEFAULT_BUTTON["font_color"]
+        self.default_title_font_family = MENU_DEFAULT_TITLE["font_family"]
+        self.default_title_font_size = MENU_DEFAULT_TITLE["font_size"]
+        self.default_title_font_color = MENU_DEFAULT_TITLE["font_color"]
+        self.player = None # QMediaPlayer は最初に動画を読み込むときに作る (ensure_player)
+        self.audio_output = None
+        self.video_widget = None
+        self.drives = None # 列挙済みの書き込みドライブ [(表示名, ドライブID), ...]
+        self.drive_scan_running = False
+        self.drive_timer = None
         self.setWindowTitle("BDメニュー作成・書き込みソフト (Qt版)")
 
         # ウィンドウサイズを大きく
@@ -582,33 +6254,61 @@ class MainWindow(QMainWindow):
         grid_layout.setRowStretch(2, 2)    # 行2 (ログ/設定)
 
         self.populate_drive_list()
+        self.load_tool_capabilities()
 
-    def log_message(self, message):
-        self.log_output.append(message)
-
-    def menu_encoding_finished(self, output_path):
-        self.log_output.append("\n🎉 メニュー動画のエンコードが正常に完了しました！")
-        self.log_output.append(f"出力ファイル: {output_path}")
-        self.menu_video_path = output_path
-        self.check_all_encoding_finished() # 両方完了したかチェック
+    def load_tool_capabilities(self):
+        """ 起動時はキャッシュだけを読み、無ければ (初回や ffmpeg の更新後) バックグラウンドで調べる """
+        ffmpeg_path = self.find_ffmpeg()
+        if not ffmpeg_path:
+            return
+        capabilities = get_tool_registry().cached(ffmpeg_path)
+        if capabilities is not None:
+            self.apply_tool_capabilities(capabilities)
+            return
+        self.log_message("ffmpeg の機能 (使用できるエンコーダ・フィルタ) を確認しています...")
+        worker = ToolProbeWorker("ffmpeg", ffmpeg_path)
+        worker.signals.result.connect(self.apply_tool_capabilities)
+        worker.signals.error.connect(self.log_message)
+        self.threadpool.start(worker)
 
-    def encoding_finished(self, output_path):
-        self.log_output.append("\n🎉 本編動画のエンコードが正常に完了しました！")
-        self.log_output.append(f"出力ファイル: {output_path}")
-        self.encoded_video_path = output_path
-        self.check_all_encoding_finished() # 両方完了したかチェック
+    def apply_tool_capabilities(self, capabilities):
+        """ 使用できるエンコーダだけを選択肢に残し、必要なフィルタが無い機能は無効にする """
+        self.tool_capabilities = capabilities
+        usable = capabilities.get("usable_encoders", [])
+        current = self.encoder_combo_box.currentData()
+        self.encoder_combo_box.clear()
+        for label, encoder in VIDEO_ENCODER_CHOICES:
+            if encoder in usable:
+                self.encoder_combo_box.addItem(label, encoder)
+        self.encoder_combo_box.setCurrentIndex(max(0, self.encoder_combo_box.findData(current)))
+        if not usable:
+            self.log_message("エラー: この ffmpeg には使用できる H.264 エンコーダがありません。")
+        # UHD の出力は x265 が無ければ選べないようにする
+        uhd = capabilities.get("uhd", False)
+        model = self.resolution_combo_box.model()
+        for index in range(self.resolution_combo_box.count()):
+            if is_uhd_output(self.resolution_combo_box.itemData(index)):
+                model.item(index).setEnabled(uhd)
+                model.item(index).setToolTip("" if uhd else f"この ffmpeg には {UHD_VIDEO_ENCODER} がありません")
+        if not uhd and is_uhd_output(self.resolution_combo_box.currentData()):
+            self.resolution_combo_box.setCurrentIndex(self.resolution_combo_box.findData("1920x1080:24000/1001"))
+            self.log_message(f"警告: この ffmpeg には {UHD_VIDEO_ENCODER} が無いため、出力を 1080p 24fps に戻しました。")
+        filters = set(capabilities.get("filters", []))
+        for checkbox, required in ((self.loudnorm_checkbox, "loudnorm"), (self.verify_checkbox, "ssim")):
+            if required not in filters:
+                checkbox.setChecked(False)
+                checkbox.setEnabled(False)
+                checkbox.setToolTip(f"この ffmpeg には {required} フィルタがありません")
 
-    def check_all_encoding_finished(self):
-        if self.menu_video_path and self.encoded_video_path:
-            self.log_message("\n--- メニューと本編のエンコードが両方完了しました ---")
-            self.start_muxing_process() # 両方完了したらmux処理を開始
-        else:
-            if not self.menu_video_path:
-                self.log_message("...本編エンコード完了、メニュー動画エンコード待機中...")
-            if not self.encoded_video_path:
-                self.log_message("...メニュー動画エンコード完了、本編エンコード待機中...")
+    def log_message(self, message):
+        self.log_output.append(message)
 
-    def authoring_finished(self, output_path): # output_path は "output.iso" のパス
+    def authoring_finished(self, output_path): # output_path は "output.iso" (BDMV フォルダのみの場合はフォルダ) のパス
+        if os.path.isdir(output_path):
+            self.log_output.append("\n✅ BDMV フォルダの生成が正常に完了しました！")
+            self.log_output.append(f"出力先フォルダ: {output_path}")
+            self.toggle_ui_elements(True) # 書き込みには ISO が必要
+            return
         self.log_output.append("\n✅ BD ISOイメージの生成が正常に完了しました！")
         self.log_output.append(f"出力先ISO: {output_path}")
         self.generated_iso_path = output_path    # ISOパスを保存
@@ -626,6 +6326,10 @@ class MainWindow(QMainWindow):
     def toggle_ui_elements(self, enabled):
         self.select_file_button.setEnabled(enabled)
         self.select_bg_button.setEnabled(enabled)
+        self.add_subtitle_button.setEnabled(enabled)
+        self.remove_subtitle_button.setEnabled(enabled)
+        self.add_title_button.setEnabled(enabled)
+        self.remove_title_button.setEnabled(enabled)
         self.add_chapter_button.setEnabled(enabled)
         self.delete_chapter_button.setEnabled(enabled)
         self.author_button.setEnabled(enabled)
@@ -649,36 +6353,100 @@ class MainWindow(QMainWindow):
     def open_file_dialog(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "動画ファイルを選択", "", "Video Files (*.mp4 *.mkv *.mov);;All Files (*)")
         if file_path:
-            self.selected_video_path = file_path
-            short_path = "..." + file_path[-40:] if len(file_path) > 40 else file_path
-            self.file_path_label.setText(f"選択中: {short_path}")
-            self.log_message(f"動画ファイルが選択されました: {file_path}")
-            self.player.setSource(QUrl.fromLocalFile(file_path))
-            self.play_button.setEnabled(True)
-            self.skip_button.setEnabled(True)
-            self.rewind_button.setEnabled(True)
+            self.set_video_file(file_path)
+
+    def set_video_file(self, file_path, preview=True):
+        self.selected_video_path = file_path
+        short_path = "..." + file_path[-40:] if len(file_path) > 40 else file_path
+        self.file_path_label.setText(f"選択中: {short_path}")
+        self.log_message(f"動画ファイルが選択されました: {file_path}")
+        if not preview:
+            return # ウィンドウを表示しない実行では QMediaPlayer を作らない
+        self.ensure_player()
+        self.player.setSource(QUrl.fromLocalFile(file_path))
+        self.play_button.setEnabled(True)
+        self.skip_button.setEnabled(True)
+        self.rewind_button.setEnabled(True)
+    def open_subtitle_dialog(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "字幕ファイルを選択", "", "Subtitle Files (*.srt *.ass *.ssa)")
+        if file_path:
+            # "movie.jpn.srt" のようなファイル名から言語コードを推定する
+            match = re.search(r'\.([a-z]{3})\.(srt|ass|ssa)$', file_path, re.IGNORECASE)
+            language = match.group(1).lower() if match else "und"
+            self.subtitle_tracks.append((file_path, language))
+            self.subtitle_list_widget.addItem(f"[{language}] {os.path.basename(file_path)}")
+            self.log_message(f"字幕ファイルを追加しました: {file_path} (言語: {language})")
+
+    def remove_selected_subtitle(self):
+        row = self.subtitle_list_widget.currentRow()
+        if row < 0:
+            self.log_message("削除する字幕が選択されていません。")
+            return
+        subtitle_path, _ = self.subtitle_tracks.pop(row)
+        self.subtitle_list_widget.takeItem(row)
+        self.log_message(f"字幕ファイルを削除しました: {subtitle_path}")
+
+    def open_title_dialog(self):
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "追加するタイトルの動画を選択 (複数選択すると順に連結して1タイトルにします)",
+                                                     "", "Video Files (*.mp4 *.mkv *.mov *.m2ts);;All Files (*)")
+        if file_paths:
+            name = os.path.splitext(os.path.basename(file_paths[0]))[0]
+            self.extra_titles.append({"name": name, "sources": list(file_paths), "chapters": []})
+            self.update_title_list_widget()
+            self.log_message(f"タイトル {len(self.extra_titles) + 1} を追加しました: {name} (パート {len(file_paths)}個)")
+            self.update_menu_layout()
+
+    def remove_selected_title(self):
+        row = self.title_list_widget.currentRow()
+        if row < 0:
+            self.log_message("削除するタイトルが選択されていません。")
+            return
+        title = self.extra_titles.pop(row)
+        self.update_title_list_widget()
+        self.log_message(f"タイトルを削除しました: {title['name']}")
+        self.update_menu_layout()
+
+    def update_title_list_widget(self):
+        self.title_list_widget.clear()
+        for number, title in enumerate(self.extra_titles, start=2):
+            parts = f" (パート {len(title['sources'])}個)" if len(title["sources"]) > 1 else ""
+            self.title_list_widget.addItem(f"タイトル {number}: {title['name']}{parts}")
+
+    def show_title_chapters(self, row):
+        chapters = self.extra_titles[row]["chapters"] if 0 <= row < len(self.extra_titles) else []
+        self.title_chapters_input.setText(", ".join(chapters))
+
+    def set_title_chapters(self):
+        row = self.title_list_widget.currentRow()
+        if row < 0:
+            return
+        chapters = [t.strip() for t in self.title_chapters_input.text().split(",") if t.strip()]
+        if any(not re.match(r'^\d{2}:\d{2}:\d{2}$', t) for t in chapters):
+            self.log_message("エラー: チャプターは HH:MM:SS 形式をカンマで区切って入力してください。")
+            return
+        self.extra_titles[row]["chapters"] = sorted(set(chapters) - {"00:00:00"})
+        self.log_message(f"タイトル {row + 2} のチャプターを設定しました: {len(self.extra_titles[row]['chapters'])}個")
+
+    def get_titles(self):
+        """ ディスクのタイトル一覧 (タイトル1は選択した動画とチャプター) """
+        main_title = {"name": os.path.splitext(os.path.basename(self.selected_video_path))[0],
+                      "sources": [self.selected_video_path], "chapters": list(self.chapters)}
+        return [main_title] + self.extra_titles
+
     def open_background_image_dialog(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "背景画像を選択", "", "Image Files (*.png *.jpg *.jpeg *.bmp)")
         if file_path:
             self.background_image_path = file_path
             self.set_background_image(file_path)
 
+    @traced()
     def set_background_image(self, file_path):
         self.scene.clear() # Clear everything including bg image
         self.menu_buttons.clear()
         self.title_item = None
         pixmap = QPixmap(file_path)
         if not pixmap.isNull():
-            bg_item = QGraphicsPixmapItem()
-
-            scaled_pixmap = pixmap.scaled(int(self.scene.width()), int(self.scene.height()),
-                                          Qt.AspectRatioMode.KeepAspectRatioByExpanding, # Fit by expanding/cropping
-                                          Qt.TransformationMode.SmoothTransformation)
-            bg_item.setPixmap(scaled_pixmap)
-            bg_item.setPos((self.scene.width() - scaled_pixmap.width()) / 2,
-                           (self.scene.height() - scaled_pixmap.height()) / 2)
-
-            self.scene.addItem(bg_item) # Add new bg image first
+            add_menu_background(self.scene, pixmap) # Add new bg image first
             self.view.fitInView(self.scene.sceneRect(), Qt.AspectRatioMode.KeepAspectRatio)
             self.log_message(f"背景画像を設定しました: {file_path}")
             self.update_menu_layout() # Then add title and buttons
@@ -720,6 +6488,7 @@ class MainWindow(QMainWindow):
         for i, time in enumerate(all_chapters):
             self.chapter_list_widget.addItem(f"チャプター {i+1}: {time}")
 
+    @traced()
     def update_menu_layout(self, loaded_data=None):
         saved_button_props = {}
         for btn in self.menu_buttons:
@@ -753,14 +6522,18 @@ class MainWindow(QMainWindow):
             }
             self.create_title_item(title_props_to_use)
 
-            all_chapters = sorted(['00:00:00'] + self.chapters)
-            for i, chapter_time in enumerate(all_chapters):
+            if self.extra_titles:
+                # 複数タイトルのディスクではタイトルごとにボタンを置く
+                entries = [(f"title:{n}", title["name"] or f"Title {n}") for n, title in enumerate(self.get_titles(), start=1)]
+            else:
+                entries = [(t, f"Chapter {i+1}") for i, t in enumerate(sorted(['00:00:00'] + self.chapters))]
+            for i, (chapter_time, text) in enumerate(entries):
                 props = saved_button_props.get(chapter_time)
                 if props:
                     self.create_menu_button(props, chapter_time)
                 else:
                     self.create_menu_button({
-                        "text": f"Chapter {i+1}", "pos_x": 100, "pos_y": 150 + i * 70,
+                        "text": text, "pos_x": 100, "pos_y": 150 + i * 70,
                         "font_family": self.default_button_font_family,
                         "font_size": self.default_button_font_size,
                         "font_color": self.default_button_font_color,
@@ -780,36 +6553,16 @@ class MainWindow(QMainWindow):
                 "font_color": self.default_title_font_color,
                 "is_bold": False, "is_italic": False
             }
-        self.title_item = DraggableTextItem(properties.get("text", "Title"))
+        self.title_item = add_menu_title(self.scene, properties, dict(
+            MENU_DEFAULT_TITLE, font_family=self.default_title_font_family, font_size=self.default_title_font_size,
+            font_color=self.default_title_font_color))
         self.title_item.clicked.connect(self.on_item_selected)
-        self.title_item.setProperty("font_family", properties.get("font_family", self.default_title_font_family))
-        self.title_item.setProperty("font_size", properties.get("font_size", self.default_title_font_size))
-        self.title_item.setProperty("font_color", properties.get("font_color", self.default_title_font_color))
-        self.title_item.setProperty("is_bold", properties.get("is_bold", False))
-        self.title_item.setProperty("is_italic", properties.get("is_italic", False))
-        self.apply_text_item_style(self.title_item)
-        self.scene.addItem(self.title_item)
-        self.title_item.setPos(properties.get("pos_x", 100), properties.get("pos_y", 50))
 
     def create_menu_button(self, properties, chapter_time):
-        button = QTextEdit()
-        button.setText(properties["text"])
-        button.setReadOnly(True)
-
-        proxy_widget = DraggableProxyWidget()
-        proxy_widget.setWidget(button)
+        proxy_widget = add_menu_button(self.scene, properties, chapter_time, dict(
+            MENU_DEFAULT_BUTTON, font_family=self.default_button_font_family, font_size=self.default_button_font_size,
+            font_color=self.default_button_font_color))
         proxy_widget.clicked.connect(self.on_item_selected)
-        proxy_widget.setProperty("time_str", chapter_time)
-        proxy_widget.setProperty("font_family", properties.get("font_family", self.default_button_font_family))
-        proxy_widget.setProperty("font_size", properties.get("font_size", self.default_button_font_size))
-        proxy_widget.setProperty("font_color", properties.get("font_color", self.default_button_font_color))
-        proxy_widget.setProperty("is_bold", properties.get("is_bold", False))
-        proxy_widget.setProperty("is_italic", properties.get("is_italic", False))
-        self.apply_button_style(proxy_widget)
-        self.scene.addItem(proxy_widget)
-        proxy_widget.setPos(properties["pos_x"], properties["pos_y"])
-        if "width" in properties and "height" in properties:
-            proxy_widget.resize(properties["width"], properties["height"])
         self.menu_buttons.append(proxy_widget)
 
     def on_item_selected(self, item):
@@ -930,42 +6683,10 @@ class MainWindow(QMainWindow):
                 self.title_color_button.setStyleSheet(f"background-color: {color_hex};")
 
     def apply_button_style(self, button_proxy):
-        font_family = button_proxy.property("font_family")
-        font_size = button_proxy.property("font_size")
-        font_color = button_proxy.property("font_color")
-        is_bold = button_proxy.property("is_bold")
-        is_italic = button_proxy.property("is_italic")
-
-        font_weight = "bold" if is_bold else "normal"
-        font_style = "italic" if is_italic else "normal"
-
-        style = f"""QTextEdit {{
-                    background-color: rgba(0, 0, 0, 0.6);
-                    color: {font_color};
-                    border: 1px solid white;
-                    border-radius: 5px;
-                    padding: 10px;
-                    font-family: '{font_family}';
-                    font-size: {font_size}px;
-                    font-weight: {font_weight};
-                    font-style: {font_style};
-                }}"""
-        button_proxy.widget().setStyleSheet(style)
-
-        if isinstance(button_proxy.widget(), QTextEdit):
-            button_proxy.widget().setAlignment(Qt.AlignCenter)
+        style_menu_button(button_proxy)
 
     def apply_text_item_style(self, text_item):
-        font = QFont()
-        font.setFamily(text_item.property("font_family"))
-        font.setPointSize(text_item.property("font_size"))
-        font.setBold(text_item.property("is_bold"))
-        font.setItalic(text_item.property("is_italic"))
-
-        text_item.setFont(font)
-        text_item.setDefaultTextColor(QColor(text_item.property("font_color")))
-        # Optionally adjust width to fit text if needed
-        # text_item.adjustSize()
+        style_menu_text(text_item)
 
     def get_item_properties(self, item):
         props = {
@@ -1017,6 +6738,8 @@ class MainWindow(QMainWindow):
             props = self.get_item_properties(proxy_widget)
             props["text"] = proxy_widget.widget().toPlainText() # .text() -> .toPlainText()
             layout_data["buttons"].append(props)
+        if self.extra_titles:
+            layout_data["titles"] = self.extra_titles
         try:
             with open(save_path, 'w', encoding='utf-8') as f:
                 json.dump(layout_data, f, indent=4, ensure_ascii=False)
@@ -1029,18 +6752,63 @@ class MainWindow(QMainWindow):
         if not load_path:
             return
         try:
-            with open(load_path, 'r', encoding='utf-8') as f:
-                layout_data = json.load(f)
-            self.chapters = layout_data.get("chapters", [])
-            self.update_chapter_list_widget()
-            self.background_image_path = layout_data["background"]
-            self.set_background_image(self.background_image_path)
-            # Update_menu_layout handles both title and buttons now
-            self.update_menu_layout(loaded_data=layout_data)
+            self.apply_layout_file(load_path)
             self.log_message(f"レイアウトを読み込みました: {load_path}")
         except Exception as e:
             self.log_message(f"レイアウトの読み込みに失敗しました: {e}")
 
+    def apply_layout_file(self, load_path):
+        """
+        保存したレイアウト (背景・チャプター・タイトル・ボタン、任意でオーサリング設定) を反映する。
+        ディスクセットのプロジェクトのように "video" があれば、タイトル1の動画も選択する。
+        """
+        with open(load_path, 'r', encoding='utf-8') as f:
+            layout_data = json.load(f)
+        self.chapters = layout_data.get("chapters", [])
+        self.update_chapter_list_widget()
+        # 共有フォルダに置いたレイアウトは、レイアウトファイルからの相対パスで背景や追加タイトルを指定できる
+        base_dir = os.path.dirname(os.path.abspath(load_path))
+        self.extra_titles = [{"name": title.get("name", ""), "chapters": list(title.get("chapters", [])),
+                              "sources": [os.path.join(base_dir, path) for path in title["sources"]]}
+                             for title in layout_data.get("titles", [])]
+        self.update_title_list_widget()
+        if layout_data.get("video"):
+            self.set_video_file(os.path.join(base_dir, layout_data["video"]), preview=self.isVisible())
+        background = layout_data["background"]
+        if not os.path.isabs(background):
+            background = os.path.join(base_dir, background)
+        self.background_image_path = background
+        self.set_background_image(self.background_image_path)
+        # Update_menu_layout handles both title and buttons now
+        self.update_menu_layout(loaded_data=layout_data)
+        self.apply_authoring_options(layout_data.get("authoring", {}))
+        return layout_data
+
+    def apply_authoring_options(self, options):
+        """ レイアウトの "authoring" 項目 (無人オーサリング用) を各設定に反映する """
+        for key, combo in (("encoder", self.encoder_combo_box), ("resolution_fps", self.resolution_combo_box),
+                           ("media", self.media_combo_box), ("preset", self.preset_combo_box),
+                           ("output_format", self.output_format_combo)):
+            if key in options:
+                index = combo.findData(options[key])
+                if index < 0:
+                    raise ValueError(f"authoring.{key} の値が不正です: {options[key]}")
+                combo.setCurrentIndex(index)
+        for key, checkbox in (("normalize_loudness", self.loudnorm_checkbox), ("analyze_source", self.analysis_checkbox),
+                              ("interactive_menu", self.interactive_menu_checkbox)):
+            if key in options:
+                checkbox.setChecked(bool(options[key]))
+        if "secondary_outputs" in options:
+            unknown = set(options["secondary_outputs"]) - set(SECONDARY_OUTPUTS)
+            if unknown:
+                raise ValueError(f"authoring.secondary_outputs の値が不正です: {', '.join(sorted(unknown))}")
+            for name, checkbox in self.secondary_checkboxes.items():
+                checkbox.setChecked(name in options["secondary_outputs"])
+        if "verify_ssim_floor" in options:
+            self.verify_checkbox.setChecked(options["verify_ssim_floor"] is not None)
+            if options["verify_ssim_floor"] is not None:
+                self.verify_floor_spinbox.setValue(float(options["verify_ssim_floor"]))
+
     def start_authoring(self):
         if not self.selected_video_path or not self.background_image_path:
             self.log_message("エラー: 動画ファイルと背景画像の両方を選択してください。")
@@ -1048,192 +6816,174 @@ class MainWindow(QMainWindow):
 
         # 処理開始前にパスをリセット
         self.toggle_ui_elements(False)
-        self.encoded_video_path = None
-        self.menu_video_path = None
         self.generated_iso_path = None
         self.burn_button.setEnabled(False) # 書き込みボタンを無効化
 
         self.log_output.clear()
         self.log_message("オーサリング準備中...")
-        output_dir = os.path.dirname(self.selected_video_path)
+        trace = get_tracer().start_capture() # メニュー画像の描画からジョブのトレースに含める
+        output_dir = self.output_dir or os.path.dirname(self.selected_video_path)
         self.menu_image_path = os.path.join(output_dir, "menu_image.png").replace('\\', '/')
+        menu_buttons = None
+        if self.interactive_menu_checkbox.isChecked() and self.menu_buttons:
+            # ボタンは IG で重ねるので、背景動画には焼き込まない
+            menu_buttons = [dict(self.get_item_properties(proxy_widget), text=proxy_widget.widget().toPlainText())
+                            for proxy_widget in self.menu_buttons]
         try:
             # Ensure no item is selected visually before rendering
             for item in self.scene.selectedItems():
                 item.setSelected(False)
-            self.render_scene_to_image(self.menu_image_path)
+            out_width, out_height, _ = parse_resolution_fps(self.resolution_combo_box.currentData())
+            if menu_buttons:
+                for proxy_widget in self.menu_buttons:
+                    proxy_widget.setVisible(False)
+            try:
+                with trace.activate(), pipeline_stage("menu_render", outputs=[self.menu_image_path],
+                                                      report=get_metrics_collector().record_stage):
+                    self.render_scene_to_image(self.menu_image_path, out_width, out_height)
+            finally:
+                for proxy_widget in self.menu_buttons:
+                    proxy_widget.setVisible(True)
             self.log_message(f"メニュー画像を保存しました: {self.menu_image_path}")
-
-            # --- 並行エンコード開始 ---
-            self.start_menu_encoding_process(self.menu_image_path) # メニュー動画
-            self.start_encoding_process() # 本編動画
-
         except Exception as e:
             self.encoding_error(f"メニュー画像の生成に失敗: {e}")
+            return
 
-    def render_scene_to_image(self, save_path):
-        scene_rect = self.scene.sceneRect()
-        image = QImage(scene_rect.size().toSize(), QImage.Format.Format_ARGB32)
-        image.fill(Qt.GlobalColor.transparent)
-        painter = QPainter(image)
-
-        self.scene.show_grid = False # グリッドを非表示
-        try:
-            # Ensure correct rendering area
-            self.scene.render(painter, target=scene_rect, source=scene_rect)
-        finally:
-            self.scene.show_grid = True # 終わったら元に戻す
-
-        painter.end()
-        image.save(save_path)
-
-    def start_menu_encoding_process(self, image_path):
-        self.log_message("メニュー動画エンコード準備中...")
-        ffmpeg_path = self.find_ffmpeg(for_menu=True)
+        ffmpeg_path = self.find_ffmpeg()
         if not ffmpeg_path:
             self.encoding_error("ffmpegが見つかりません。")
             return
-
-        resolution_fps = self.resolution_combo_box.currentData()
+        if not self.encoder_combo_box.currentData():
+            self.encoding_error("使用できる映像エンコーダがありません。")
+            return
+        tsmuxer_exe_path = self.find_tsmuxer()
+        if not tsmuxer_exe_path:
+            self.encoding_error("tsMuxeR.exe (または tsMuxeR) が main.py と同じフォルダに見つかりませんでした。")
+            return
 
         # メニューの長さを設定 (今は10秒で固定)
         self.menu_duration_sec = 10.0
 
-        worker = MenuEncoderWorker(image_path, self.menu_duration_sec, resolution_fps, ffmpeg_path)
+        preset, threads = self.resolve_encoder_preset()
+
+        job = AuthoringJob(self.selected_video_path, self.chapters, self.menu_image_path,
+                           self.encoder_combo_box.currentData(), self.resolution_combo_box.currentData(),
+                           ffmpeg_path, tsmuxer_exe_path, ffprobe_path=self.find_ffprobe(),
+                           menu_duration_sec=self.menu_duration_sec,
+                           normalize_loudness=self.loudnorm_checkbox.isChecked(),
+                           subtitle_tracks=self.subtitle_tracks,
+                           subtitle_font_family=self.get_menu_font_family(),
+                           analyze_source=self.analysis_checkbox.isChecked(),
+                           media_target=self.media_combo_box.currentData(),
+                           preset=preset, threads=threads,
+                           verify_ssim_floor=self.verify_floor_spinbox.value() if self.verify_checkbox.isChecked() else None,
+                           check_iso=self.check_iso, output_format=self.output_format_combo.currentData(),
+                           secondary_outputs=[name for name, checkbox in self.secondary_checkboxes.items() if checkbox.isChecked()],
+                           trace=trace, output_dir=output_dir, coordinator=self.encode_coordinator,
+                           threadpool=self.threadpool, titles=self.get_titles() if self.extra_titles else None,
+                           menu_buttons=menu_buttons, parent=self)
+        job.log.connect(self.log_message)
+        job.finished.connect(self.authoring_finished) # 完了ハンドラ
+        job.error.connect(self.encoding_error)
+        job.plan_ready.connect(self.show_plan)
+        get_metrics_collector().watch_job(job)
+        get_job_history_recorder().watch_job(job)
+        self.current_job = job
+        job.start()
+
+    def current_video_encoder(self):
+        """ 出力設定で実際に使うエンコーダ (UHD は選択によらず libx265) """
+        return video_encoder_for(self.encoder_combo_box.currentData(), self.resolution_combo_box.currentData())
+
+    def resolve_encoder_preset(self):
+        encoder = self.current_video_encoder()
+        if self.preset_combo_box.currentData() != "auto":
+            return self.preset_combo_box.currentData(), None
+        preset, threads, reason = select_encoder_preset(encoder, self.resolution_combo_box.currentData(),
+                                                        self.quality_floor_spinbox.value())
+        self.log_message(f"エンコーダ設定: {encoder} preset={preset} threads={threads or 'auto'} ({reason})")
+        return preset, threads
+
+    def start_preset_benchmark(self):
+        ffmpeg_path = self.find_ffmpeg()
+        if not ffmpeg_path:
+            self.log_message("エラー: ffmpegが見つかりません。")
+            return
+        self.benchmark_button.setEnabled(False)
+        worker = PresetBenchmarkWorker(self.current_video_encoder(), self.resolution_combo_box.currentData(), ffmpeg_path)
         worker.signals.log.connect(self.log_message)
-        worker.signals.finished.connect(self.menu_encoding_finished)
-        worker.signals.error.connect(self.encoding_error)
+        worker.signals.finished.connect(self.preset_benchmark_finished)
+        worker.signals.error.connect(self.preset_benchmark_finished)
         self.threadpool.start(worker)
 
-    def start_encoding_process(self):
-        self.log_message("本編エンコード準備中...")
+    def preset_benchmark_finished(self, message):
+        self.benchmark_button.setEnabled(True)
+        preset, threads, reason = select_encoder_preset(self.current_video_encoder(),
+                                                        self.resolution_combo_box.currentData(),
+                                                        self.quality_floor_spinbox.value())
+        self.log_message(f"{message}\n自動選択されるプリセット: {preset} threads={threads or 'auto'} ({reason})")
+
+    def start_estimate_process(self):
+        media = self.media_combo_box.currentData()
+        if not self.selected_video_path or not media:
+            self.log_message("エラー: 動画ファイルと収めるメディアを選択してください。")
+            return
         ffmpeg_path = self.find_ffmpeg()
         if not ffmpeg_path:
-            self.encoding_error("ffmpegが見つかりません。")
+            self.log_message("エラー: ffmpegが見つかりません。")
             return
-
-        encoder = self.encoder_combo_box.currentData()
-        resolution_fps = self.resolution_combo_box.currentData()
-
-        # EncoderWorkerのコンストラクタに ffmpeg_path を渡す
-        worker = EncoderWorker(self.selected_video_path, self.chapters, encoder, resolution_fps, ffmpeg_path)
-
+        self.estimate_button.setEnabled(False)
+        self.plan_label.setText("予測サイズ: 見積もり中...")
+        worker = PlanningWorker(self.selected_video_path, self.encoder_combo_box.currentData(),
+                                self.resolution_combo_box.currentData(), media, ffmpeg_path, self.find_ffprobe(),
+                                analyze_source=self.analysis_checkbox.isChecked(), menu_duration_sec=self.menu_duration_sec,
+                                subtitle_count=len(self.subtitle_tracks), normalize_loudness=self.loudnorm_checkbox.isChecked(),
+                                preset=self.resolve_encoder_preset()[0])
         worker.signals.log.connect(self.log_message)
-        worker.signals.finished.connect(self.encoding_finished)
-        worker.signals.error.connect(self.encoding_error)
+        worker.signals.result.connect(self.show_plan)
+        worker.signals.error.connect(self.estimate_failed)
         self.threadpool.start(worker)
 
-    def start_muxing_process(self):
-        if not self.menu_video_path or not self.encoded_video_path:
-            self.encoding_error("致命的エラー: Mux処理が呼ばれましたが、動画ファイルが不足しています。")
-            return
-
-        output_dir = os.path.dirname(self.selected_video_path)
-        iso_output_path = os.path.join(output_dir, "BDMV_MENU.iso").replace('\\', '/')
-        meta_path = os.path.join(output_dir, "tsmuxer.meta").replace('\\', '/')
-
-        # --- FPS文字列の決定 ---
-        resolution_fps_str = self.resolution_combo_box.currentData()
-        fps_str = "23.976" # Default
-        if resolution_fps_str:
-            if ":" in resolution_fps_str:
-                 fps_part = resolution_fps_str.split(':')[1]
-                 if fps_part == "60": fps_str = "59.94" # Correct BD FPS for 60
-                 elif fps_part == "30": fps_str = "29.97" # Correct BD FPS for 30
-                 elif "24000/1001" in fps_part: fps_str="23.976"
-
-        # --- チャプターオフセット計算 ---
-        # ヘルパー関数: HH:MM:SS -> float(秒)
-        def time_to_sec(t):
-            h, m, s = map(int, t.split(':'))
-            return float(h * 3600 + m * 60 + s)
-
-        # ヘルパー関数: float(秒) -> HH:MM:SS (ミリ秒を削除)
-        def sec_to_time(s_float):
-            s = int(round(s_float)) # ミリ秒を丸める
-            h = s // 3600
-            m = (s % 3600) // 60
-            s = s % 60
-            return f"{h:02}:{m:02}:{s:02}" 
-
-        offset_sec = self.menu_duration_sec # メニュー動画の長さ
-        all_chapters_time = sorted(['00:00:00'] + self.chapters)
-
-        offset_chapters_list = []
-        for time_str in all_chapters_time:
-            original_sec = time_to_sec(time_str)
-            offset_chapters_list.append(sec_to_time(original_sec + offset_sec))
-
-        # 最終的なチャプターリスト (ミリ秒なし)
-        final_chapters_list = ["00:00:00"] + offset_chapters_list 
-        chapters_str = ";".join(final_chapters_list)
-
-        # --- .meta ファイル生成 (tsMuxeR構文エラー修正済み) ---
-        
-        # MUXOPT行にチャプター情報 (--chapters="...") を含めるように修正
-        meta_content = f'MUXOPT --no-pcr-on-video-pid --new-audio-pes --vbr --vbv-len=500 --blu-ray-iso --chapters="{chapters_str}"\n'
-
-        # (↑の行に統合したため、この行は削除します)
-        # meta_content += f'CHAPTERS {chapters_str}\n'
-        
-        # トラック1: メニュー
-        meta_content += f'V_MPEG4/ISO/AVC, "{self.menu_video_path}", track=1, fps={fps_str}\n'
-        meta_content += f'A_AC3, "{self.menu_video_path}", track=1\n' # (無音オーディオトラック)
-
-        # トラック2: 本編
-        meta_content += f'V_MPEG4/ISO/AVC, "{self.encoded_video_path}", track=1, fps={fps_str}\n'
-        meta_content += f'A_AC3, "{self.encoded_video_path}", track=1\n' # (本編オーディオトラック、timeshift不要)
-
+    def show_plan(self, plan):
+        self.estimate_button.setEnabled(True)
+        self.plan_label.setText(f"予測サイズ: {describe_plan(plan)}")
 
-        # --- tsMuxeR 実行 ---
-        try:
-            with open(meta_path, 'w', encoding='utf-8') as f:
-                f.write(meta_content)
-            self.log_message("tsMuxeR用の設定ファイルを作成しました (メニュー + 本編)。")
-        except Exception as e:
-            self.encoding_error(f"tsMuxeR設定ファイルの作成に失敗: {e}")
-            return
+    def estimate_failed(self, message):
+        self.estimate_button.setEnabled(True)
+        self.plan_label.setText("予測サイズ: -")
+        self.log_message(f"❌ {message}")
 
-        tsmuxer_exe_path = self.find_tsmuxer()
-        if not tsmuxer_exe_path:
-             self.encoding_error("tsMuxeR.exe (または tsMuxeR) が main.py と同じフォルダに見つかりませんでした。")
-             return
+    def get_menu_font_family(self):
+        # 字幕はメニューボタンと同じフォントで描画する
+        if self.menu_buttons:
+            return self.menu_buttons[0].property("font_family") or self.default_button_font_family
+        return self.default_button_font_family
 
-        worker = AuthoringWorker(tsmuxer_exe_path, meta_path, iso_output_path) # 出力先をISOに変更
-        worker.signals.log.connect(self.log_message)
-        worker.signals.finished.connect(self.authoring_finished) # 完了ハンドラ
-        worker.signals.error.connect(self.encoding_error)
-        self.threadpool.start(worker)
+    @traced()
+    def render_scene_to_image(self, save_path, width=None, height=None):
+        render_menu_scene(self.scene, save_path, width, height)
 
     # --- ▼ ステップ1 修正箇所 (2/3) ▼ ---
     def find_ffmpeg(self, for_menu=False):
         # 修正: os.path.dirname(os.path.abspath(__file__)) を get_base_path() に変更
-        base_path = get_base_path()
-        exe_name = "ffmpeg.exe" if sys.platform == "win32" else "ffmpeg"
-        local_path = os.path.join(base_path, exe_name)
-        
-        if os.path.exists(local_path):
-            return local_path
-        system_ffmpeg = shutil.which(exe_name)
-        if system_ffmpeg:
-            return system_ffmpeg
-        return None
+        # 探索はツールレジストリが行い、見つけた場所を覚えておく
+        if "ffmpeg" in self.tool_paths:
+            return self.tool_paths["ffmpeg"]
+        return get_tool_registry().locate("ffmpeg")
     # --- ▲ ステップ1 修正箇所 (2/3) ▲ ---
 
+    def find_ffprobe(self):
+        # ffprobe は任意 (無い場合は ffmpeg -i の出力からプローブする)
+        if "ffprobe" in self.tool_paths:
+            return self.tool_paths["ffprobe"]
+        return get_tool_registry().locate("ffprobe")
+
     # --- ▼ ステップ1 修正箇所 (3/3) ▼ ---
     def find_tsmuxer(self):
         # 修正: os.path.dirname(os.path.abspath(__file__)) を get_base_path() に変更
-        base_path = get_base_path()
-        exe_name = "tsMuxeR.exe" if sys.platform == "win32" else "tsMuxeR"
-        local_path = os.path.join(base_path, exe_name)
-
-        if os.path.exists(local_path):
-            return local_path
-        # PATHも探す (オプション)
-        system_path = shutil.which(exe_name)
-        if system_path:
-            return system_path
-        return None
+        if "tsMuxeR" in self.tool_paths:
+            return self.tool_paths["tsMuxeR"]
+        return get_tool_registry().locate("tsMuxeR") # main.py と同じフォルダ → PATH
     # --- ▲ ステップ1 修正箇所 (3/3) ▲ ---
 
     def start_burning_process(self):
@@ -1249,7 +6999,8 @@ class MainWindow(QMainWindow):
         self.log_message(f"書き込み処理を開始します (ドライブ: {drive_id}, ISO: {self.generated_iso_path})")
         self.toggle_ui_elements(False) # UIを無効化
 
-        worker = BurnerWorker(self.generated_iso_path, drive_id)
+        worker = BurnerWorker(self.generated_iso_path, drive_id, verify=self.readback_checkbox.isChecked())
+        get_metrics_collector().watch(worker.signals, "burn")
         worker.signals.log.connect(self.log_message)
         worker.signals.error.connect(self.encoding_error) # 既存のエラー処理を流用
         worker.signals.finished.connect(self.burning_finished) # 新しい完了処理
@@ -1257,63 +7008,78 @@ class MainWindow(QMainWindow):
         self.threadpool.start(worker)
 
     def populate_drive_list(self):
-        self.drive_combo.clear()
+        """ 前回の一覧をすぐに表示し、列挙はバックグラウンドで行う (以降は一定間隔で更新する) """
+        if sys.platform not in ("win32", "darwin"):
+            self.log_message(f"非対応OSのためドライブを取得できません: {sys.platform}")
+            return
+        cached = load_drive_cache()
+        if cached is not None:
+            self.update_drive_list(cached, announce=False)
         self.log_message("書き込みドライブを検索中...")
-        try:
-            if sys.platform == "win32":
-                # Windows: 'wmic' を使ってドライブレターを取得
-                output = subprocess.check_output(['wmic', 'cdrom', 'get', 'Drive, MediaType'],
-                                                 universal_newlines=True,
-                                                 creationflags=subprocess.CREATE_NO_WINDOW)
-                for line in output.splitlines():
-                    match = re.match(r'^\s*([A-Z]:)\s*(.*)', line)
-                    if match:
-                        drive = match.group(1)
-                        media_type = match.group(2).strip()
-                        if not media_type:
-                            media_type = "メディアなし"
-                        self.drive_combo.addItem(f"{drive} ({media_type})", drive) # 表示名, 内部ID
-                if self.drive_combo.count() > 0:
-                     self.log_message(f"{self.drive_combo.count()}個のドライブを見つけました。")
-                else:
-                     self.log_message("書き込み可能なドライブが見つかりませんでした。")
+        self.refresh_drive_list()
+        self.drive_timer = QTimer(self)
+        self.drive_timer.timeout.connect(self.refresh_drive_list)
+        self.drive_timer.start(DRIVE_REFRESH_SEC * 1000)
 
-            elif sys.platform == "darwin":
-                # macOS: 'drutil list' を使ってドライブIDを取得
-                output = subprocess.check_output(['drutil', 'list'], universal_newlines=True)
-                # 'drutil list' の出力をパースして、実際のドライブID（disk2など）を取得
-                current_device = None
-                for line in output.splitlines():
-                    if "Vendor" in line and "Product" in line:
-                         # 新しいデバイスセクションの開始
-                         match = re.search(r'/dev/(disk\d+)', line)
-                         if match:
-                             current_device = match.group(1)
-                    if current_device and "Type" in line and ("CD" in line or "DVD" in line or "BD" in line):
-                         # 光学ドライブである可能性が高い
-                         self.drive_combo.addItem(f"{current_device} (光学ドライブ)", current_device)
-                         current_device = None # 重複追加を防ぐ
-
-                if self.drive_combo.count() > 0:
-                     self.log_message(f"{self.drive_combo.count()}個のドライブを見つけました。")
-                else:
-                     self.log_message("書き込み可能なドライブが見つかりませんでした。")
+    def refresh_drive_list(self):
+        if self.drive_scan_running:
+            return
+        self.drive_scan_running = True
+        worker = DriveListWorker()
+        worker.signals.result.connect(self.update_drive_list)
+        worker.signals.error.connect(self.drive_scan_failed)
+        self.threadpool.start(worker)
 
-            else:
-                self.log_message(f"非対応OSのためドライブを取得できません: {sys.platform}")
+    def update_drive_list(self, drives, announce=True):
+        self.drive_scan_running = False
+        drives = [tuple(drive) for drive in drives]
+        if drives == self.drives:
+            return # 変化が無ければ選択状態もログもそのまま
+        self.drives = drives
+        selected = self.drive_combo.currentData()
+        self.drive_combo.clear()
+        for label, drive_id in drives:
+            self.drive_combo.addItem(label, drive_id)
+        self.drive_combo.setCurrentIndex(self.drive_combo.findData(selected) if selected else -1)
+        if not announce:
+            return
+        if drives:
+            self.log_message(f"{len(drives)}個のドライブを見つけました。")
+        else:
+            self.log_message("書き込み可能なドライブが見つかりませんでした。")
 
-        except Exception as e:
-            self.log_message(f"ドライブ一覧の取得に失敗: {e}")
+    def drive_scan_failed(self, message):
+        self.drive_scan_running = False
+        if self.drives is None:
+            self.log_message(message) # 定期更新での失敗は毎回ログに出さない
+            self.drives = []
+
+    def ensure_player(self):
+        """ メディアバックエンドの初期化は重いので、最初に動画を読み込むときに行う """
+        if self.player is not None:
+            return
+        from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
+        from PySide6.QtMultimediaWidgets import QVideoWidget
+        self.player = QMediaPlayer()
+        self.audio_output = QAudioOutput()
+        self.player.setAudioOutput(self.audio_output)
+        self.player.positionChanged.connect(self.update_timecode)
+        self.player.durationChanged.connect(self.update_timecode)
+        self.video_widget = QVideoWidget()
+        self.video_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.video_widget.setAspectRatioMode(Qt.AspectRatioMode.KeepAspectRatioByExpanding)
+        self.player.setVideoOutput(self.video_widget)
+        self.video_container.layout().addWidget(self.video_widget)
 
     def play_video(self):
-        if self.player.playbackState() == QMediaPlayer.PlaybackState.PlayingState:
+        if self.player.isPlaying():
             self.player.pause()
             self.play_button.setText("再生")
         else:
             self.player.play()
             self.play_button.setText("一時停止")
     def add_chapter_from_video(self):
-        if self.player.source().isEmpty():
+        if self.player is None or self.player.source().isEmpty():
             return
         milliseconds = self.player.position()
         time_str = self.format_time(milliseconds)
@@ -1362,8 +7128,35 @@ class MainWindow(QMainWindow):
         self.save_layout_button.clicked.connect(self.save_layout)
         self.load_layout_button = QPushButton("レイアウトを読み込み...")
         self.load_layout_button.clicked.connect(self.load_layout)
+        self.add_subtitle_button = QPushButton("字幕ファイルを追加...")
+        self.add_subtitle_button.clicked.connect(self.open_subtitle_dialog)
+        self.remove_subtitle_button = QPushButton("選択した字幕を削除")
+        self.remove_subtitle_button.clicked.connect(self.remove_selected_subtitle)
+        self.subtitle_list_widget = QListWidget()
+        self.subtitle_list_widget.setMaximumHeight(70)
+        subtitle_button_layout = QHBoxLayout()
+        subtitle_button_layout.addWidget(self.add_subtitle_button)
+        subtitle_button_layout.addWidget(self.remove_subtitle_button)
+        self.add_title_button = QPushButton("タイトルを追加...")
+        self.add_title_button.clicked.connect(self.open_title_dialog)
+        self.remove_title_button = QPushButton("選択したタイトルを削除")
+        self.remove_title_button.clicked.connect(self.remove_selected_title)
+        self.title_list_widget = QListWidget()
+        self.title_list_widget.setMaximumHeight(70)
+        self.title_list_widget.currentRowChanged.connect(self.show_title_chapters)
+        self.title_chapters_input = QLineEdit()
+        self.title_chapters_input.setPlaceholderText("選択したタイトルのチャプター (HH:MM:SS をカンマ区切り)")
+        self.title_chapters_input.editingFinished.connect(self.set_title_chapters)
+        title_button_layout = QHBoxLayout()
+        title_button_layout.addWidget(self.add_title_button)
+        title_button_layout.addWidget(self.remove_title_button)
         layout.addWidget(self.select_file_button)
         layout.addWidget(self.file_path_label)
+        layout.addLayout(subtitle_button_layout)
+        layout.addWidget(self.subtitle_list_widget)
+        layout.addLayout(title_button_layout)
+        layout.addWidget(self.title_list_widget)
+        layout.addWidget(self.title_chapters_input)
         layout.addWidget(self.select_bg_button)
         layout.addWidget(self.save_layout_button)
         layout.addWidget(self.load_layout_button)
@@ -1374,13 +7167,13 @@ class MainWindow(QMainWindow):
         panel, content = self.create_panel_widget("ビデオプレビュー")
         panel.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
         layout = QVBoxLayout(content)
-        self.video_widget = QVideoWidget()
-
-        self.video_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-
-        self.video_widget.setAspectRatioMode(Qt.AspectRatioMode.KeepAspectRatioByExpanding)
-
-        self.player.setVideoOutput(self.video_widget)
+        # QVideoWidget は ensure_player で作ってこの中に入れる
+        self.video_container = QWidget()
+        self.video_container.setObjectName("videoContainer")
+        self.video_container.setAttribute(Qt.WidgetAttribute.WA_StyledBackground, True)
+        self.video_container.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        video_container_layout = QVBoxLayout(self.video_container)
+        video_container_layout.setContentsMargins(0, 0, 0, 0)
         controls_layout = QGridLayout()
         self.play_button = QPushButton("再生")
         self.play_button.setEnabled(False)
@@ -1402,7 +7195,7 @@ class MainWindow(QMainWindow):
         self.skip_button.clicked.connect(self.skip_video)
         self.add_chapter_from_video_button.clicked.connect(self.add_chapter_from_video)
 
-        layout.addWidget(self.video_widget, 1)
+        layout.addWidget(self.video_container, 1)
         layout.addLayout(controls_layout)
         return panel
 
@@ -1412,7 +7205,7 @@ class MainWindow(QMainWindow):
         layout = QVBoxLayout(content)
 
         self.scene = GridGraphicsScene()
-        self.scene.setSceneRect(0, 0, 1920, 1080) # 16:9
+        self.scene.setSceneRect(0, 0, MENU_LAYOUT_WIDTH, MENU_LAYOUT_HEIGHT) # 16:9 論理座標 (出力解像度とは独立)
 
         # QGraphicsView を AspectRatioGraphicsView に変更
         self.view = AspectRatioGraphicsView(self.scene)
@@ -1541,19 +7334,72 @@ class MainWindow(QMainWindow):
         # --- Encoding Settings ---
         layout.addWidget(QLabel("エンコード設定"))
         self.encoder_combo_box = QComboBox()
-        self.encoder_combo_box.addItem("CPU (高品質)", "libx264")
-        self.encoder_combo_box.addItem("NVIDIA (高速)", "h264_nvenc")
-        self.encoder_combo_box.addItem("AMD (高速)", "h264_amf")
-        self.encoder_combo_box.addItem("Intel (高速)", "h264_qsv")
+        for label, encoder in VIDEO_ENCODER_CHOICES:
+            self.encoder_combo_box.addItem(label, encoder)
         layout.addWidget(self.encoder_combo_box)
+        preset_layout = QHBoxLayout()
+        self.preset_combo_box = QComboBox()
+        self.preset_combo_box.addItem("プリセット: 自動 (ベンチマーク結果)", "auto")
+        self.preset_combo_box.addItem("プリセット: medium", "medium")
+        preset_layout.addWidget(self.preset_combo_box, 1)
+        preset_layout.addWidget(QLabel("SSIM下限:"))
+        self.quality_floor_spinbox = QDoubleSpinBox()
+        self.quality_floor_spinbox.setRange(0.80, 0.999)
+        self.quality_floor_spinbox.setDecimals(3)
+        self.quality_floor_spinbox.setSingleStep(0.005)
+        self.quality_floor_spinbox.setValue(DEFAULT_QUALITY_FLOOR)
+        preset_layout.addWidget(self.quality_floor_spinbox)
+        self.benchmark_button = QPushButton("ベンチマーク")
+        self.benchmark_button.clicked.connect(self.start_preset_benchmark)
+        preset_layout.addWidget(self.benchmark_button)
+        layout.addLayout(preset_layout)
         self.resolution_combo_box = QComboBox()
         self.resolution_combo_box.addItem("1080p 60fps", "1920x1080:60")
         self.resolution_combo_box.addItem("1080p 30fps", "1920x1080:30")
         self.resolution_combo_box.addItem("1080p 24fps (BD標準)", "1920x1080:24000/1001")
         self.resolution_combo_box.addItem("720p 60fps", "1280x720:60")
         self.resolution_combo_box.addItem("720p 30fps", "1280x720:30")
+        self.resolution_combo_box.addItem("2160p 24fps (UHD BD, HEVC 10bit)", "3840x2160:24000/1001")
+        self.resolution_combo_box.addItem("2160p 60fps (UHD BD, HEVC 10bit)", "3840x2160:60")
         self.resolution_combo_box.setCurrentIndex(2)
         layout.addWidget(self.resolution_combo_box)
+        self.loudnorm_checkbox = QCheckBox("音声ラウドネス正規化 (EBU R128)")
+        layout.addWidget(self.loudnorm_checkbox)
+        self.analysis_checkbox = QCheckBox("ソースを事前解析 (インターレース/テレシネ/黒帯)")
+        self.analysis_checkbox.setChecked(True)
+        layout.addWidget(self.analysis_checkbox)
+        verify_layout = QHBoxLayout()
+        self.verify_checkbox = QCheckBox("品質検証 (SSIM/PSNR)")
+        verify_layout.addWidget(self.verify_checkbox, 1)
+        verify_layout.addWidget(QLabel("SSIM下限:"))
+        self.verify_floor_spinbox = QDoubleSpinBox()
+        self.verify_floor_spinbox.setRange(0.80, 0.999)
+        self.verify_floor_spinbox.setDecimals(3)
+        self.verify_floor_spinbox.setSingleStep(0.005)
+        self.verify_floor_spinbox.setValue(DEFAULT_VERIFY_SSIM_FLOOR)
+        verify_layout.addWidget(self.verify_floor_spinbox)
+        layout.addLayout(verify_layout)
+        layout.addWidget(QLabel("追加出力 (本編と同じデコードから作成):"))
+        secondary_layout = QGridLayout()
+        self.secondary_checkboxes = {}
+        for index, (name, (label, _file_name)) in enumerate(SECONDARY_OUTPUTS.items()):
+            checkbox = QCheckBox(label)
+            self.secondary_checkboxes[name] = checkbox
+            secondary_layout.addWidget(checkbox, index // 2, index % 2)
+        layout.addLayout(secondary_layout)
+        media_layout = QHBoxLayout()
+        self.media_combo_box = QComboBox()
+        self.media_combo_box.addItem("容量合わせなし (CRF 20固定)", None)
+        for media in MEDIA_CAPACITY_BYTES:
+            self.media_combo_box.addItem(f"{media} に収める", media)
+        self.estimate_button = QPushButton("容量を見積もる")
+        self.estimate_button.clicked.connect(self.start_estimate_process)
+        media_layout.addWidget(self.media_combo_box, 1)
+        media_layout.addWidget(self.estimate_button)
+        layout.addLayout(media_layout)
+        self.plan_label = QLabel("予測サイズ: -")
+        self.plan_label.setWordWrap(True)
+        layout.addWidget(self.plan_label)
         separator3 = QFrame(); separator3.setFrameShape(QFrame.Shape.HLine); separator3.setFrameShadow(QFrame.Shadow.Sunken)
         layout.addWidget(separator3)
 
@@ -1582,6 +7428,12 @@ class MainWindow(QMainWindow):
         self.author_button = QPushButton("1. ISOイメージを生成") # ラベル変更
         self.author_button.setObjectName("encode-button")
         self.author_button.clicked.connect(self.start_authoring)
+        self.output_format_combo = QComboBox()
+        for output_format, label in OUTPUT_FORMATS.items():
+            self.output_format_combo.addItem(label, output_format)
+        self.output_format_combo.setToolTip("BDMV フォルダ出力では本編クリップを再利用し、メニューの変更は数秒で反映されます")
+        self.interactive_menu_checkbox = QCheckBox("ボタンを IG で重ねる (リモコンで選べるメニュー)")
+        self.interactive_menu_checkbox.setToolTip("ボタンは背景動画に焼き込まず、選択・決定の表示とジャンプ先を持つ IG ストリームにします")
 
         self.drive_combo = QComboBox()
         self.drive_combo.setPlaceholderText("書き込みドライブを選択...")
@@ -1590,10 +7442,18 @@ class MainWindow(QMainWindow):
         self.burn_button.setObjectName("burn-button")
         self.burn_button.setEnabled(False) # 初期状態は無効
         self.burn_button.clicked.connect(self.start_burning_process)
-
+        self.readback_checkbox = QCheckBox("書き込み後にディスクを読み戻して検証")
+        self.readback_checkbox.setChecked(True)
+
+        output_format_layout = QHBoxLayout()
+        output_format_layout.addWidget(QLabel("出力形式:"))
+        output_format_layout.addWidget(self.output_format_combo, 1)
+        layout.addLayout(output_format_layout)
+        layout.addWidget(self.interactive_menu_checkbox)
         layout.addWidget(self.author_button)
         layout.addWidget(QLabel("書き込みドライブ:"))
         layout.addWidget(self.drive_combo)
+        layout.addWidget(self.readback_checkbox)
         layout.addWidget(self.burn_button)
 
         self.clear_property_panel() # Disable property panels initially
@@ -1609,9 +7469,817 @@ class MainWindow(QMainWindow):
         layout.addWidget(self.log_output, 1)
         return panel
 
+# --- 監視フォルダのデーモン ---
+def parse_deadline(text):
+    """ authoring.deadline (ISO 8601) をローカル時刻の naive な datetime にする """
+    deadline = datetime.fromisoformat(text)
+    return deadline.astimezone().replace(tzinfo=None) if deadline.tzinfo else deadline
+
+class WatchFolderDaemon(QObject):
+    """
+    監視フォルダに届いたマスターを順番にオーサリングする (ウィンドウは表示しない)。
+    成功したら ISO・ログ・トレースと投入されたファイルを output、失敗したら error フォルダへ移す。
+    order が "shortest" なら履歴から見積もった所要時間の短い順、"deadline" ならレイアウトの
+    authoring.deadline (ISO 8601 の日時) の早い順 (締め切りの無いものはその後に短い順) に処理する。
+    """
+    candidate_ready = Signal(object) # 監視スレッド → GUI スレッド
+
+    def __init__(self, window, watch_dirs, output_dir=None, error_dir=None, stable_sec=WATCH_STABLE_SEC,
+                 use_inotify=True, order="fifo", parent=None):
+        super().__init__(parent)
+        self.window = window
+        self.order = order
+        self.watch_dirs = [os.path.abspath(d) for d in watch_dirs]
+        self.output_dir = output_dir
+        self.error_dir = error_dir
+        self.queue = deque()
+        self.queued_fingerprints = set()
+        self.current = None
+        self.history = WatchHistory()
+        self.candidate_ready.connect(self.enqueue)
+        self.watcher = FolderWatcher(self.watch_dirs, self.candidate_ready.emit, stable_sec=stable_sec,
+                                     use_inotify=use_inotify, log=self.print_log)
+
+    @staticmethod
+    def print_log(message):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+    def start(self):
+        self.print_log(f"監視を開始します: {', '.join(self.watch_dirs)}")
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+
+    def result_dir(self, candidate, failed):
+        # 指定が無ければ監視フォルダ内の output / error に置く (直下しか走査しないので再検出されない)
+        base = self.error_dir if failed else self.output_dir
+        base = base or os.path.join(os.path.dirname(candidate["video_path"]), "error" if failed else "output")
+        stem = os.path.splitext(os.path.basename(candidate["video_path"]))[0]
+        path = os.path.join(base, stem)
+        if os.path.exists(path):
+            path += datetime.now().strftime("_%Y%m%d_%H%M%S")
+        os.makedirs(path)
+        return path
+
+    def enqueue(self, candidate):
+        fingerprint = candidate["fingerprint"]
+        name = os.path.basename(candidate["video_path"])
+        done = self.history.get(fingerprint)
+        if done and done.get("result") != "ok":
+            done = None # 失敗したマスターは投入し直されたら再試行する
+        if fingerprint in self.queued_fingerprints or done:
+            reason = f"処理済み ({done['result']}: {done.get('destination')})" if done else "キュー内に同じ内容があります"
+            self.print_log(f"重複のためスキップします: {name} — {reason}")
+            return
+        if self.order != "fifo":
+            self.estimate(candidate)
+        self.queued_fingerprints.add(fingerprint)
+        self.queue.append(candidate)
+        message = f"キューに追加しました: {name} (待ち {len(self.queue)}件"
+        if self.order != "fifo":
+            estimate = candidate["estimate_sec"]
+            message += f", 見積もり 約{format_duration(estimate)}" if estimate is not None else ", 見積もり 履歴なし"
+            message += f", 締め切り {candidate['deadline']:%m/%d %H:%M}" if candidate.get("deadline") else ""
+            unknown = sum(c["estimate_sec"] is None for c in self.queue)
+            message += f", 待ちの合計 約{format_duration(sum(c['estimate_sec'] or 0.0 for c in self.queue))}"
+            message += f" + 見積もれない {unknown}件" if unknown else ""
+        self.print_log(message + ")")
+        get_metrics_collector().set_queued(len(self.queue))
+        if self.current is None:
+            self.run_next()
+
+    def estimate(self, candidate):
+        """
+        キューの並べ替えのため、レイアウトの設定とソースの長さから所要秒をジョブ履歴で見積もる。
+        同じ条件の履歴が無ければ、全ジョブの 所要秒 / ソースの長さ で換算する。
+        履歴がまったく無ければ estimate_sec は None (見積もれたものの後に、ソースの短い順に並べる)。
+        """
+        window = self.window
+        candidate["estimate_sec"] = candidate["duration_sec"] = None
+        try:
+            with open(candidate["layout_path"], 'r', encoding='utf-8') as f:
+                layout_data = json.load(f)
+            options = layout_data.get("authoring", {})
+            if options.get("deadline"):
+                candidate["deadline"] = parse_deadline(options["deadline"])
+            probe = load_source_probe(candidate["video_path"], window.find_ffmpeg(), window.find_ffprobe())
+            resolution_fps = options.get("resolution_fps", window.resolution_combo_box.currentData())
+            features = {"duration_sec": probe.get("duration") or 0.0, "titles": 1 + len(layout_data.get("titles", [])),
+                        "encoder": video_encoder_for(options.get("encoder", window.encoder_combo_box.currentData()), resolution_fps),
+                        "preset": options.get("preset", window.preset_combo_box.currentData()),
+                        "resolution_fps": resolution_fps,
+                        "output_format": options.get("output_format", window.output_format_combo.currentData())}
+            candidate["duration_sec"] = features["duration_sec"]
+            history = get_job_history()
+            prediction = history.predict_job(features)
+            if prediction:
+                candidate["estimate_sec"] = prediction["seconds"]
+            else:
+                ratio = history.wall_ratio()
+                candidate["estimate_sec"] = ratio * features["duration_sec"] if ratio and features["duration_sec"] else None
+        except (OSError, ValueError, TypeError, RuntimeError, subprocess.CalledProcessError, sqlite3.Error) as e:
+            self.print_log(f"所要時間を見積もれません (キューの末尾扱いにします): {os.path.basename(candidate['video_path'])}: {e}")
+
+    @staticmethod
+    def size_key(candidate):
+        # 見積もれたもの (所要秒) → 履歴が無くソースの長さだけ分かるもの → 何も分からないもの の順
+        if candidate["estimate_sec"] is not None:
+            return (0, candidate["estimate_sec"])
+        if candidate["duration_sec"]:
+            return (1, candidate["duration_sec"])
+        return (2, 0.0)
+
+    def take_next(self):
+        if self.order == "fifo":
+            return self.queue.popleft()
+        if self.order == "deadline":
+            key = lambda c: (0, c["deadline"].timestamp(), self.size_key(c)) if c.get("deadline") else (1, 0, self.size_key(c))
+        else:
+            key = self.size_key
+        candidate = min(self.queue, key=key) # 同じ値なら先に届いたもの
+        self.queue.remove(candidate)
+        return candidate
+
+    def run_next(self):
+        if not self.queue:
+            self.current = None
+            self.print_log("キューは空です。待機中...")
+            return
+        candidate = self.current = self.take_next()
+        get_metrics_collector().set_queued(len(self.queue))
+        if candidate.get("deadline") and candidate["estimate_sec"] is not None:
+            finish = datetime.now() + timedelta(seconds=candidate["estimate_sec"])
+            if finish > candidate["deadline"]:
+                self.print_log(f"警告: 締め切り ({candidate['deadline']:%m/%d %H:%M}) に間に合わない見込みです "
+                               f"(完了見込み {finish:%m/%d %H:%M})")
+        window = self.window
+        self.print_log(f"オーサリングを開始します: {candidate['video_path']} (レイアウト: {candidate['layout_path']})")
+        try:
+            candidate["work_dir"] = tempfile.mkdtemp(prefix="bdcopy_watch_", dir=os.path.dirname(candidate["video_path"]))
+            window.apply_layout_file(candidate["layout_path"])
+            window.selected_video_path = candidate["video_path"].replace('\\', '/')
+            window.output_dir = candidate["work_dir"].replace('\\', '/')
+            window.current_job = None
+            window.start_authoring()
+        except Exception as e:
+            self.job_failed(f"ジョブを開始できませんでした: {e}")
+            return
+        job = window.current_job
+        if job is None:
+            self.job_failed((window.log_output.toPlainText().splitlines() or ["ジョブを開始できませんでした。"])[-1])
+            return
+        candidate["job"] = job
+        job.finished.connect(self.job_finished)
+        job.error.connect(self.job_failed)
+
+    def _collect(self, candidate, destination, extra_files=()):
+        with open(os.path.join(destination, "authoring.log"), 'w', encoding='utf-8') as f:
+            f.write(self.window.log_output.toPlainText())
+        trace_path = os.path.join(candidate["work_dir"], "authoring_trace.json")
+        for path in list(extra_files) + [trace_path, candidate["video_path"]]:
+            if os.path.exists(path):
+                shutil.move(path, os.path.join(destination, os.path.basename(path)))
+        # フォルダ共通のレイアウトは残し、マスター専用のレイアウトだけ一緒に移す
+        if os.path.basename(candidate["layout_path"]) != WATCH_DEFAULT_LAYOUT:
+            shutil.move(candidate["layout_path"], os.path.join(destination, os.path.basename(candidate["layout_path"])))
+
+    def job_finished(self, iso_path):
+        self.detach_job()
+        self.when_workers_idle(lambda: self.collect_finished(iso_path))
+
+    def job_failed(self, message):
+        self.detach_job()
+        self.print_log(f"失敗: {os.path.basename(self.current['video_path'])}: {message}")
+        self.when_workers_idle(lambda: self.collect_failed(message)) # 失敗時も残りの Worker が止まってから片付ける
+
+    def detach_job(self):
+        # 後から届く別の Worker のエラーで二重に片付けないよう切り離す
+        candidate = self.current
+        if candidate.get("job") and not candidate.get("detached"):
+            candidate["detached"] = True
+            candidate["job"].finished.disconnect(self.job_finished)
+            candidate["job"].error.disconnect(self.job_failed)
+
+    def when_workers_idle(self, callback, announced=False):
+        """
+        ジョブの残りの Worker (失敗後も走り続けるエンコードなど) が終わってから callback を呼ぶ。
+        待つ間もイベントループは止めないので、新しいマスターの検出や終了シグナルは処理される。
+        """
+        if not self.window.threadpool.activeThreadCount():
+            callback()
+            return
+        if not announced:
+            self.print_log(f"残りの処理 ({self.window.threadpool.activeThreadCount()}件) の終了を待っています...")
+        QTimer.singleShot(WATCH_DRAIN_POLL_MS, lambda: self.when_workers_idle(callback, announced=True))
+
+    def collect_finished(self, iso_path):
+        candidate = self.current
+        try:
+            destination = self.result_dir(candidate, failed=False)
+            stem = os.path.splitext(os.path.basename(candidate["video_path"]))[0]
+            final_iso = os.path.join(destination, stem + (".iso" if iso_path.endswith(".iso") else "")) # BDMV フォルダのみの場合はフォルダ
+            shutil.move(iso_path, final_iso)
+            self._collect(candidate, destination)
+            self.history.record(candidate["fingerprint"], result="ok", source=candidate["video_path"], destination=final_iso)
+            self.print_log(f"完了: {final_iso}")
+        except Exception as e:
+            self.print_log(f"結果の移動に失敗しました: {e}")
+        self.finish_current()
+
+    def collect_failed(self, message):
+        candidate = self.current
+        try:
+            destination = self.result_dir(candidate, failed=True)
+            with open(os.path.join(destination, "error.txt"), 'w', encoding='utf-8') as f:
+                f.write(message + "\n")
+            self._collect(candidate, destination)
+            self.history.record(candidate["fingerprint"], result="error", source=candidate["video_path"],
+                                destination=destination, message=message)
+        except Exception as e:
+            self.print_log(f"エラーフォルダへの移動に失敗しました: {e}")
+        self.finish_current()
+
+    def finish_current(self):
+        candidate = self.current
+        self.detach_job()
+        self.queued_fingerprints.discard(candidate["fingerprint"])
+        if candidate.get("work_dir"):
+            shutil.rmtree(candidate["work_dir"], ignore_errors=True)
+        self.window.output_dir = None
+        self.current = None
+        self.run_next()
+
+# --- ディスクセットの作成 (タイトルの振り分けと並行オーサリング) ---
+DISC_SET_MANIFEST = "disc_set.json"
+
+def build_set_project(layout_data, layout_dir, titles, disc_number, disc_count):
+    """ 共通レイアウトから1枚分のプロジェクト (タイトル一覧とタイトルごとのボタン) を作る """
+    project = json.loads(json.dumps(layout_data))
+    project["background"] = os.path.join(layout_dir, layout_data["background"])
+    project["video"] = titles[0]["sources"][0]
+    project["chapters"] = titles[0]["chapters"]
+    project["titles"] = titles[1:]
+    if menu_template_fields(layout_data):
+        # テンプレートのレイアウトなら {disc} {discs} {episodes} (タイトル名のリスト) を埋める。
+        # タイトルへ飛ぶのは繰り返すボタンだけで、固定のボタンはレイアウトの飛び先のまま
+        values = {"disc": disc_number, "discs": disc_count, "episodes": [title["name"] for title in titles]}
+        buttons = project.get("buttons") or [{}]
+        project["buttons"] = buttons
+        for i in menu_list_buttons(buttons, dict(project.get("template_values", {}), **values)) or range(len(buttons)):
+            buttons[i]["time_str"] = "title:{n}"
+        return apply_menu_template(project, values, button_count=len(titles))
+    if disc_count > 1 and project.get("title"):
+        project["title"]["text"] = f"{project['title'].get('text', '')} - Disc {disc_number}"
+    # ボタンの体裁は共通レイアウトの先頭のボタンに揃え、間隔は先頭2つのボタンから取る
+    buttons = layout_data.get("buttons") or [{}]
+    template = buttons[0]
+    step = buttons[1].get("pos_y", 0) - template.get("pos_y", 0) if len(buttons) > 1 else 70
+    project["buttons"] = [dict(template, text=title["name"], time_str=f"title:{n}", pos_x=template.get("pos_x", 100),
+                               pos_y=template.get("pos_y", 150) + (n - 1) * step)
+                          for n, title in enumerate(titles, start=1)]
+    return project
+
+class DiscSetBuilder(QObject):
+    """
+    複数のソースを予測サイズでディスクに振り分け、1枚ごとのプロジェクトを書き出して
+    すべてのディスクを並行にオーサリングする (ウィンドウは表示しない)。
+    """
+    finished = Signal(int) # 失敗したディスクの数
+
+    def __init__(self, window, sources, layout_path, media, output_dir, parent=None):
+        super().__init__(parent)
+        self.window = window
+        self.sources = [os.path.abspath(path) for path in sources]
+        self.layout_path = os.path.abspath(layout_path)
+        self.media = media
+        self.output_dir = os.path.abspath(output_dir)
+        self.manifest = None
+        self.pending = 0
+        self.failures = 0
+
+    print_log = staticmethod(WatchFolderDaemon.print_log)
+
+    def start(self):
+        window = self.window
+        try:
+            window.apply_layout_file(self.layout_path) # エンコーダなどのオーサリング設定を読む
+        except Exception as e:
+            self.print_log(f"レイアウトを読み込めませんでした: {e}")
+            self.finished.emit(1)
+            return
+        preset, _threads = window.resolve_encoder_preset()
+        self.print_log(f"{len(self.sources)}本のソースの容量を予測しています ({self.media})...")
+        worker = SetPlanningWorker(self.sources, window.encoder_combo_box.currentData(), window.resolution_combo_box.currentData(),
+                                   window.find_ffmpeg(), window.find_ffprobe(), preset=preset,
+                                   analyze_source=window.analysis_checkbox.isChecked(),
+                                   normalize_loudness=window.loudnorm_checkbox.isChecked())
+        worker.signals.log.connect(self.print_log)
+        worker.signals.result.connect(self.planned)
+        worker.signals.error.connect(self.planning_failed)
+        window.threadpool.start(worker)
+
+    def planning_failed(self, message):
+        self.print_log(message)
+        self.finished.emit(1)
+
+    def planned(self, sizes):
+        capacity = disc_title_capacity(self.media, self.window.menu_duration_sec)
+        too_large = [os.path.basename(path) for path, size in zip(self.sources, sizes) if size > capacity]
+        if too_large:
+            self.print_log(f"{self.media} 1枚 (使用可能 {format_size(capacity)}) に収まらないソースがあります: {', '.join(too_large)}")
+            self.finished.emit(1)
+            return
+        discs = pack_titles_into_discs(sizes, capacity)
+        with open(self.layout_path, 'r', encoding='utf-8') as f:
+            layout_data = json.load(f)
+        self.manifest = {"media": self.media, "capacity_bytes": capacity, "layout": self.layout_path, "discs": []}
+        for number, indexes in enumerate(discs, start=1):
+            titles = [{"name": os.path.splitext(os.path.basename(self.sources[i]))[0], "sources": [self.sources[i]],
+                       "chapters": []} for i in indexes]
+            disc_dir = os.path.join(self.output_dir, f"disc_{number:02}")
+            os.makedirs(disc_dir, exist_ok=True)
+            project_path = os.path.join(disc_dir, "project.json")
+            with open(project_path, 'w', encoding='utf-8') as f:
+                json.dump(build_set_project(layout_data, os.path.dirname(self.layout_path), titles, number, len(discs)),
+                          f, indent=4, ensure_ascii=False)
+            fill = sum(sizes[i] for i in indexes)
+            self.manifest["discs"].append({"disc": number, "project": project_path, "sources": [self.sources[i] for i in indexes],
+                                           "predicted_bytes": fill, "fill_ratio": round(fill / capacity, 4)})
+            self.print_log(f"ディスク{number}: {', '.join(title['name'] for title in titles)} — "
+                           f"予測 {format_size(fill)} ({fill / capacity:.0%})")
+        self.write_manifest()
+        self.pending = len(self.manifest["discs"])
+        for disc in self.manifest["discs"]:
+            self.start_disc(disc)
+
+    def write_manifest(self):
+        with open(os.path.join(self.output_dir, DISC_SET_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=1, ensure_ascii=False)
+
+    def start_disc(self, disc):
+        # ジョブは開始時に設定とメニュー画像を受け取るので、同じウィンドウで次のディスクを組み立ててよい
+        window = self.window
+        disc_log = []
+        try:
+            window.apply_layout_file(disc["project"])
+            window.output_dir = os.path.dirname(disc["project"]).replace('\\', '/')
+            window.current_job = None
+            window.start_authoring()
+        except Exception as e:
+            self.disc_done(disc, disc_log, None, f"ジョブを開始できませんでした: {e}")
+            return
+        finally:
+            window.output_dir = None
+        job = window.current_job
+        if job is None:
+            self.disc_done(disc, disc_log, None, (window.log_output.toPlainText().splitlines() or ["ジョブを開始できませんでした。"])[-1])
+            return
+        self.print_log(f"ディスク{disc['disc']} のオーサリングを開始しました。")
+        job.log.connect(disc_log.append)
+        job.finished.connect(lambda path, disc=disc, disc_log=disc_log: self.disc_done(disc, disc_log, path, None))
+        job.error.connect(lambda message, disc=disc, disc_log=disc_log: self.disc_done(disc, disc_log, None, message))
+
+    def disc_done(self, disc, disc_log, output_path, message):
+        if "result" in disc:
+            return # 失敗の後から届く通知は無視する
+        disc["result"] = "ok" if output_path else "error"
+        disc_dir = os.path.dirname(disc["project"])
+        with open(os.path.join(disc_dir, "authoring.log"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(disc_log + ([message] if message else [])) + "\n")
+        if output_path:
+            disc["output"] = output_path
+            self.print_log(f"ディスク{disc['disc']} 完了: {output_path}")
+        else:
+            disc["error"] = message
+            self.failures += 1
+            self.print_log(f"ディスク{disc['disc']} 失敗: {message}")
+        self.pending -= 1
+        self.write_manifest()
+        if self.pending == 0:
+            self.print_log(f"ディスクセットの作成が終わりました: {len(self.manifest['discs']) - self.failures}枚成功 / "
+                           f"{self.failures}枚失敗 ({os.path.join(self.output_dir, DISC_SET_MANIFEST)})")
+            self.finished.emit(self.failures)
+
+# --- パイプラインのベンチマーク ---
+BENCHMARK_RESULT_VERSION = 1 # 結果JSONの形式を変えたら上げる
+
+# スタブの ffmpeg / tsMuxeR。設定JSONに従って出力行を流し、出力ファイルを書くだけで終了する
+STUB_TOOL_SOURCE = """import json, sys, time
+script = json.load(open({config!r}, encoding="utf-8"))[{tool!r}]
+args = sys.argv[1:]
+if script.get("probe_lines") and "-y" not in args:
+    # ffmpeg -i <file> (プローブ) は出力ファイル無しで終了コード 1 を返す
+    print("\\n".join(script["probe_lines"]), flush=True)
+    sys.exit(1)
+for i in range(script.get("lines", 0)):
+    print(script.get("line", "frame={{i}}").format(i=i), flush=True)
+    time.sleep(script.get("line_interval", 0.0))
+if args and args[-1] != "-":
+    with open(args[-1], "wb") as f:
+        f.write(b"\\0" * script.get("output_bytes", 0))
+sys.exit(script.get("returncode", 0))
+"""
+
+def build_stub_script(duration_sec, resolution_fps, overrides=None):
+    """ 合成ソース1本分のスタブの振る舞い (出力行・書き込みサイズ・プローブ結果) """
+    width, height, _ = parse_resolution_fps(resolution_fps)
+    h, rem = divmod(duration_sec, 3600)
+    m, sec = divmod(rem, 60)
+    script = {
+        "ffmpeg": {"lines": 20, "line": "frame={i} fps=0.0 q=-1.0 size=0kB time=00:00:00.00 bitrate=N/A speed=N/A",
+                   "line_interval": 0.0, "output_bytes": 256 * 1024,
+                   "probe_lines": ["Input #0, matroska,webm, from 'synthetic.mkv':",
+                                   f"  Duration: {int(h):02}:{int(m):02}:{sec:05.2f}, start: 0.000000, bitrate: 8000 kb/s",
+                                   f"  Stream #0:0: Video: h264 (High), yuv420p(progressive), {width}x{height} [SAR 1:1 DAR 16:9], 23.98 fps, 23.98 tbr, 1k tbn",
+                                   "  Stream #0:1(eng): Audio: ac3, 48000 Hz, stereo, fltp, 192 kb/s"]},
+        "tsMuxeR": {"lines": 10, "line": "{i}0.0% complete", "line_interval": 0.0, "output_bytes": 1024 * 1024},
+    }
+    for tool, values in (overrides or {}).items():
+        script.setdefault(tool, {}).update(values)
+    return script
+
+def write_stub_tools(directory, script):
+    """ スタブの ffmpeg / tsMuxeR を書き出し、{ツール名: 実行パス} を返す """
+    config_path = os.path.join(directory, "stub_script.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(script, f)
+    tools = {}
+    for tool in ("ffmpeg", "tsMuxeR"):
+        source_path = os.path.join(directory, f"{tool}_stub.py")
+        with open(source_path, 'w', encoding='utf-8') as f:
+            f.write(STUB_TOOL_SOURCE.format(config=config_path, tool=tool))
+        if sys.platform == 'win32':
+            tools[tool] = os.path.join(directory, f"{tool}.cmd")
+            with open(tools[tool], 'w', encoding='utf-8') as f:
+                f.write(f'@"{sys.executable}" "{source_path}" %*\n')
+        else:
+            tools[tool] = os.path.join(directory, tool)
+            with open(tools[tool], 'w', encoding='utf-8') as f:
+                f.write(f"#!{sys.executable}\n")
+                f.write(open(source_path, encoding='utf-8').read())
+            os.chmod(tools[tool], 0o755)
+    return tools
+
+def generate_synthetic_source(ffmpeg_path, output_path, duration_sec, resolution_fps):
+    """ lavfi のテストパターン + 正弦波で合成ソース (H.264 + AC-3 の mkv) を作る """
+    width, height, fps = parse_resolution_fps(resolution_fps)
+    command = [ffmpeg_path, '-hide_banner', '-nostats', '-y',
+               '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+               '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+               '-t', str(duration_sec), '-map', '0:v', '-map', '1:a',
+               '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18',
+               '-c:a', 'ac3', '-b:a', '192k', '-metadata:s:a:0', 'language=eng', output_path]
+    returncode, _ = run_command(command)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+
+def write_benchmark_background(path, width=MENU_LAYOUT_WIDTH, height=MENU_LAYOUT_HEIGHT):
+    image = QImage(width, height, QImage.Format.Format_RGB32)
+    painter = QPainter(image)
+    gradient = QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0.0, QColor("#203060"))
+    gradient.setColorAt(1.0, QColor("#a04020"))
+    painter.fillRect(0, 0, width, height, gradient)
+    painter.end()
+    image.save(path)
+
+def get_code_version():
+    """ 結果を版ごとに比較できるよう、main.py の内容のハッシュを返す """
+    try:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except OSError:
+        return "unknown"
+
+def run_pipeline_case(window, case, work_dir, tools, encoder, preset):
+    """ 1ケース分 (合成ソースの生成 → メニュー描画 → エンコード → meta → tsMuxeR) をヘッドレスで実行する """
+    case_dir = os.path.join(work_dir, case["name"])
+    os.makedirs(case_dir, exist_ok=True)
+    source_path = os.path.join(case_dir, "source.mkv").replace('\\', '/')
+    background_path = os.path.join(work_dir, "background.png")
+    if not os.path.exists(background_path):
+        write_benchmark_background(background_path)
+    if tools.get("stub"):
+        with open(source_path, 'wb') as f:
+            f.write(b"\0" * 1024) # スタブはソースを読まない
+    else:
+        generate_synthetic_source(tools["ffmpeg"], source_path, case["duration_sec"], case["resolution_fps"])
+
+    window.tool_paths = {"ffmpeg": tools["ffmpeg"], "tsMuxeR": tools["tsMuxeR"], "ffprobe": tools.get("ffprobe")}
+    window.check_iso = not tools.get("stub") # スタブの tsMuxeR は UDF を書かない
+    window.selected_video_path = source_path
+    window.background_image_path = background_path
+    window.set_background_image(background_path)
+    half = int(case["duration_sec"] // 2)
+    window.chapters = [f"{half // 3600:02}:{half % 3600 // 60:02}:{half % 60:02}"] if half else []
+    for combo, value in ((window.encoder_combo_box, encoder), (window.resolution_combo_box, case["resolution_fps"]),
+                         (window.preset_combo_box, preset)):
+        if combo.findData(value) < 0:
+            combo.addItem(value, value)
+        combo.setCurrentIndex(combo.findData(value))
+    window.analysis_checkbox.setChecked(False)
+    window.loudnorm_checkbox.setChecked(False)
+    window.verify_checkbox.setChecked(False)
+    window.media_combo_box.setCurrentIndex(0)
+
+    metrics = get_stage_metrics()
+    metrics.reset()
+    outcome = {}
+    loop = QEventLoop()
+    times_started, started = os.times(), time.perf_counter()
+    window.current_job = None
+    window.start_authoring()
+    job = window.current_job
+    if job is None:
+        outcome["error"] = (window.log_output.toPlainText().splitlines() or ["ジョブを開始できませんでした。"])[-1]
+    else:
+        job.finished.connect(lambda path: (outcome.setdefault("iso", path), loop.quit()))
+        job.error.connect(lambda message: (outcome.setdefault("error", message), loop.quit()))
+        loop.exec()
+    window.threadpool.waitForDone()
+    wall = time.perf_counter() - started
+    times_finished = os.times()
+    cpu = sum(times_finished[i] - times_started[i] for i in range(4)) # user/sys (自身 + 子プロセス)
+    stages = sorted(metrics.stages, key=lambda stage: stage["start_sec"])
+    return {"name": case["name"], "duration_sec": case["duration_sec"], "resolution_fps": case["resolution_fps"],
+            "ok": "error" not in outcome, "error": outcome.get("error"),
+            "wall_sec": round(wall, 4), "cpu_sec": round(cpu, 4),
+            "peak_rss_bytes": max([stage["peak_rss_bytes"] for stage in stages] + [0]),
+            "bytes_written": sum(stage["bytes_written"] for stage in stages),
+            "stages": stages}
+
+def run_pipeline_benchmark(window, durations, resolutions, work_dir, encoder="libx264", preset="medium",
+                           stub=False, stub_overrides=None, ffmpeg_path=None, tsmuxer_path=None, log=print):
+    """ 長さ x 解像度の各ケースを実行し、比較可能な結果 (dict) を返す """
+    os.environ["BDCOPY_CACHE_DIR"] = os.path.join(work_dir, "cache") # 索引のキャッシュで結果が変わらないようにする
+    metrics = get_stage_metrics()
+    metrics.enabled = True
+    result = {"format": BENCHMARK_RESULT_VERSION, "code_version": get_code_version(),
+              "created_at": datetime.now().isoformat(timespec="seconds"), "machine": get_machine_id(),
+              "platform": platform.platform(), "python": platform.python_version(),
+              "mode": "stub" if stub else "real", "encoder": encoder, "preset": preset, "cases": []}
+    if not stub:
+        _, lines = run_command([ffmpeg_path, '-hide_banner', '-version'], capture=True)
+        result["ffmpeg"] = lines[0] if lines else ""
+    try:
+        for duration in durations:
+            for resolution_fps in resolutions:
+                case = {"name": f"{duration:g}s_{resolution_fps.replace(':', '@').replace('/', '_')}",
+                        "duration_sec": duration, "resolution_fps": resolution_fps}
+                if stub:
+                    stub_dir = os.path.join(work_dir, case["name"] + "_tools")
+                    os.makedirs(stub_dir, exist_ok=True)
+                    tools = dict(write_stub_tools(stub_dir, build_stub_script(duration, resolution_fps, stub_overrides)),
+                                 stub=True, ffprobe=None)
+                else:
+                    tools = {"ffmpeg": ffmpeg_path, "tsMuxeR": tsmuxer_path, "ffprobe": None}
+                log(f"[{case['name']}] 実行中...")
+                case_result = run_pipeline_case(window, case, work_dir, tools, encoder, preset)
+                result["cases"].append(case_result)
+                status = "OK" if case_result["ok"] else f"失敗: {case_result['error']}"
+                log(f"[{case['name']}] {status} 合計 {case_result['wall_sec']:.2f}秒 (CPU {case_result['cpu_sec']:.2f}秒)")
+                for stage in case_result["stages"]:
+                    log(f"    {stage['name']:<16} {stage['wall_sec']:>8.3f}秒  CPU {stage['cpu_sec']:>8.3f}秒  "
+                        f"RSS {stage['peak_rss_bytes'] / 2**20:>8.1f} MiB  書込 {stage['bytes_written'] / 2**20:>8.1f} MiB")
+    finally:
+        metrics.enabled = False
+    return result
+
+def compare_benchmark_results(base, current):
+    """ 2つの結果JSONをケース・段階ごとに比較した行のリストを返す """
+    lines = [f"基準: {base.get('code_version')} ({base.get('created_at')})  比較: {current.get('code_version')} ({current.get('created_at')})"]
+    base_cases = {case["name"]: case for case in base.get("cases", [])}
+    for case in current.get("cases", []):
+        old = base_cases.get(case["name"])
+        if not old:
+            lines.append(f"[{case['name']}] 基準に無いケース")
+            continue
+        def delta(a, b):
+            return f"{a:.3f} → {b:.3f}秒 ({(b - a) / a:+.1%})" if a else f"{a:.3f} → {b:.3f}秒"
+        lines.append(f"[{case['name']}] 合計 {delta(old['wall_sec'], case['wall_sec'])}")
+        old_stages = {stage["name"]: stage for stage in old.get("stages", [])}
+        for stage in case.get("stages", []):
+            if stage["name"] in old_stages:
+                lines.append(f"    {stage['name']:<16} {delta(old_stages[stage['name']]['wall_sec'], stage['wall_sec'])}")
+    return lines
+
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    multiprocessing.freeze_support() # PyInstaller でビルドした実行ファイルでのプロセスプール用
+    parser = argparse.ArgumentParser(description="BDCopy")
+    parser.add_argument('--benchmark-presets', metavar='ENCODER', help="エンコーダのプリセットを計測してプロファイルを保存し終了する (例: libx264)")
+    parser.add_argument('--resolution', default="1920x1080:24000/1001", help="ベンチマークの解像度とフレームレート")
+    parser.add_argument('--ffmpeg', default="ffmpeg", help="ffmpeg のパス")
+    parser.add_argument('--tsmuxer', help="tsMuxeR のパス (パイプラインのベンチマーク用)")
+    parser.add_argument('--benchmark-pipeline', metavar='RESULT_JSON', help="合成ソースで全工程を計測し、結果をJSONに書いて終了する")
+    parser.add_argument('--bench-durations', default="10,60", help="合成ソースの長さ (秒, カンマ区切り)")
+    parser.add_argument('--bench-resolutions', default="1280x720:30,1920x1080:24000/1001", help="解像度:fps (カンマ区切り)")
+    parser.add_argument('--bench-encoder', default="libx264")
+    parser.add_argument('--bench-preset', default="medium")
+    parser.add_argument('--bench-work-dir', help="作業フォルダ (省略時は一時フォルダを使い、終了後に削除)")
+    parser.add_argument('--stub-tools', action='store_true', help="ffmpeg/tsMuxeR をスタブに置き換え、段取りのオーバーヘッドだけを計測する")
+    parser.add_argument('--stub-script', help="スタブの振る舞いを上書きするJSON (例: {\"ffmpeg\": {\"lines\": 500}})")
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get("BDCOPY_METRICS_PORT", "0")),
+                        help="Prometheus 形式のメトリクスを http://127.0.0.1:PORT/metrics で公開する (0 で無効)")
+    parser.add_argument('--watch', nargs='+', metavar='DIR', help="監視フォルダに届いたマスター + レイアウトJSONを自動でオーサリングする (デーモン)")
+    parser.add_argument('--watch-output', help="成功時の出力フォルダ (省略時は各監視フォルダの output)")
+    parser.add_argument('--watch-error', help="失敗時の出力フォルダ (省略時は各監視フォルダの error)")
+    parser.add_argument('--watch-stable-sec', type=float, default=WATCH_STABLE_SEC, help="書き込み完了とみなすまでの静止時間 (秒)")
+    parser.add_argument('--watch-polling', action='store_true', help="inotify を使わずポーリングで監視する")
+    parser.add_argument('--watch-order', default="fifo", choices=QUEUE_ORDERS,
+                        help="キューの順序 (fifo: 届いた順 / shortest: 見積もりの短い順 / deadline: authoring.deadline の早い順)")
+    parser.add_argument('--job-history', type=int, nargs='?', const=20, metavar='N', help="直近のジョブ履歴を N 件表示して終了する")
+    parser.add_argument('--coordinator-port', type=int, help="本編映像をエージェントに分散してエンコードする (待ち受けポート)")
+    parser.add_argument('--coordinator-host', default="127.0.0.1", help="コーディネータの待ち受けアドレス (他のマシンから使う場合は 0.0.0.0 など)")
+    parser.add_argument('--segment-sec', type=float, default=DISTRIBUTED_SEGMENT_SEC, help="分散エンコードのセグメント長 (秒)")
+    parser.add_argument('--agent', metavar='URL', help="分散エンコードのエージェントとして動作する (例: http://host:port)")
+    parser.add_argument('--agent-name', help="エージェント名 (省略時はホスト名-PID)")
+    parser.add_argument('--cluster-token', default=os.environ.get("BDCOPY_CLUSTER_TOKEN"),
+                        help="コーディネータとエージェントの共有トークン (BDCOPY_CLUSTER_TOKEN)")
+    parser.add_argument('--measure-startup', action='store_true', help="起動時間 (段階ごとの経過秒) をJSONで出力して終了する")
+    parser.add_argument('--check-iso', metavar='ISO', help="ISO のハッシュと UDF (BDMV) 構造を確認してマニフェストを書き、終了する")
+    parser.add_argument('--readback', nargs=2, metavar=('ISO', 'TARGET'),
+                        help="TARGET (ドライブID またはイメージファイル) を読み戻して ISO と比べ、終了する")
+    parser.add_argument('--pack-bdmv', nargs=2, metavar=('FOLDER', 'ISO'), help="BDMV フォルダを ISO にまとめて終了する")
+    parser.add_argument('--cpu-budget', type=int, help="エンコードに割り当てるスレッド数の合計 (省略時はコア数 - 1)")
+    parser.add_argument('--cpu-affinity', action='store_true', help="エンコードごとに重ならない CPU を割り当てる")
+    parser.add_argument('--normal-priority', action='store_true', help="エンコードの優先度 (nice / ionice) を下げない")
+    parser.add_argument('--build-set', nargs='+', metavar='SOURCE',
+                        help="複数のソースを予測サイズでディスクに振り分け、1枚ずつのプロジェクトを作ってすべて並行にオーサリングする")
+    parser.add_argument('--set-layout', help="ディスクセットで共通に使うレイアウトJSON (背景・タイトル・ボタンの体裁・オーサリング設定)")
+    parser.add_argument('--set-media', default="BD-25", choices=sorted(MEDIA_CAPACITY_BYTES), help="ディスクセットのメディア")
+    parser.add_argument('--set-output', default="disc_set", help="ディスクセットの出力フォルダ (ディスクごとに disc_NN を作る)")
+    parser.add_argument('--render-menus', nargs=2, metavar=('LAYOUT', 'VALUES'),
+                        help="テンプレートのレイアウトに差し込み値 (CSV/JSON) を埋めてメニュー画像と動画を一括で作り、終了する")
+    parser.add_argument('--menu-output', default="menus", help="一括描画の出力フォルダ (値の組ごとに name のフォルダを作る)")
+    parser.add_argument('--menu-jobs', type=int, help="一括描画のプロセス数 (省略時はコア数 - 1)")
+    parser.add_argument('--menu-duration', type=float, default=10.0, help="メニュー動画の長さ (秒)")
+    parser.add_argument('--menu-images-only', action='store_true', help="メニュー画像だけを作り、動画はエンコードしない")
+    parser.add_argument('--probe-tools', action='store_true', help="外部ツールの機能を調べ直してキャッシュを更新し終了する (ドライバ更新後など)")
+    parser.add_argument('--benchmark-compare', nargs=2, metavar=('BASE_JSON', 'RESULT_JSON'), help="2つのベンチマーク結果を比較して終了する")
+    args, qt_args = parser.parse_known_args()
+    # 監視フォルダのデーモンとディスクセットの作成は GUI を表示しないので、予約コアもエンコードに回す
+    configure_resource_governor(budget=args.cpu_budget, affinity=args.cpu_affinity, background_priority=not args.normal_priority,
+                                reserved_cores=0 if args.watch or args.build_set else CPU_RESERVED_CORES)
+    if args.benchmark_compare:
+        results = []
+        for path in args.benchmark_compare:
+            with open(path, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        print("\n".join(compare_benchmark_results(*results)))
+        sys.exit(0)
+    if args.job_history:
+        history = get_job_history()
+        for job in reversed(history.recent_jobs(args.job_history)):
+            duration = format_duration(job["duration_sec"]) if job["duration_sec"] else "-"
+            output = format_size(job["output_bytes"]) if job["output_bytes"] else "-"
+            print(f"#{job['id']:<5} {job['started_at']}  {job['result']:<5}  {os.path.basename(job['source'] or '')}  "
+                  f"ソース {duration}  {job['encoder']}/{job['preset'] or '既定'} {job['resolution_fps']}  {job['output_format']}  "
+                  f"所要 {format_duration(job['wall_sec'])}  "
+                  f"{str(job['encode_fps']) + 'fps' if job['encode_fps'] else '-'}  出力 {output}")
+        print(f"保存先: {history.path}")
+        sys.exit(0)
+    if args.check_iso:
+        manifest, problems = check_iso_image(args.check_iso, hash_iso_chunks(args.check_iso))
+        for path, size in sorted(manifest["files"].items()):
+            print(f"{size:>14,}  {path}")
+        print("\n".join(problems) or f"問題なし: SHA-256 (チャンク単位) {manifest['digest']}")
+        sys.exit(1 if problems else 0)
+    if args.readback:
+        iso_path, target = args.readback
+        manifest = load_iso_manifest(iso_path) or write_iso_manifest(iso_path, hash_iso_chunks(iso_path))
+        with open_readback_device(target, log=print, timeout_sec=0) as device:
+            mismatches = verify_readback(device, iso_path, manifest, log=print)
+        for start, end in mismatches:
+            print(f"不一致: セクタ {start}-{end}")
+        print("一致しました" if not mismatches else f"{len(mismatches)} 箇所が一致しません")
+        sys.exit(1 if mismatches else 0)
+    if args.pack_bdmv:
+        folder, iso_path = args.pack_bdmv
+        problems = check_bdmv_structure(scan_bdmv_folder(folder), 0)
+        if problems:
+            print("\n".join(problems))
+            sys.exit(1)
+        print(pack_bdmv_iso(folder, iso_path, log=print))
+        sys.exit(0)
+    if args.render_menus:
+        layout_path, values_path = args.render_menus
+        with open(layout_path, 'r', encoding='utf-8') as f:
+            resolution_fps = json.load(f).get("authoring", {}).get("resolution_fps", args.resolution)
+        ffmpeg_path = None
+        if not args.menu_images_only:
+            ffmpeg_path = get_tool_registry().locate("ffmpeg") if args.ffmpeg == "ffmpeg" else args.ffmpeg
+        if not args.menu_images_only and not ffmpeg_path:
+            sys.exit("ffmpeg が見つかりません (--menu-images-only で画像だけを作れます)。")
+        manifest = render_menu_batch(layout_path, load_menu_variants(values_path), os.path.abspath(args.menu_output),
+                                     resolution_fps, ffmpeg_path=ffmpeg_path, duration_sec=args.menu_duration,
+                                     jobs=args.menu_jobs, log=print)
+        failed = [entry for entry in manifest["variants"] if "error" in entry]
+        print(f"メニュー {len(manifest['variants'])}件 (描画 {sum(entry['rendered'] for entry in manifest['variants'])}件, "
+              f"失敗 {len(failed)}件): {os.path.join(os.path.abspath(args.menu_output), MENU_BATCH_MANIFEST)}")
+        sys.exit(1 if failed else 0)
+    if args.probe_tools:
+        registry = get_tool_registry()
+        for name in ("ffmpeg", "ffprobe", "tsMuxeR"):
+            path = registry.locate(name)
+            if not path:
+                print(f"{name}: 見つかりません")
+                continue
+            capabilities = registry.capabilities(name, path, refresh=True)
+            print(f"{name}: {path}\n  {capabilities['version']}")
+            if "usable_encoders" in capabilities:
+                print(f"  使用できる映像エンコーダ: {', '.join(capabilities['usable_encoders']) or 'なし'}")
+                print(f"  エンコーダ {len(capabilities['encoders'])} / フィルタ {len(capabilities['filters'])} / "
+                      f"マルチプレクサ {len(capabilities['muxers'])}")
+        print(f"保存先: {registry.cache_path}")
+        sys.exit(0)
+    if args.agent:
+        if not args.cluster_token:
+            sys.exit("--cluster-token (または BDCOPY_CLUSTER_TOKEN) を指定してください。")
+        agent_stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: agent_stop.set())
+        run_encode_agent(args.agent, args.cluster_token, args.ffmpeg, name=args.agent_name, stop=agent_stop)
+        sys.exit(0)
+    if args.benchmark_presets:
+        results = benchmark_encoder_presets(args.ffmpeg, args.benchmark_presets, args.resolution, log=print)
+        save_encoder_profile(args.benchmark_presets, args.resolution, results)
+        for quality_floor in (0.95, DEFAULT_QUALITY_FLOOR, 0.99):
+            preset, threads, reason = select_encoder_preset(args.benchmark_presets, args.resolution, quality_floor)
+            print(f"SSIM下限 {quality_floor}: preset={preset} threads={threads or 'auto'} ({reason})")
+        print(f"保存先: {get_encoder_profile_path()}")
+        sys.exit(0)
+    if args.benchmark_pipeline:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # ウィンドウを表示せずに実行する
+        app = QApplication(sys.argv[:1] + qt_args)
+        window = MainWindow()
+        tsmuxer_path = args.tsmuxer or window.find_tsmuxer()
+        if not args.stub_tools and not tsmuxer_path:
+            sys.exit("tsMuxeR が見つかりません (--tsmuxer で指定するか --stub-tools を使ってください)。")
+        with tempfile.TemporaryDirectory(prefix="bdcopy_pipeline_") as tmp_dir:
+            work_dir = os.path.abspath(args.bench_work_dir or tmp_dir)
+            os.makedirs(work_dir, exist_ok=True)
+            result = run_pipeline_benchmark(
+                window, [float(v) for v in args.bench_durations.split(',')], args.bench_resolutions.split(','),
+                work_dir, encoder=args.bench_encoder, preset=args.bench_preset, stub=args.stub_tools,
+                stub_overrides=json.loads(args.stub_script) if args.stub_script else None,
+                ffmpeg_path=args.ffmpeg, tsmuxer_path=tsmuxer_path)
+        with open(args.benchmark_pipeline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1, ensure_ascii=False)
+        print(f"結果を保存しました: {args.benchmark_pipeline}")
+        sys.exit(0 if all(case["ok"] for case in result["cases"]) else 1)
+    if args.build_set and not args.set_layout:
+        sys.exit("--set-layout で共通のレイアウトJSONを指定してください。")
+    if args.watch or args.measure_startup or args.build_set:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # ウィンドウを表示せずに実行する
+    mark_startup("import")
+    app = QApplication(sys.argv[:1] + qt_args)
     app.setStyleSheet(STYLE_SHEET)
+    mark_startup("qapplication")
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+        print(f"メトリクス: http://127.0.0.1:{args.metrics_port}/metrics")
+    coordinator = None
+    if args.coordinator_port is not None:
+        coordinator = EncodeCoordinator(args.coordinator_port, args.coordinator_host, token=args.cluster_token,
+                                        segment_sec=args.segment_sec).start()
+        host, port = coordinator.address
+        print(f"分散エンコードのコーディネータ: http://{host}:{port}")
+        if not args.cluster_token:
+            print(f"エージェントの起動: {os.path.basename(sys.argv[0])} --agent http://{host}:{port} --cluster-token {coordinator.token}")
+    if args.watch:
+        window = MainWindow() # メニュー描画とジョブの組み立てに使う (表示しない)
+        window.encode_coordinator = coordinator
+        daemon = WatchFolderDaemon(window, args.watch, output_dir=args.watch_output, error_dir=args.watch_error,
+                                   stable_sec=args.watch_stable_sec, use_inotify=not args.watch_polling,
+                                   order=args.watch_order)
+        daemon.start()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: app.quit())
+        # Qt のイベントループ中でも Python のシグナルハンドラが動くよう定期的に制御を戻す
+        signal_timer = QTimer()
+        signal_timer.timeout.connect(lambda: None)
+        signal_timer.start(500)
+        exit_code = app.exec()
+        daemon.stop()
+        sys.exit(exit_code)
+    if args.build_set:
+        window = MainWindow() # メニュー描画とジョブの組み立てに使う (表示しない)
+        window.encode_coordinator = coordinator
+        builder = DiscSetBuilder(window, args.build_set, args.set_layout, args.set_media, args.set_output)
+        builder.finished.connect(lambda failures: app.exit(1 if failures else 0))
+        QTimer.singleShot(0, builder.start)
+        sys.exit(app.exec())
     window = MainWindow()
+    window.encode_coordinator = coordinator
+    mark_startup("main_window")
     window.show()
+    def startup_finished():
+        # イベントループが回り始めた時点 (ウィンドウの表示後) を起動完了とする
+        mark_startup("shown")
+        window.log_message(describe_startup())
+        if args.measure_startup:
+            print(json.dumps(_startup_marks))
+            app.quit()
+    QTimer.singleShot(0, startup_finished)
     sys.exit(app.exec())
\ No newline at end of file